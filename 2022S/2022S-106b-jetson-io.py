@@ -22,11 +22,137 @@
 
 from curses import panel
 import curses
-from Jetson import board
+import json
 import os
 import shutil
 import sys
 import textwrap
+import threading
+
+
+CACHE_DIR = '/var/cache/jetson-io'
+# Board model, as the device tree names it
+MODEL = '/proc/device-tree/compatible'
+
+
+class LazyBoard(object):
+    # board.Board() probes the device tree, every header's pinmux and
+    # every addon overlay before it returns. LazyBoard runs that probe in
+    # the background from start(), or on first use without it, and
+    # memoizes the queries whose answers cannot change in a session.
+    # hw_addon_get() is not one of them: the addons it lists are those of
+    # the active header, so it always goes to the board.
+    #
+    # With a cache file, the header names are also remembered per board
+    # model, so the main menu can be drawn from them while the probe is
+    # still running; opening a header is what waits for the board.
+    def __init__(self, cache=None):
+        self._board = None
+        self._error = None
+        self._thread = None
+        self._memo = {}
+        self._cache = cache
+        self._cached_headers = None
+
+    def start(self):
+        if self._thread is None and self._board is None:
+            self._thread = threading.Thread(target=self._probe)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _probe(self):
+        try:
+            from Jetson import board
+            self._board = board.Board()
+        except Exception as error:
+            self._error = error
+
+    def get(self):
+        if self._board is None:
+            if self._thread is None:
+                self._probe()
+            else:
+                self._thread.join()
+                self._thread = None
+            if self._error is not None:
+                raise self._error
+        if self._cached_headers is not None:
+            self._check_headers()
+        return self._board
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def _memoized(self, key, query, *args):
+        if key not in self._memo:
+            self._memo[key] = query(*args)
+        return self._memo[key]
+
+    def _model(self):
+        try:
+            with open(MODEL, 'rb') as f:
+                return f.read().decode('utf-8', 'replace')
+        except (IOError, OSError):
+            return None
+
+    def _load_headers(self):
+        model = self._model()
+        if self._cache is None or model is None:
+            return None
+        try:
+            with open(self._cache) as f:
+                return json.load(f).get(model)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save_headers(self, headers):
+        model = self._model()
+        if self._cache is None or model is None:
+            return
+        try:
+            with open(self._cache) as f:
+                models = json.load(f)
+        except (IOError, OSError, ValueError):
+            models = {}
+        models[model] = headers
+        try:
+            if not os.path.isdir(os.path.dirname(self._cache)):
+                os.makedirs(os.path.dirname(self._cache))
+            with open(self._cache + '.tmp', 'w') as f:
+                json.dump(models, f)
+            os.replace(self._cache + '.tmp', self._cache)
+        except (IOError, OSError):
+            # Not root: every start probes first, as before
+            pass
+
+    def _check_headers(self):
+        # The menus were built from remembered header names; if the board
+        # disagrees (jetson-io was updated), remember the new ones and
+        # have the user start again
+        headers = self._board.get_board_headers()
+        if headers != self._cached_headers:
+            self._save_headers(headers)
+            raise RuntimeError("Board headers changed, please restart!")
+        self._cached_headers = None
+
+    def get_board_headers(self):
+        if 'headers' not in self._memo:
+            headers = None
+            if self._board is None:
+                headers = self._load_headers()
+                self._cached_headers = headers
+            if headers is None:
+                headers = self.get().get_board_headers()
+                if self._cache is not None:
+                    self._save_headers(headers)
+            self._memo['headers'] = headers
+        return self._memo['headers']
+
+    def preconf_pins_avail(self, hdr):
+        # The pinmux left by an earlier session; fixed until reboot
+        return self._memoized(('preconf', hdr),
+                              self.get().preconf_pins_avail, hdr)
 
 
 class Window(object):
@@ -40,7 +166,10 @@ class Window(object):
         panel.update_panels()
 
     def clear(self):
-        self.win.clear()
+        # erase() rather than clear(): clear() also forces a repaint of
+        # the whole terminal on the next refresh, which is most of the
+        # output over a serial console or SSH
+        self.win.erase()
 
     def show(self):
         self.panel.top()
@@ -113,6 +242,8 @@ class Menu(object):
         self.title = title
         self.maxwidth = maxwidth
         self.index = 0
+        # index -> (caption, highlighted) as last drawn
+        self.drawn = {}
 
     def up(self, items):
         while self.index > 0:
@@ -138,11 +269,16 @@ class Menu(object):
         return item.exit_on_select
 
     def update(self, items):
+        # Only lines whose caption or highlight changed are written again
         for index, item in enumerate(items):
             if item.is_empty():
                 continue
 
             caption = item.get_caption(self.maxwidth)
+            line = (caption, index == self.index)
+            if self.drawn.get(index) == line:
+                continue
+            self.drawn[index] = line
 
             if index == self.index:
                 self.win.addstr_centre(4+index, caption, curses.A_REVERSE)
@@ -150,6 +286,8 @@ class Menu(object):
                 self.win.addstr_centre(4+index, caption)
 
     def show(self, items):
+        # The window may have been cleared since the last show
+        self.drawn = {}
         self.win.show()
         self.win.addstr_centre(2, self.title)
 
@@ -170,26 +308,77 @@ class Menu(object):
         self.win.hide()
 
 
-class Header(object):
-    def __init__(self, screen, jetson, w):
-        self.rows = int(jetson.header.pin_count() / 2)
+class HeaderState(object):
+    # Labels and pingroup states of a header as last read from the board.
+    # All pin changes go through here, so the cached values are dropped
+    # only when something actually changed and not on every redraw.
+    # The owning HeaderMenu makes its header the active one before use.
+    def __init__(self, jetson):
         self.jetson = jetson
+        self.generation = 0
+        self.rows = None
+        self.enabled = {}
+        self.default = None
+
+    def invalidate(self):
+        self.generation += 1
+        self.rows = None
+        self.enabled = {}
+        self.default = None
+
+    def get_rows(self):
+        # (pin, odd label, even label) of each displayed row
+        if self.rows is None:
+            header = self.jetson.header
+            self.rows = []
+            for row in range(int(header.pin_count() / 2)):
+                pin = (row * 2) + 1
+                odd = header.pin_get_label(pin)
+                even = header.pin_get_label(pin + 1)
+
+                # Unlisted pins are not displayed so that the
+                # UI display does not grow too long
+                if (odd == 'NA') and (even == 'NA'):
+                    continue
+                self.rows.append((pin, odd, even))
+        return self.rows
+
+    def pingroup_is_enabled(self, pingroup):
+        if pingroup not in self.enabled:
+            self.enabled[pingroup] = \
+                self.jetson.header.pingroup_is_enabled(pingroup)
+        return self.enabled[pingroup]
+
+    def pins_are_default(self):
+        if self.default is None:
+            self.default = self.jetson.header.pins_are_default()
+        return self.default
+
+    def pingroup_enable(self, pingroup):
+        self.jetson.header.pingroup_enable(pingroup)
+        self.invalidate()
+
+    def pingroup_disable(self, pingroup):
+        self.jetson.header.pingroup_disable(pingroup)
+        self.invalidate()
+
+    def hw_addon_load(self, addon):
+        self.jetson.hw_addon_load(addon)
+        self.invalidate()
+
+    def pins_set_default(self):
+        self.jetson.header.pins_set_default()
+        self.invalidate()
 
-        # Get actual no. of display rows as rows where
-        # both pins are unavailable are not displayed
-        disp_rows = 0
-        for row in range(self.rows):
-            pin = (row * 2) + 1
-            odd = self.jetson.header.pin_get_label(pin)
-            even = self.jetson.header.pin_get_label(pin + 1)
-
-            # Unlisted pins are not displayed so that the
-            # UI display does not grow too long
-            if (odd == 'NA') and (even == 'NA'):
-                continue
-            disp_rows += 1
 
-        self.win = Window(screen, disp_rows + 2, w, 2, 2)
+class Header(object):
+    def __init__(self, screen, state, w):
+        self.state = state
+        # (col, text) of each row as last drawn and the state generation
+        # it was drawn from
+        self.drawn = []
+        self.generation = None
+        self.win = Window(screen, len(state.get_rows()) + 2, w, 2, 2)
 
     def show(self):
         self.update()
@@ -197,32 +386,37 @@ class Header(object):
 
     def clear(self):
         self.win.clear()
+        self.drawn = []
+        self.generation = None
 
     def update(self):
-        self.clear()
-        disp_row = 0
-
-        for row in range(self.rows):
-            pin = (row * 2) + 1
-            odd = self.jetson.header.pin_get_label(pin)
-            even = self.jetson.header.pin_get_label(pin + 1)
-
-            # Unlisted pins are not displayed so that the
-            # UI display does not grow too long
-            if (odd == 'NA') and (even == 'NA'):
-                continue
+        if self.generation == self.state.generation:
+            return
+        lines = []
 
+        for disp_row, (pin, odd, even) in enumerate(self.state.get_rows()):
             text = "%s (%3d) .. (%3d) %s" % (odd, pin, pin + 1, even)
             col = int(self.win.w / 2) - len("%s (%3d) ." % (odd, pin))
+            lines.append((col, text))
+
+            # Rows that read the same as on screen are left alone
+            if disp_row < len(self.drawn) and \
+               self.drawn[disp_row] == (col, text):
+                continue
+            self.win.win.move(2+disp_row, 0)
+            self.win.win.clrtoeol()
             self.win.win.addstr(2+disp_row, col, text)
-            disp_row += 1
+
+        self.drawn = lines
+        self.generation = self.state.generation
 
 
 class HardwareAddonsMenu(object):
-    def __init__(self, screen, header, jetson, h, w):
+    def __init__(self, screen, header, state, jetson, h, w):
         title = "Select one of the following options:"
         self.win = Window(screen, h, w, 2, 2)
         self.header = header
+        self.state = state
         self.jetson = jetson
         self.addon = None
         self.menuitems = []
@@ -241,8 +435,9 @@ class HardwareAddonsMenu(object):
         return self.addon
 
     def select(self, args):
-        self.jetson.hw_addon_load(args[0])
-        self.header.update()
+        # The header is redrawn from the new state when HeaderMenu shows
+        # it again; this menu covers it until then
+        self.state.hw_addon_load(args[0])
         self.addon = args[0]
 
     def show(self):
@@ -251,10 +446,11 @@ class HardwareAddonsMenu(object):
 
 
 class PinGroupMenu(object):
-    def __init__(self, screen, header, jetson, h, w):
+    def __init__(self, screen, header, state, jetson, h, w):
         title = "Select desired functions (for pins):"
         self.win = Window(screen, h, w, 2, 2)
         self.header = header
+        self.state = state
         self.jetson = jetson
         self.menuitems = []
         maxwidth = 0
@@ -277,17 +473,18 @@ class PinGroupMenu(object):
         self.menu = Menu(self.win, title, maxwidth)
 
     def is_selected(self, args):
-        return self.jetson.header.pingroup_is_enabled(args[0])
+        return self.state.pingroup_is_enabled(args[0])
 
     def show(self):
         self.menu.show(self.menuitems)
 
     def set_pingroup(self, args):
-        if self.jetson.header.pingroup_is_enabled(args[0]):
-            self.jetson.header.pingroup_disable(args[0])
+        # As for addons, the header row labels are read again only when
+        # the header is next shown, not on every toggle
+        if self.state.pingroup_is_enabled(args[0]):
+            self.state.pingroup_disable(args[0])
         else:
-            self.jetson.header.pingroup_enable(args[0])
-        self.header.update()
+            self.state.pingroup_enable(args[0])
 
 
 class HeaderMenu(object):
@@ -300,13 +497,15 @@ class HeaderMenu(object):
         self.hdr_state_default = True
         self.go_back = False
         self.menu = None
+        self.state = HeaderState(jetson)
 
     def _create_menu(self):
-        self.header = Header(self.screen, self.jetson, self.w)
-        self.pingroup = PinGroupMenu(self.screen, self.header,
+        self.header = Header(self.screen, self.state, self.w)
+        self.pingroup = PinGroupMenu(self.screen, self.header, self.state,
                                      self.jetson, self.h, self.w)
         self.hw_addons = HardwareAddonsMenu(self.screen, self.header,
-                                            self.jetson, self.h, self.w)
+                                            self.state, self.jetson,
+                                            self.h, self.w)
 
         self.menu_default = []
         self.menu_save_hw_addons = []
@@ -366,7 +565,7 @@ class HeaderMenu(object):
 
     def discard(self):
         self.hw_addons.deselect()
-        self.jetson.header.pins_set_default()
+        self.state.pins_set_default()
         self.hdr_state_default = True
 
     def exit(self, messages=[]):
@@ -375,7 +574,10 @@ class HeaderMenu(object):
             self.print_and_wait(messages)
         self.go_back = True
 
-    def get_saved_dtbo(self):
+    def get_saved_dtbo(self, build=True):
+        # With build=False, a DTBO that has to be generated is not built
+        # here but flagged with 'build' for the caller (see build_dtbos)
+        #
         # If this header is not touched in the current session and
         # was not modified in any previous session (i.e. no entries
         # in the pinmux DT), then no DTBO needs to be generated
@@ -384,15 +586,21 @@ class HeaderMenu(object):
             return {'dtbo' : None}
 
         self.jetson.set_active_header(self.hdr)
-        if self.menu is None:
-            self._create_menu()
 
-        hw_addon = self.hw_addons.get()
+        # An addon can only have been picked through the menus, so there
+        # is no need to build them just to ask
+        hw_addon = None
+        if self.menu is not None:
+            hw_addon = self.hw_addons.get()
         if hw_addon is not None:
             if hw_addon not in self.jetson.hw_addons.keys():
                 raise RuntimeError("Unknown hardware addon %s!" % hw_addon)
             return {'dtbo' : self.jetson.hw_addons[hw_addon],
                     'temp' : False}
+        elif not build:
+            return {'dtbo' : None,
+                    'temp' : True,
+                    'build' : True}
         else:
             return {'dtbo' : self._create_dtbo(),
                     'temp' : True}
@@ -406,11 +614,11 @@ class HeaderMenu(object):
             if self.go_back:
                 self.go_back = False
                 break
-            self.subwin.win.clear()
+            self.subwin.clear()
             self.header.show()
             if self.hw_addons.get() is not None:
                 self.menu.show(self.menu_save_hw_addons)
-            elif self.jetson.header.pins_are_default():
+            elif self.state.pins_are_default():
                 self.menu.show(self.menu_default)
             else:
                 self.menu.show(self.menu_save_pingroup)
@@ -424,11 +632,116 @@ class HeaderMenu(object):
         self.subwin.win.getch()
 
 
+# The board the DTBO workers build from. Set just before the pool forks,
+# so each worker has its own copy with the pins as configured
+_build_board = None
+# Where the workers report each DTBO as soon as it is written
+_build_done = None
+
+
+def _build_init():
+    # Ctrl-C is the parent's to handle: it stops the pool
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _build_dtbo(hdr):
+    # When another worker dies the pool terminates the rest. SIGTERM is
+    # held off until this build is written and reported, so the parent
+    # knows every DTBO there is to remove
+    import signal
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGTERM])
+    try:
+        _build_board.set_active_header(hdr)
+        path = _build_board.create_dtbo_for_header()
+        _build_done.put(path)
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGTERM])
+    return path
+
+
+def _remove(paths):
+    for path in paths:
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+
+def build_dtbos(jetson, hdrs, workers=None):
+    # Builds the DTBO of every header in hdrs and returns their paths in
+    # the order of hdrs, however the builds finish. The board has a single
+    # active header, so builds cannot share it between threads; with more
+    # than one header they run in forked processes instead, each working
+    # on its own copy of the board. If any build fails the others are
+    # still waited for, every DTBO built is removed and the first error
+    # (in header order) is raised.
+    global _build_board, _build_done
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(hdrs))
+    built = []
+    if workers < 2:
+        try:
+            for hdr in hdrs:
+                jetson.set_active_header(hdr)
+                built.append(jetson.create_dtbo_for_header())
+        except BaseException:
+            _remove(built)
+            raise
+        return built
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    context = multiprocessing.get_context('fork')
+    _build_board = jetson
+    _build_done = context.SimpleQueue()
+    # Unlike multiprocessing.Pool, the executor notices a worker that
+    # died (OOM killer, a crash in native code) and fails every build
+    # still pending with BrokenProcessPool instead of waiting forever.
+    # The results of builds that finished are lost with it, so what to
+    # remove comes from _build_done instead
+    pool = ProcessPoolExecutor(workers, mp_context=context,
+                               initializer=_build_init)
+    futures = []
+    error = None
+    complete = False
+    try:
+        futures = [pool.submit(_build_dtbo, hdr) for hdr in hdrs]
+        for future in futures:
+            try:
+                built.append(future.result())
+            except Exception as exc:
+                built.append(None)
+                if error is None:
+                    error = exc
+        complete = error is None
+    finally:
+        # Interrupted or failed: drop the builds not started and let the
+        # running ones finish before removing everything written
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=True)
+        written = []
+        while not _build_done.empty():
+            written.append(_build_done.get())
+        _build_done.close()
+        _build_board = None
+        _build_done = None
+        if not complete:
+            _remove(written)
+    if error is not None:
+        raise error
+    return built
+
+
 class MainMenu(object):
-    def __init__(self, screen, main, h, w):
-        self.jetson = board.Board()
+    def __init__(self, screen, main, h, w, jetson=None):
+        self.jetson = jetson if jetson is not None else LazyBoard()
         self.headers = self.jetson.get_board_headers()
         self.main = main
+        self.screen = screen
+        self.h = h
+        self.w = w
+        # Built when a header is first opened or saved
         self.header_menu = {}
         self.menu_default = []
         self.menu_save = []
@@ -441,10 +754,7 @@ class MainMenu(object):
         self.menu = Menu(self.subwin, title)
 
         for hdr in self.headers:
-            header_menu = HeaderMenu(screen, self.jetson, hdr, h, w)
-            self.header_menu[hdr] = header_menu
-
-            item = MenuItemAction('', True, header_menu.show)
+            item = MenuItemAction('', True, self.show_header, hdr)
             # Caption string is common to both menu_default and menu_save and
             # will be updated based on whether the pin state is default or not
             self.menu_default.append(item)
@@ -464,12 +774,26 @@ class MainMenu(object):
         self.menu_default.append(item)
         self.menu_save.append(item)
 
+    def get_header_menu(self, hdr):
+        if hdr not in self.header_menu:
+            self.header_menu[hdr] = HeaderMenu(self.screen, self.jetson,
+                                               hdr, self.h, self.w)
+        return self.header_menu[hdr]
+
+    def show_header(self, args):
+        self.get_header_menu(args[0]).show()
+
+    def is_hdr_state_default(self, hdr):
+        # A header not opened in this session is still in its default state
+        header_menu = self.header_menu.get(hdr)
+        return header_menu is None or header_menu.is_hdr_state_default()
+
     def headers_are_default(self):
         default = True
         hdr_idx = 0
         for hdr in self.headers:
             # Caption string below is common to menu_default and menu_save
-            if self.header_menu[hdr].is_hdr_state_default():
+            if self.is_hdr_state_default(hdr):
                 self.menu_save[hdr_idx].set_caption('Configure ' + hdr)
             else:
                 self.menu_save[hdr_idx].set_caption('Re-configure ' + hdr)
@@ -479,18 +803,28 @@ class MainMenu(object):
 
     def _create_dtb(self):
         dtb = ''
-        dtbos = []
-        dtbos_temp = []
+        saved = []
+        builds = []
         for hdr in self.headers:
-            dtbo = self.header_menu[hdr].get_saved_dtbo()
+            dtbo = self.get_header_menu(hdr).get_saved_dtbo(build=False)
             # If pin state is modified because of HW Addon DTBO,
             # then 'temp' would be False
             # If pin state changes are because of manual changes, then 'temp'
             # would be True and the DTBO will be deleted after creating DTB
-            if dtbo['dtbo'] is not None:
+            if dtbo.get('build'):
+                builds.append(hdr)
+            saved.append((hdr, dtbo))
+
+        # The DTBOs to generate are built concurrently and merged in
+        # header order
+        built = dict(zip(builds, build_dtbos(self.jetson, builds)))
+        dtbos = []
+        dtbos_temp = list(built.values())
+        for hdr, dtbo in saved:
+            if hdr in built:
+                dtbos.append(built[hdr])
+            elif dtbo['dtbo'] is not None:
                 dtbos.append(dtbo['dtbo'])
-                if dtbo['temp']:
-                    dtbos_temp.append(dtbo['dtbo'])
 
         try:
             dtb = self.jetson.create_dtb_for_headers(dtbos)
@@ -521,7 +855,7 @@ class MainMenu(object):
 
     def discard_all(self):
         for hdr in self.headers:
-            if not self.header_menu[hdr].is_hdr_state_default():
+            if not self.is_hdr_state_default(hdr):
                 self.jetson.set_active_header(hdr)
                 self.header_menu[hdr].discard()
 
@@ -536,7 +870,7 @@ class MainMenu(object):
 
     def show(self):
         while True:
-            self.subwin.win.clear()
+            self.subwin.clear()
             if self.headers_are_default():
                 self.menu.show(self.menu_default)
             else:
@@ -570,14 +904,15 @@ class MainWindow(object):
 
 
 class JetsonIO(object):
-    def __init__(self, stdscreen):
+    def __init__(self, stdscreen, jetson=None):
         height = 50
         width = 80
         curses.resizeterm(height, width)
         self.win = MainWindow(stdscreen, height - 2, width - 10)
 
         try:
-            self.menu = MainMenu(stdscreen, self.win, height - 4, width - 12)
+            self.menu = MainMenu(stdscreen, self.win, height - 4, width - 12,
+                                 jetson)
             self.menu.show()
         except KeyboardInterrupt:
             sys.exit(0)
@@ -590,5 +925,213 @@ class JetsonIO(object):
             sys.exit(1)
 
 
+class BuildCache(object):
+    # Generated DTBOs stored under a hash of what they were built from:
+    # the board, the header and its enabled pingroups. The same
+    # configuration is built once, however many specs or runs ask for it.
+    #
+    # DTBs are not cached: the board's create_dtb_for_headers() merges
+    # and installs in one step, so getting a DTB always means installing
+    # it (see batch_install).
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, *parts):
+        # Batch mode only; kept out of the interactive startup
+        import hashlib
+        text = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get(self, key, suffix):
+        path = os.path.join(self.path, key + suffix)
+        if os.path.exists(path):
+            self.hits += 1
+            return path
+        self.misses += 1
+        return None
+
+    def put(self, key, suffix, built, move=False):
+        # Copied (or moved, for temp files) in under a temp name and
+        # renamed, so an interrupted run never leaves a partial artifact
+        import tempfile
+        path = os.path.join(self.path, key + suffix)
+        fd, temp = tempfile.mkstemp(suffix=suffix, dir=self.path)
+        os.close(fd)
+        try:
+            if move:
+                shutil.move(built, temp)
+            else:
+                shutil.copyfile(built, temp)
+            os.replace(temp, path)
+        except Exception:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return path
+
+
+def file_key(path):
+    import hashlib
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def board_key(jetson):
+    # Identifies the board a build is for: the base DTB when the board
+    # names one, else its headers
+    dtb = getattr(jetson, 'dtb', None)
+    if dtb and os.path.isfile(dtb):
+        return file_key(dtb)
+    return ','.join(jetson.get_board_headers())
+
+
+def batch_apply(jetson, spec, cache, board_id=None):
+    # Builds (or finds in the cache) the DTBOs for one spec:
+    #   {"name": ..., "output": optional path for a copy of the DTB,
+    #    "headers": {header: {"pingroups": [...]} or {"addon": name}}}
+    # Headers not listed keep their default pins. Returns the DTBO paths
+    # in header order, none when every header is default. Nothing here
+    # changes the board's boot configuration.
+    if board_id is None:
+        board_id = board_key(jetson)
+    headers = jetson.get_board_headers()
+    wanted = spec.get('headers', {})
+    for hdr in wanted:
+        if hdr not in headers:
+            raise RuntimeError("Unknown header %s!" % hdr)
+
+    dtbos = []
+    # (index in dtbos, header, key, pingroups) of DTBOs not in the cache
+    misses = []
+    for hdr in headers:
+        conf = wanted.get(hdr)
+        if not conf:
+            continue
+        addon = conf.get('addon')
+        if addon is not None:
+            # The board lists the addons of the active header
+            jetson.set_active_header(hdr)
+            if addon not in jetson.hw_addons.keys():
+                raise RuntimeError("Unknown hardware addon %s!" % addon)
+            dtbos.append(jetson.hw_addons[addon])
+            continue
+
+        pingroups = sorted(set(conf.get('pingroups', [])))
+        if not pingroups:
+            continue
+        key = cache.key(board_id, hdr, 'pingroups', pingroups)
+        dtbo = cache.get(key, '.dtbo')
+        if dtbo is None:
+            jetson.set_active_header(hdr)
+            available = jetson.header.pingroups_available()
+            for pingroup in pingroups:
+                if pingroup not in available:
+                    raise RuntimeError("Unknown pingroup %s on %s!" %
+                                       (pingroup, hdr))
+            misses.append((len(dtbos), hdr, key, pingroups))
+        dtbos.append(dtbo)
+
+    if misses:
+        # All headers are configured first, then built together
+        try:
+            for _, hdr, _, pingroups in misses:
+                jetson.set_active_header(hdr)
+                # From the default pins: the key is the spec's pingroups
+                # only, so pins left set by an earlier session must not
+                # end up in the cached DTBO
+                jetson.header.pins_set_default()
+                for pingroup in pingroups:
+                    jetson.header.pingroup_enable(pingroup)
+            built = build_dtbos(jetson, [hdr for _, hdr, _, _ in misses])
+        finally:
+            for _, hdr, _, _ in misses:
+                jetson.set_active_header(hdr)
+                jetson.header.pins_set_default()
+        try:
+            for (index, _, key, _), temp in zip(misses, built):
+                dtbos[index] = cache.put(key, '.dtbo', temp, move=True)
+        finally:
+            # Those not moved into the cache
+            _remove(built)
+
+    return dtbos
+
+
+def batch_install(jetson, spec, dtbos):
+    # Merges the DTBOs of a spec into the DTB the board boots next, as
+    # "Save and reboot" does. Done on every run whether or not the DTBOs
+    # came from the cache: the board's DTB may have been changed since.
+    dtb = jetson.create_dtb_for_headers(dtbos)
+    output = spec.get('output')
+    if output:
+        shutil.copyfile(dtb, output)
+    return dtb
+
+
+def batch_main(path, cache_dir, install=None):
+    # A spec file holds one spec or a list of them, e.g. one per robot.
+    # Every spec's DTBOs are built into the cache; only the spec named by
+    # install, if any, is then installed on this board.
+    with open(path) as f:
+        specs = json.load(f)
+    if isinstance(specs, dict):
+        specs = [specs]
+    names = [spec.get('name', '#%d' % index)
+             for index, spec in enumerate(specs)]
+    if install is not None and install not in names:
+        print("No spec named %s in %s!" % (install, path))
+        return 1
+    jetson = LazyBoard()
+    cache = BuildCache(cache_dir)
+    board_id = board_key(jetson)
+    failed = 0
+    for name, spec in zip(names, specs):
+        try:
+            dtbos = batch_apply(jetson, spec, cache, board_id)
+            if name == install and dtbos:
+                dtbos = [batch_install(jetson, spec, dtbos)]
+        except Exception as error:
+            print("%s: FAILED: %s" % (name, error))
+            failed += 1
+            continue
+        if not dtbos:
+            print("%s: all headers default, nothing to build" % name)
+        elif name == install:
+            print("%s: installed %s" % (name, dtbos[0]))
+        else:
+            print("%s: %s" % (name, ' '.join(dtbos)))
+    print("%d specs, %d failed, cache %d hits, %d misses" %
+          (len(specs), failed, cache.hits, cache.misses))
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Jetson Expansion Header Tool')
+    parser.add_argument('--batch', metavar='SPEC',
+                        help='build the pin configurations of a JSON spec '
+                        'file without the menus')
+    parser.add_argument('--install', metavar='NAME',
+                        help='with --batch, also make the DTB of the spec '
+                        'NAME the one this board boots')
+    parser.add_argument('--cache', default=CACHE_DIR,
+                        help='directory of built DTBOs and DTBs, and of '
+                        'the header names remembered per board model')
+    args = parser.parse_args(argv)
+    if args.install and not args.batch:
+        parser.error('--install needs --batch')
+    if args.batch:
+        return batch_main(args.batch, args.cache, args.install)
+    # Probe the board while curses starts up and the menu is drawn
+    jetson = LazyBoard(os.path.join(args.cache, 'headers.json')).start()
+    curses.wrapper(JetsonIO, jetson)
+    return 0
+
+
 if __name__ == '__main__':
-    curses.wrapper(JetsonIO)
+    sys.exit(main())
@@ -0,0 +1,384 @@
+# GPIO backends with batched multi-pin reads and writes.
+#
+# 2023S-103a-gpio.py and 2022S-104c-gpio.py drive pin 12 through RPi.GPIO
+# one call at a time. Every call goes through the library's per-channel
+# checks and a sysfs or register write, and a pattern that changes
+# several pins (stepper coils, an LED bar) goes out as separate writes,
+# so for a moment the outputs show a mix of the old and new pattern.
+#
+# A backend requests a set of pins once and then reads or writes any
+# subset of them in one call:
+#
+#   GpiodBackend  Linux GPIO character device (/dev/gpiochipN) through
+#                 libgpiod's Python bindings, v1 or v2. All lines of a
+#                 write go to the kernel in one ioctl and change together.
+#   RpiBackend    RPi.GPIO or Jetson.GPIO (BOARD numbering). Their
+#                 output() takes lists, so a write is one library call,
+#                 though the library still sets the pins one by one.
+#   SimBackend    In memory, with a log of every write for checking
+#                 patterns and timing without hardware.
+#
+# Pins are always BOARD header numbers, as in the course scripts; the
+# gpiod backend maps them to line offsets with a per-board table (Jetson
+# Nano below).
+#
+# PinGroup fixes an ordered list of pins so a pattern can be written as
+# a bit mask (bit i = pins[i]) without building dicts per write.
+#
+#   python3 gpio_backend.py                  # toggle bench on the simulator
+#   python3 gpio_backend.py --backend gpiod  # ... and on the real pins
+import time
+
+from lsm303_metrics import LogHistogram
+
+# Jetson Nano 40-pin header: BOARD pin -> tegra-gpio line (gpiochip0)
+JETSON_NANO_LINES = {
+    7: 216, 11: 50, 12: 79, 13: 14, 15: 194, 16: 232, 18: 15, 19: 16,
+    21: 17, 22: 13, 23: 18, 24: 19, 26: 20, 29: 149, 31: 200, 32: 168,
+    33: 38, 35: 76, 36: 51, 37: 12, 38: 77, 40: 78,
+}
+
+OUT = 'out'
+IN = 'in'
+
+
+class GpioError(Exception):
+    pass
+
+
+class Backend(object):
+    # setup(pins, direction, initial) once, then set()/get() on any subset
+    # of the pins set up; values are 0/1 in the order of pins
+    def setup(self, pins, direction=OUT, initial=0):
+        raise NotImplementedError
+
+    def set(self, pins, values):
+        raise NotImplementedError
+
+    def get(self, pins):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SimBackend(Backend):
+    def __init__(self, log=False, clock=time.perf_counter_ns):
+        self.levels = {}
+        self.directions = {}
+        self.clock = clock
+        # (ns, pins, values) of every write when log is on
+        self.log = [] if log else None
+        self.writes = 0
+
+    def setup(self, pins, direction=OUT, initial=0):
+        for pin in pins:
+            self.directions[pin] = direction
+            self.levels[pin] = initial if direction == OUT else 0
+
+    def set(self, pins, values):
+        levels = self.levels
+        for pin, value in zip(pins, values):
+            if self.directions.get(pin) != OUT:
+                raise GpioError('pin {0} is not an output'.format(pin))
+            levels[pin] = 1 if value else 0
+        self.writes += 1
+        if self.log is not None:
+            self.log.append((self.clock(), tuple(pins), tuple(values)))
+
+    def get(self, pins):
+        levels = self.levels
+        return [levels[pin] for pin in pins]
+
+    def drive(self, pin, value):
+        # Stand-in for the outside world pulling an input
+        self.levels[pin] = 1 if value else 0
+
+
+class RpiBackend(Backend):
+    def __init__(self, module=None):
+        if module is None:
+            try:
+                import Jetson.GPIO as module
+            except ImportError:
+                import RPi.GPIO as module
+        self.GPIO = module
+        module.setwarnings(False)
+        module.setmode(module.BOARD)
+        self.pins = []
+
+    def setup(self, pins, direction=OUT, initial=0):
+        GPIO = self.GPIO
+        pins = list(pins)
+        if direction == OUT:
+            GPIO.setup(pins, GPIO.OUT, initial=GPIO.HIGH if initial
+                       else GPIO.LOW)
+        else:
+            GPIO.setup(pins, GPIO.IN)
+        self.pins.extend(pins)
+
+    def set(self, pins, values):
+        # One call for all pins; the library loops over them
+        self.GPIO.output(list(pins), [1 if v else 0 for v in values])
+
+    def get(self, pins):
+        GPIO = self.GPIO
+        return [GPIO.input(pin) for pin in pins]
+
+    def close(self):
+        if self.pins:
+            self.GPIO.cleanup(self.pins)
+            self.pins = []
+
+
+class GpiodBackend(Backend):
+    # lines: BOARD pin -> line offset on `chip`
+    def __init__(self, chip='/dev/gpiochip0', lines=JETSON_NANO_LINES,
+                 consumer='cmpe242'):
+        import gpiod
+        self.gpiod = gpiod
+        self.chip_path = chip
+        self.lines = lines
+        self.consumer = consumer
+        # v2 bindings have request_lines(); v1 has Chip.get_lines()
+        self.v2 = hasattr(gpiod, 'request_lines')
+        self.requests = []
+        # pin -> (request, offset) for the v2 API, (lines, index) for v1
+        self.owner = {}
+        # v1 sets every line of a request at once: last values written
+        self.shadow = {}
+        self.directions = {}
+        if self.v2:
+            from gpiod.line import Direction, Value
+            self.Direction = Direction
+            self.Value = Value
+        else:
+            name = chip[len('/dev/'):] if chip.startswith('/dev/') else chip
+            self.chip = gpiod.Chip(name)
+
+    def _offset(self, pin):
+        try:
+            return self.lines[pin]
+        except KeyError:
+            raise GpioError('pin {0} has no GPIO line on this board'.format(
+                pin))
+
+    def setup(self, pins, direction=OUT, initial=0):
+        # The kernel refuses a second request for a line this process
+        # already holds (EBUSY), so pins set up before keep their request
+        # and only get the initial level again, as with RPi.GPIO
+        gpiod = self.gpiod
+        pins = list(pins)
+        held = [pin for pin in pins if pin in self.owner]
+        for pin in held:
+            if self.directions[pin] != direction:
+                raise GpioError('pin {0} is already set up as {1}'.format(
+                    pin, self.directions[pin]))
+        if held and direction == OUT:
+            self.set(held, [initial] * len(held))
+        pins = [pin for pin in pins if pin not in self.owner]
+        if not pins:
+            return
+        offsets = [self._offset(pin) for pin in pins]
+        if self.v2:
+            Direction, Value = self.Direction, self.Value
+            settings = gpiod.LineSettings(
+                direction=Direction.OUTPUT if direction == OUT
+                else Direction.INPUT,
+                output_value=Value.ACTIVE if initial else Value.INACTIVE)
+            request = gpiod.request_lines(
+                self.chip_path, consumer=self.consumer,
+                config={tuple(offsets): settings})
+            for pin, offset in zip(pins, offsets):
+                self.owner[pin] = (request, offset)
+        else:
+            request = self.chip.get_lines(offsets)
+            if direction == OUT:
+                request.request(consumer=self.consumer,
+                                type=gpiod.LINE_REQ_DIR_OUT,
+                                default_vals=[initial] * len(offsets))
+            else:
+                request.request(consumer=self.consumer,
+                                type=gpiod.LINE_REQ_DIR_IN)
+            for i, pin in enumerate(pins):
+                self.owner[pin] = (request, i)
+            self.shadow[request] = [initial] * len(offsets)
+        for pin in pins:
+            self.directions[pin] = direction
+        self.requests.append((request, pins))
+
+    def _grouped(self, pins):
+        # Split pins by the request that owns them: {request: [(i, slot)]}
+        groups = {}
+        for i, pin in enumerate(pins):
+            request, slot = self.owner[pin]
+            groups.setdefault(request, []).append((i, slot))
+        return groups
+
+    def set(self, pins, values):
+        if self.v2:
+            active, inactive = self.Value.ACTIVE, self.Value.INACTIVE
+            for request, members in self._grouped(pins).items():
+                request.set_values(dict(
+                    (slot, active if values[i] else inactive)
+                    for i, slot in members))
+            return
+        for request, members in self._grouped(pins).items():
+            current = self.shadow[request]
+            for i, slot in members:
+                current[slot] = 1 if values[i] else 0
+            request.set_values(current)
+
+    def get(self, pins):
+        result = [0] * len(pins)
+        for request, members in self._grouped(pins).items():
+            if self.v2:
+                levels = request.get_values([slot for _, slot in members])
+                for (i, _), level in zip(members, levels):
+                    result[i] = 1 if level == self.Value.ACTIVE else 0
+            else:
+                levels = request.get_values()
+                for i, slot in members:
+                    result[i] = levels[slot]
+        return result
+
+    def close(self):
+        for request, _ in self.requests:
+            request.release()
+        self.requests = []
+        self.owner = {}
+        self.shadow = {}
+        self.directions = {}
+
+
+class PinGroup(object):
+    # An ordered set of output pins written as a bit mask
+    def __init__(self, backend, pins, initial=0):
+        self.backend = backend
+        self.pins = list(pins)
+        self.masks = [1 << i for i in range(len(self.pins))]
+        self.value = initial
+        backend.setup(self.pins, OUT, 0)
+        if initial:
+            self.write(initial)
+
+    def write(self, mask):
+        self.value = mask
+        self.backend.set(self.pins, [mask & m for m in self.masks])
+
+    def read(self):
+        mask = 0
+        for level, m in zip(self.backend.get(self.pins), self.masks):
+            if level:
+                mask |= m
+        return mask
+
+
+def open_backend(name, **kw):
+    if name == 'sim':
+        return SimBackend(**kw)
+    if name == 'rpi':
+        return RpiBackend(**kw)
+    if name == 'gpiod':
+        return GpiodBackend(**kw)
+    raise ValueError('unknown GPIO backend {0}'.format(name))
+
+
+# Full-step two-phase sequence of a 4-wire stepper (2022S stepper homework)
+FULL_STEP = [0b0011, 0b0110, 0b1100, 0b1001]
+
+
+def _toggle(backend, pin, n):
+    # One pin, one write per toggle, as the course scripts do
+    hist = LogHistogram()
+    pins = [pin]
+    on, off = [1], [0]
+    clock = time.perf_counter_ns
+    start = clock()
+    for i in range(n):
+        t0 = clock()
+        backend.set(pins, on if i & 1 else off)
+        hist.record(clock() - t0)
+    elapsed = (clock() - start) / 1e9
+    return n / elapsed, hist
+
+
+def _pattern(group, n, batched):
+    # Stepper patterns on 4 pins: one batched write per step, or four
+    # single-pin writes per step (the outputs briefly show a mix)
+    backend, pins = group.backend, group.pins
+    hist = LogHistogram()
+    clock = time.perf_counter_ns
+    start = clock()
+    for i in range(n):
+        mask = FULL_STEP[i & 3]
+        t0 = clock()
+        if batched:
+            group.write(mask)
+        else:
+            for bit, pin in enumerate(pins):
+                backend.set([pin], [(mask >> bit) & 1])
+        hist.record(clock() - t0)
+    elapsed = (clock() - start) / 1e9
+    return n / elapsed, hist
+
+
+def _mixed_states(log, pins):
+    # Pin states visible between writes that are not one of the patterns
+    levels = dict((pin, 0) for pin in pins)
+    wanted = set(FULL_STEP) | {0}
+    mixed = 0
+    for _, written, values in log:
+        for pin, value in zip(written, values):
+            levels[pin] = 1 if value else 0
+        mask = sum(levels[pin] << bit for bit, pin in enumerate(pins))
+        if mask not in wanted:
+            mixed += 1
+    return mixed
+
+
+def _bench(names=('sim',), n=200000, pin=12, pins=(31, 33, 35, 37)):
+    for name in names:
+        try:
+            backend = open_backend(name)
+        except (ImportError, OSError, RuntimeError) as exc:
+            print("{0}: not available here ({1})".format(name, exc))
+            continue
+        with backend:
+            backend.setup([pin], OUT, 0)
+            rate, hist = _toggle(backend, pin, n)
+            print("{0:5s} toggle pin {1}: {2:9.0f} ops/s, p99 {3:6.2f} us, "
+                  "worst {4:7.2f} us".format(name, pin, rate,
+                                             hist.percentile(99) / 1e3,
+                                             hist.max / 1e3))
+            group = PinGroup(backend, pins)
+            for batched in (False, True):
+                if isinstance(backend, SimBackend):
+                    backend.log = []
+                rate, hist = _pattern(group, n // 4, batched)
+                mixed = ''
+                if isinstance(backend, SimBackend):
+                    mixed = ", {0} mixed states seen".format(
+                        _mixed_states(backend.log, list(pins)))
+                    backend.log = None
+                print("{0:5s} 4-pin steps, {1:7s}: {2:9.0f} steps/s, p99 "
+                      "{3:6.2f} us, worst {4:7.2f} us{5}".format(
+                          name, 'batched' if batched else '4 calls', rate,
+                          hist.percentile(99) / 1e3, hist.max / 1e3, mixed))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='GPIO backend toggle bench')
+    parser.add_argument('--backend', action='append', default=[],
+                        choices=['sim', 'rpi', 'gpiod'],
+                        help='backends to bench besides the simulator')
+    parser.add_argument('-n', type=int, default=200000)
+    args = parser.parse_args()
+    _bench(['sim'] + [b for b in args.backend if b != 'sim'], args.n)
@@ -0,0 +1,588 @@
+# Fake Jetson.board for running and benching the jetson-io tool off target.
+#
+# 2022S/2022S-106b-jetson-io.py imports `board` from the Jetson package
+# that ships with JetPack (/opt/nvidia/jetson-io), which reads the pinmux
+# from the device tree and calls dtc/fdtoverlay to build overlays. None of
+# that exists on a laptop, so FakeBoard implements the part of the
+# board.Board interface the tool uses, over generated headers, pingroups
+# and hardware addons, and counts every call made on it. Building a DTBO
+# or merging a DTB sleeps for build_delay / merge_delay in place of dtc,
+# and constructing the board probe_delay per header and addon.
+#
+# load() imports the tool (the file name is not a module name) with the
+# fake installed as Jetson.board. run_ui() starts the curses UI under a
+# pseudo terminal in a child process, types keys into it and counts the
+# bytes it writes back after each key, which is what a slow serial
+# console or SSH session pays for.
+#
+#   python3 jetson_io_sim.py                       # UI and batch benches
+#   python3 jetson_io_sim.py --script old-io.py    # ... on another copy
+#   python3 jetson_io_sim.py --bench batch         # cold vs cached builds
+#   python3 jetson_io_sim.py --bench startup       # import, first frame
+#   python3 jetson_io_sim.py --bench parallel      # per-header DTBO builds
+import collections
+import fcntl
+import importlib.util
+import json
+import os
+import random
+import select
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import termios
+import time
+import types
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '2022S', '2022S-106b-jetson-io.py')
+
+# 40-pin header fixed functions (Jetson Nano numbering)
+POWER = {1: '3.3V', 2: '5V', 4: '5V', 6: 'GND', 9: 'GND', 14: 'GND',
+         17: '3.3V', 20: 'GND', 25: 'GND', 30: 'GND', 34: 'GND',
+         39: 'GND', 3: 'i2c2', 5: 'i2c2', 27: 'i2c1', 28: 'i2c1',
+         8: 'uartb', 10: 'uartb'}
+PINGROUPS = [
+    ('aud_mclk', [7]), ('pwm0', [32]), ('pwm2', [33]),
+    ('extperiph1', [29]), ('extperiph2', [31]),
+    ('i2s4', [12, 35, 38, 40]),
+    ('spi1', [19, 21, 23, 24, 26]), ('spi2', [13, 16, 18, 22, 37]),
+]
+
+
+def _addons(n):
+    # n hardware addon names, the two JetPack ones first
+    names = ['Adafruit SPH0645LM4H', 'FE-PI Audio V1 and Z V2']
+    return (names + ['Addon board %d' % i for i in range(n)])[:n]
+
+
+class FakeHeader(object):
+    def __init__(self, board, name, pins=40, pingroups=PINGROUPS):
+        self.board = board
+        self.name = name
+        self.pins = pins
+        self.pingroups = collections.OrderedDict(pingroups)
+        self.enabled = set()
+        # Pins given by an addon overlay: pin -> label
+        self.addon = {}
+
+    def _call(self, name):
+        self.board.calls[name] += 1
+
+    def pin_count(self):
+        self._call('pin_count')
+        return self.pins
+
+    def pin_get_label(self, pin):
+        self._call('pin_get_label')
+        if pin in self.addon:
+            return self.addon[pin]
+        for pingroup in self.enabled:
+            if pin in self.pingroups[pingroup]:
+                return pingroup
+        if pin in POWER:
+            return POWER[pin]
+        if any(pin in pins for pins in self.pingroups.values()):
+            return 'unused'
+        return 'NA'
+
+    def pingroups_available(self):
+        self._call('pingroups_available')
+        return list(self.pingroups)
+
+    def pingroup_get_pins(self, pingroup):
+        self._call('pingroup_get_pins')
+        return ','.join(str(pin) for pin in self.pingroups[pingroup])
+
+    def pingroup_is_enabled(self, pingroup):
+        self._call('pingroup_is_enabled')
+        return pingroup in self.enabled
+
+    def pingroup_enable(self, pingroup):
+        self._call('pingroup_enable')
+        self.enabled.add(pingroup)
+
+    def pingroup_disable(self, pingroup):
+        self._call('pingroup_disable')
+        self.enabled.discard(pingroup)
+
+    def pins_set_default(self):
+        self._call('pins_set_default')
+        self.enabled.clear()
+        self.addon.clear()
+
+    def pins_are_default(self):
+        self._call('pins_are_default')
+        return not self.enabled and not self.addon
+
+
+class FakeBoard(object):
+    # headers: names of the expansion headers; addons: hardware addon
+    # names offered for every header
+    def __init__(self, headers=('Jetson 40pin Header',),
+                 addons=('Adafruit SPH0645LM4H', 'FE-PI Audio V1 and Z V2'),
+                 workdir=None, build_delay=0.0, merge_delay=0.0,
+                 probe_delay=0.0, fail=(), crash=(), preconf=None):
+        # Board() on a Jetson parses every header and addon overlay
+        time.sleep(probe_delay * (len(headers) + len(addons)))
+        self.calls = collections.Counter()
+        self.workdir = workdir or tempfile.mkdtemp(prefix='jetson-io-')
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        self.build_delay = build_delay
+        self.merge_delay = merge_delay
+        # Headers whose DTBO build fails, as dtc would on a bad overlay
+        self.fail = set(fail)
+        # Headers whose build kills the process, as the OOM killer would
+        self.crash = set(crash)
+        # Base DTB of the board, which identifies it to the build cache
+        self.dtb = os.path.join(self.workdir, 'tegra210-p3448-0000.dtb')
+        with open(self.dtb, 'w') as f:
+            f.write('base: %s\n' % ' '.join(headers))
+        self.headers = collections.OrderedDict(
+            (name, FakeHeader(self, name)) for name in headers)
+        # Pingroups an earlier session left enabled: {header: [...]}
+        self.preconf = dict(preconf or {})
+        for hdr, pingroups in self.preconf.items():
+            self.headers[hdr].enabled.update(pingroups)
+        self.header = None
+        self.hdr = None
+        self.hw_addons = collections.OrderedDict(
+            (addon, os.path.join(self.workdir, '%s.dtbo' % addon.replace(
+                ' ', '-'))) for addon in addons)
+        for addon, path in self.hw_addons.items():
+            with open(path, 'w') as f:
+                f.write('addon: %s\n' % addon)
+
+    def get_board_headers(self):
+        self.calls['get_board_headers'] += 1
+        return list(self.headers)
+
+    def set_active_header(self, hdr):
+        self.calls['set_active_header'] += 1
+        self.hdr = hdr
+        self.header = self.headers[hdr]
+
+    def hw_addon_get(self):
+        self.calls['hw_addon_get'] += 1
+        return list(self.hw_addons)
+
+    def hw_addon_load(self, addon):
+        self.calls['hw_addon_load'] += 1
+        # An addon takes the I2S pins of the active header
+        self.header.enabled.clear()
+        self.header.addon = dict((pin, 'i2s4') for pin in (12, 35, 38, 40))
+
+    def preconf_pins_avail(self, hdr):
+        self.calls['preconf_pins_avail'] += 1
+        return bool(self.preconf.get(hdr))
+
+    def create_dtbo_for_header(self):
+        self.calls['create_dtbo_for_header'] += 1
+        time.sleep(self.build_delay)
+        if self.hdr in self.fail:
+            raise RuntimeError('dtc failed for %s' % self.hdr)
+        if self.hdr in self.crash:
+            os._exit(1)
+        fd, path = tempfile.mkstemp(suffix='.dtbo', dir=self.workdir)
+        with os.fdopen(fd, 'w') as f:
+            f.write('%s: %s\n' % (self.hdr, ' '.join(
+                sorted(self.header.enabled))))
+        return path
+
+    def create_dtb_for_headers(self, dtbos):
+        self.calls['create_dtb_for_headers'] += 1
+        time.sleep(self.merge_delay)
+        path = os.path.join(self.workdir, 'kernel_custom.dtb')
+        with open(path, 'w') as f:
+            for dtbo in dtbos:
+                with open(dtbo) as part:
+                    f.write(part.read())
+        return path
+
+
+def install(fake):
+    # Make `from Jetson import board` return a module whose Board() is
+    # `fake` (a FakeBoard, or a callable making one)
+    module = types.ModuleType('Jetson.board')
+    module.Board = fake if callable(fake) else (lambda: fake)
+    package = types.ModuleType('Jetson')
+    package.board = module
+    package.__path__ = []
+    sys.modules['Jetson'] = package
+    sys.modules['Jetson.board'] = module
+    return module
+
+
+def load(path=SCRIPT, name='jetson_io'):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered, so its functions pickle by name for worker processes
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _child(script, counts, headers, addons, probe_delay, cache):
+    # Runs in the pseudo terminal: the tool's main() on a fake board; the
+    # call counts are written out on the way out (Ctrl-C exits the tool)
+    import atexit
+    import curses
+    boards = []
+
+    def make():
+        fake = FakeBoard(['Header %d' % (i + 1) for i in range(headers)],
+                         _addons(addons), os.path.join(cache, 'board'),
+                         probe_delay=probe_delay)
+        boards.append(fake)
+        return fake
+    install(make)
+    io = load(script)
+
+    def dump():
+        calls = boards[0].calls if boards else {}
+        with open(counts, 'w') as f:
+            json.dump(dict(calls), f)
+    atexit.register(dump)
+    if not hasattr(io, 'main'):
+        # Before main(), the tool started with just this
+        curses.wrapper(io.JetsonIO)
+        return
+    model = os.path.join(cache, 'compatible')
+    if not os.path.exists(model):
+        with open(model, 'wb') as f:
+            f.write(b'nvidia,p3449-0000-b00+p3448-0000-b00\0'
+                    b'nvidia,jetson-nano\0nvidia,tegra210\0')
+    io.MODEL = model
+    sys.exit(io.main(['--cache', cache]))
+
+
+# xterm keys with the keypad in application mode (curses keypad(1))
+KEYS = {'down': b'\x1bOB', 'up': b'\x1bOA', 'enter': b'\r', 'space': b' '}
+
+
+def _drain(fd, quiet):
+    # Bytes the child writes until it has been silent for `quiet` s
+    total = 0
+    while True:
+        ready, _, _ = select.select([fd], [], [], quiet)
+        if not ready:
+            return total
+        try:
+            data = os.read(fd, 65536)
+        except OSError:
+            return total
+        if not data:
+            return total
+        total += len(data)
+
+
+def _controlling_tty():
+    # The pty becomes the child's terminal, so Ctrl-C is a SIGINT
+    os.setsid()
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+def _spawn(script, headers=1, addons=2, probe_delay=0.0, cache=None):
+    # cache: the tool's cache directory; a fresh one by default
+    owned = cache is None
+    if owned:
+        cache = tempfile.mkdtemp(prefix='jetson-io-cache-')
+    master, slave = os.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', 50, 80, 0, 0))
+    fd, counts = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    env = dict(os.environ, TERM='xterm', LINES='50', COLUMNS='80')
+    child = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--child', script,
+         '--counts', counts, '--headers', str(headers), '--addons',
+         str(addons), '--probe-delay', str(probe_delay), '--cache', cache],
+        stdin=slave, stdout=slave, stderr=slave, env=env,
+        preexec_fn=_controlling_tty)
+    os.close(slave)
+    return child, master, counts, cache if owned else None
+
+
+def _finish(child, master, counts, owned=None, quiet=0.05):
+    # Ctrl-C the tool; -> the board calls it made. owned: a cache
+    # directory to remove
+    try:
+        os.write(master, b'\x03')
+        _drain(master, quiet)
+        child.wait(5)
+    finally:
+        if child.poll() is None:
+            os.killpg(child.pid, signal.SIGKILL)
+            child.wait()
+        os.close(master)
+    with open(counts) as f:
+        text = f.read()
+    os.remove(counts)
+    if owned:
+        shutil.rmtree(owned)
+    return collections.Counter(json.loads(text or '{}'))
+
+
+def run_ui(script=SCRIPT, keys=(), headers=1, quiet=0.05):
+    # -> (bytes of the first frame, [bytes after each key], call counts)
+    child, master, counts, owned = _spawn(script, headers)
+    try:
+        first = _drain(master, 1.0)
+        per_key = []
+        for key in keys:
+            os.write(master, KEYS[key])
+            per_key.append(_drain(master, quiet))
+    finally:
+        calls = _finish(child, master, counts, owned, quiet)
+    return first, per_key, calls
+
+
+def first_frame(script=SCRIPT, headers=1, addons=2, probe_delay=0.0,
+                cache=None, marker=b'Select one of the following'):
+    # -> (seconds from launch until the main menu is on the terminal,
+    #     board calls made by then)
+    t0 = time.perf_counter()
+    child, master, counts, owned = _spawn(script, headers, addons,
+                                          probe_delay, cache)
+    seen = b''
+    try:
+        while marker not in seen:
+            ready, _, _ = select.select([master], [], [], 10.0)
+            if not ready:
+                raise RuntimeError('no main menu from %s' % script)
+            seen = seen[-len(marker):] + os.read(master, 65536)
+        elapsed = time.perf_counter() - t0
+    finally:
+        calls = _finish(child, master, counts, owned)
+    return elapsed, calls
+
+
+def _ui_bench(script=SCRIPT, toggles=40):
+    # Into header 1, "Configure header pins manually", then toggle the
+    # pingroups walking up and down the list (never onto Back)
+    navigate = ['enter', 'down', 'enter']
+    last = len(PINGROUPS) - 1
+    moves = []
+    for i in range(toggles):
+        moves.append('space')
+        moves.append('down' if (i // last) % 2 == 0 else 'up')
+    # ... and back to the header screen
+    back = ['down'] * len(PINGROUPS) + ['enter']
+    t0 = time.perf_counter()
+    _, nav_bytes, base = run_ui(script, navigate)
+    first, per_key, calls = run_ui(script, navigate + moves + back)
+    elapsed = time.perf_counter() - t0
+    keys = per_key[len(navigate):-len(back)]
+    calls.subtract(base)
+    # The way back reads the labels once; spread it over the keys
+    n = float(len(moves))
+    print("%s: %d keys in %.1f s" % (os.path.basename(script), len(moves),
+                                      elapsed))
+    print("  first frame %d bytes, navigation %s bytes" % (
+        first, '/'.join(str(n) for n in nav_bytes)))
+    print("  per key: %.0f bytes to the terminal (toggle %.0f, move %.0f)"
+          % (sum(keys) / n, sum(keys[0::2]) / (n / 2),
+             sum(keys[1::2]) / (n / 2)))
+    print("  back to the header screen: %d bytes" % per_key[-1])
+    print("  per key: %.1f pin_get_label, %.1f pingroup_is_enabled, "
+          "%.1f pins_are_default calls" % (
+              calls['pin_get_label'] / n, calls['pingroup_is_enabled'] / n,
+              calls['pins_are_default'] / n))
+
+
+def fleet(n, headers, distinct=6, seed=242):
+    # n robot specs drawn from `distinct` pin configurations
+    rng = random.Random(seed)
+    names = [name for name, _ in PINGROUPS]
+    configs = []
+    for _ in range(distinct):
+        conf = {}
+        for hdr in headers:
+            if rng.random() < 0.2:
+                conf[hdr] = {'addon': 'FE-PI Audio V1 and Z V2'}
+            else:
+                conf[hdr] = {'pingroups': rng.sample(names, rng.randint(1, 4))}
+        configs.append(conf)
+    return [{'name': 'agv-%02d' % i, 'headers': rng.choice(configs)}
+            for i in range(n)]
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _batch(io, specs, headers, cache_dir, build_delay, merge_delay,
+           preconf=None):
+    fake = FakeBoard(headers, build_delay=build_delay,
+                     merge_delay=merge_delay, preconf=preconf)
+    cache = io.BuildCache(cache_dir)
+    t0 = time.perf_counter()
+    outputs = [io.batch_apply(fake, spec, cache) for spec in specs]
+    # As --install with the first spec: merged on every run
+    io.batch_install(fake, specs[0], outputs[0])
+    elapsed = time.perf_counter() - t0
+    # Addon DTBOs live on the board, so read before it goes
+    contents = [[_read(path) for path in dtbos] for dtbos in outputs]
+    shutil.rmtree(fake.workdir)
+    return elapsed, fake.calls, cache, contents
+
+
+def _batch_bench(script=SCRIPT, robots=50, headers=2, build_delay=0.05,
+                 merge_delay=0.1):
+    # The same fleet built three ways: every spec from scratch (a fresh
+    # cache each), one cold cache for the whole run, then that cache warm
+    install(FakeBoard)
+    io = load(script)
+    names = ['Header %d' % (i + 1) for i in range(headers)]
+    specs = fleet(robots, names)
+    print("batch: %d robots, %d headers, dtbo build %.0f ms, dtb merge "
+          "%.0f ms" % (robots, headers, build_delay * 1e3,
+                       merge_delay * 1e3))
+    root = tempfile.mkdtemp(prefix='jetson-io-cache-')
+    try:
+        elapsed = 0.0
+        for i, spec in enumerate(specs):
+            elapsed += _batch(io, [spec], names,
+                              os.path.join(root, 'fresh%d' % i),
+                              build_delay, merge_delay)[0]
+        print("  uncached  %6.2f s" % elapsed)
+        cache_dir = os.path.join(root, 'shared')
+        results = []
+        for label in ('cold', 'cached'):
+            elapsed, calls, cache, contents = _batch(
+                io, specs, names, cache_dir, build_delay, merge_delay)
+            results.append(contents)
+            print("  %-8s  %6.2f s: %3d dtbo builds, %3d dtb merges, "
+                  "%3d hits, %3d misses" % (
+                      label, elapsed, calls['create_dtbo_for_header'],
+                      calls['create_dtb_for_headers'], cache.hits,
+                      cache.misses))
+        print("  cached DTBOs identical to cold: %s" % (
+            results[0] == results[1]))
+        # Pins an earlier session left on a header must not leak into
+        # DTBOs cached under the spec's pingroups
+        contents = _batch(io, specs, names, os.path.join(root, 'preconf'),
+                          0.0, 0.0, {names[0]: ['spi1', 'pwm0']})[3]
+        print("  DTBOs on a preconfigured board identical to cold: %s" % (
+            contents == results[0]))
+    finally:
+        shutil.rmtree(root)
+
+
+def _import_time(script, runs=5):
+    # Median seconds to import the tool in a fresh interpreter
+    code = ('import sys, time; sys.path.insert(0, %r); '
+            'import jetson_io_sim as sim; sim.install(sim.FakeBoard); '
+            't0 = time.perf_counter(); sim.load(%r); '
+            'print(time.perf_counter() - t0)' % (
+                os.path.dirname(os.path.abspath(__file__)), script))
+    times = sorted(float(subprocess.check_output([sys.executable, '-c', code]))
+                   for _ in range(runs))
+    return times[len(times) // 2]
+
+
+def _startup_bench(script=SCRIPT, headers=8, addons=40, probe_delay=0.005,
+                   runs=5):
+    # The first run probes and remembers the headers (cold), the rest
+    # start from the remembered names (warm)
+    print("startup: %d headers, %d addons, board probe %.0f ms" % (
+        headers, addons, probe_delay * (headers + addons) * 1e3))
+    print("  import %.1f ms" % (_import_time(script) * 1e3))
+    cache = tempfile.mkdtemp(prefix='jetson-io-cache-')
+    try:
+        cold, cold_calls = first_frame(script, headers, addons, probe_delay,
+                                       cache)
+        warm = []
+        for _ in range(runs):
+            elapsed, warm_calls = first_frame(script, headers, addons,
+                                              probe_delay, cache)
+            warm.append(elapsed)
+    finally:
+        shutil.rmtree(cache)
+    warm.sort()
+    print("  time to first frame: cold %.0f ms, warm %.0f ms (median of %d)"
+          % (cold * 1e3, warm[len(warm) // 2] * 1e3, runs))
+    for label, calls in (('cold', cold_calls), ('warm', warm_calls)):
+        print("  board calls by the %s first frame: %s" % (label, ', '.join(
+            '%s %d' % item for item in sorted(calls.items())) or 'none'))
+
+
+def _temp_dtbos(fake):
+    return [name for name in os.listdir(fake.workdir)
+            if name.startswith('tmp') and name.endswith('.dtbo')]
+
+
+def _parallel_bench(script=SCRIPT, counts=(1, 2, 4, 8), build_delay=0.2):
+    # build_dtbos() as the save path calls it, one header after another
+    # and with a worker per header. The stub sleeps, so every build can
+    # overlap; dtc is CPU bound, so on a board the speedup stops at the
+    # number of cores
+    install(FakeBoard)
+    io = load(script)
+    print("parallel dtbo builds, %.0f ms each:" % (build_delay * 1e3))
+    for n in counts:
+        names = ['Header %d' % (i + 1) for i in range(n)]
+        row = []
+        for workers in (1, n):
+            fake = FakeBoard(names, build_delay=build_delay)
+            for i, hdr in enumerate(names):
+                fake.headers[hdr].enabled.add(PINGROUPS[i % 8][0])
+            t0 = time.perf_counter()
+            built = io.build_dtbos(fake, names, workers)
+            row.append(time.perf_counter() - t0)
+            # Merge order follows the headers, not completion
+            order = [_read(path).split(':')[0] for path in built]
+            shutil.rmtree(fake.workdir)
+        print("  %d headers: serial %5.2f s, %d workers %5.2f s, merge order "
+              "%s" % (n, row[0], n, row[1],
+                      'ok' if order == names else order))
+    names = ['Header %d' % (i + 1) for i in range(8)]
+    # A crashed worker must fail the build like an error does, not hang it
+    for how in ('fail', 'crash'):
+        fake = FakeBoard(names, build_delay=build_delay,
+                         **{how: ['Header 3']})
+        try:
+            io.build_dtbos(fake, names, 8)
+            outcome = 'no error'
+        except Exception as error:
+            outcome = str(error) or type(error).__name__
+        print("  8 headers, Header 3 %s: %s, %d temp DTBOs left" % (
+            'failing' if how == 'fail' else 'crashing', outcome,
+            len(_temp_dtbos(fake))))
+        shutil.rmtree(fake.workdir)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run the jetson-io tool against a fake board')
+    parser.add_argument('--script', default=SCRIPT)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--counts', help=argparse.SUPPRESS)
+    parser.add_argument('--headers', type=int, default=1)
+    parser.add_argument('--addons', type=int, default=2)
+    parser.add_argument('--probe-delay', type=float, default=0.0)
+    parser.add_argument('--cache', help=argparse.SUPPRESS)
+    parser.add_argument('--toggles', type=int, default=40)
+    parser.add_argument('--robots', type=int, default=50)
+    parser.add_argument('--bench', action='append',
+                        choices=['ui', 'batch', 'startup', 'parallel'],
+                        help='benches to run (default: all)')
+    args = parser.parse_args()
+    if args.child:
+        _child(args.child, args.counts, args.headers, args.addons,
+               args.probe_delay, args.cache)
+    else:
+        benches = args.bench or ['ui', 'batch', 'startup', 'parallel']
+        if 'ui' in benches:
+            _ui_bench(args.script, args.toggles)
+        if 'batch' in benches:
+            _batch_bench(args.script, args.robots, max(args.headers, 2))
+        if 'startup' in benches:
+            _startup_bench(args.script)
+        if 'parallel' in benches:
+            _parallel_bench(args.script)
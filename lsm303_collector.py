@@ -0,0 +1,456 @@
+# Collector for LSM303 streams from many sensor nodes.
+#
+# One thread, one selectors loop, non-blocking sockets. Each connection
+# receives into its own preallocated buffer and frames are parsed in place
+# from it (header with struct.unpack_from, payload as memoryview slices):
+# a FLAG_COLUMNS payload is already the capture's column layout, so its
+# four slices are copied straight into the node's lsm303_store capture
+# without building a Python object per sample. Other frames (row records,
+# FLAG_DELTA compressed blocks) are decoded through lsm303_wire.Frame.
+#
+# Acks are batched: all frames that arrived for a connection in one pass of
+# the loop are answered with a single cumulative ack after they have been
+# written, so a busy node gets one small write per pass rather than one per
+# frame.
+#
+# Nodes are identified by the name in their hello frame (lsm303_wire) and
+# by peer address otherwise; a node that reconnects keeps appending to the
+# same capture. Per-node sample counts and ingest rates go out through the
+# lsm303_metrics sinks every `report` seconds.
+#
+#   python3 lsm303_collector.py --port 3001 --store /data/lsm303
+#   python3 lsm303_collector.py --bench --nodes 1,10,100,500
+import os
+import re
+import selectors
+import socket
+import time
+
+from lsm303_store import CaptureWriter
+from lsm303_wire import (ACK, ACK_MAGIC, FLAG_COLUMNS, FLAG_HELLO, Frame,
+                         HEADER, MAGIC, MAX_PAYLOAD, RECORD, VERSION,
+                         ProtocolError)
+
+RECV_BUFFER = 256 * 1024
+
+
+class Node(object):
+    def __init__(self, name, writer=None):
+        self.name = name
+        self.writer = writer
+        self.connections = 0
+        self.samples = 0
+        self.frames = 0
+        self.bytes = 0
+        self.rate = 0.0
+        self.last_samples = 0
+
+    def store(self, count, ts, heading, accel, mag):
+        if self.writer is not None:
+            self.writer.append_columns(count, ts, heading, accel, mag)
+        self.samples += count
+        self.frames += 1
+
+
+class _Connection(object):
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.node = None
+        self.buf = bytearray(RECV_BUFFER)
+        self.fill = 0
+        self.ack = None
+        self.ack_out = b''
+
+
+class Collector(object):
+    def __init__(self, port=3001, host='', store=None, clock=time.monotonic):
+        self.store = store
+        self.clock = clock
+        self.sel = selectors.DefaultSelector()
+        self.srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.srv.bind((host, port))
+        self.srv.listen(512)
+        self.srv.setblocking(False)
+        self.port = self.srv.getsockname()[1]
+        self.sel.register(self.srv, selectors.EVENT_READ)
+        self.nodes = {}
+        self.conns = set()
+        self.acks_sent = 0
+        self.last_report = clock()
+
+    def node(self, name):
+        node = self.nodes.get(name)
+        if node is None:
+            writer = None
+            if self.store is not None:
+                writer = CaptureWriter(self.capture_path(name))
+            node = self.nodes[name] = Node(name, writer)
+        node.connections += 1
+        return node
+
+    def capture_path(self, name):
+        # The node's capture directory, always directly under the store:
+        # the name comes off the network, so '/' is replaced and names of
+        # dots only ('.', '..') are prefixed
+        safe = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+        if safe.strip('.') == '':
+            safe = '_' + safe
+        store = os.path.abspath(self.store)
+        path = os.path.join(store, safe)
+        if os.path.dirname(path) != store:
+            raise ProtocolError("bad node name %r" % name)
+        return path
+
+    def poll(self, timeout=None):
+        pending = []
+        for key, mask in self.sel.select(timeout):
+            if key.data is None:
+                self._accept()
+                continue
+            conn = key.data
+            try:
+                if mask & selectors.EVENT_READ:
+                    self._read(conn)
+                if conn.ack is not None:
+                    pending.append(conn)
+                if mask & selectors.EVENT_WRITE:
+                    self._write(conn)
+            except (OSError, ProtocolError):
+                self._drop(conn)
+        # One cumulative ack per connection for everything read this pass
+        for conn in pending:
+            if conn.ack is None:
+                continue
+            conn.ack_out += ACK.pack(ACK_MAGIC, conn.ack)
+            conn.ack = None
+            self.acks_sent += 1
+            try:
+                self._write(conn)
+            except OSError:
+                self._drop(conn)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.srv.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sock, addr)
+            self.conns.add(conn)
+            self.sel.register(sock, selectors.EVENT_READ, conn)
+
+    def _read(self, conn):
+        while True:
+            if conn.fill == len(conn.buf):
+                # A frame bigger than the buffer: grow to fit it
+                if len(conn.buf) >= HEADER.size + MAX_PAYLOAD:
+                    raise ProtocolError("frame does not fit")
+                conn.buf.extend(bytes(len(conn.buf)))
+            try:
+                n = conn.sock.recv_into(memoryview(conn.buf)[conn.fill:])
+            except (BlockingIOError, InterruptedError):
+                return
+            if not n:
+                raise ConnectionError("node closed the connection")
+            conn.fill += n
+            self._parse(conn)
+            if conn.fill < len(conn.buf):
+                # Short read: the socket is drained
+                return
+
+    def _parse(self, conn):
+        buf = conn.buf
+        view = memoryview(buf)
+        offset = 0
+        end = conn.fill
+        while end - offset >= HEADER.size:
+            magic, version, flags, seq, count, length = \
+                HEADER.unpack_from(buf, offset)
+            if magic != MAGIC:
+                raise ProtocolError("bad frame magic %r" % magic)
+            if length > MAX_PAYLOAD:
+                raise ProtocolError("frame payload too large (%d)" % length)
+            start = offset + HEADER.size
+            if end - start < length:
+                break
+            offset = start + length
+            if version != VERSION:
+                continue
+            if flags & FLAG_HELLO:
+                if conn.node is None:
+                    conn.node = self.node(
+                        bytes(view[start:offset]).decode('utf-8', 'replace'))
+                continue
+            if conn.node is None:
+                conn.node = self.node(conn.addr[0])
+            node = conn.node
+            if flags & FLAG_COLUMNS:
+                if length != count * RECORD.size:
+                    raise ProtocolError("bad columnar frame length")
+                a = start + 8 * count
+                b = a + 4 * count
+                c = b + 6 * count
+                node.store(count, view[start:a], view[a:b], view[b:c],
+                           view[c:offset])
+            else:
+                columns = Frame(seq, flags, count,
+                                bytes(view[start:offset])).columns()
+                node.store(count, *columns)
+            node.bytes += HEADER.size + length
+            conn.ack = seq
+        view.release()
+        if offset:
+            # Keep the partial frame at the front of the buffer
+            buf[:end - offset] = buf[offset:end]
+            conn.fill = end - offset
+
+    def _write(self, conn):
+        if conn.ack_out:
+            n = conn.sock.send(conn.ack_out)
+            conn.ack_out = conn.ack_out[n:]
+        events = selectors.EVENT_READ
+        if conn.ack_out:
+            events |= selectors.EVENT_WRITE
+        key = self.sel.get_key(conn.sock)
+        if key.events != events:
+            self.sel.modify(conn.sock, events, conn)
+
+    def _drop(self, conn):
+        if conn not in self.conns:
+            return
+        self.conns.discard(conn)
+        self.sel.unregister(conn.sock)
+        conn.sock.close()
+        if conn.node is not None:
+            conn.node.connections -= 1
+
+    def stats(self):
+        # Per-node totals and ingest rate since the last call
+        now = self.clock()
+        dt = max(now - self.last_report, 1e-9)
+        self.last_report = now
+        nodes = {}
+        for name, node in self.nodes.items():
+            node.rate = (node.samples - node.last_samples) / dt
+            node.last_samples = node.samples
+            nodes[name] = {'samples': node.samples, 'frames': node.frames,
+                           'bytes': node.bytes, 'rate': node.rate,
+                           'connected': node.connections > 0}
+        return {'time': time.time(), 'connections': len(self.conns),
+                'nodes': nodes,
+                'rate': sum(n['rate'] for n in nodes.values()),
+                'acks': self.acks_sent}
+
+    def serve_forever(self, report=10.0, sinks=(), verbose=False):
+        next_report = self.clock() + report
+        while True:
+            self.poll(max(0.0, next_report - self.clock()))
+            if self.clock() >= next_report:
+                next_report += report
+                stats = self.stats()
+                for sink in sinks:
+                    sink.write(stats)
+                if verbose or not sinks:
+                    print("{0} nodes, {1} connected, {2:.0f} samples/s".format(
+                        len(stats['nodes']), stats['connections'],
+                        stats['rate']))
+
+    def close(self):
+        for conn in list(self.conns):
+            self._drop(conn)
+        self.sel.unregister(self.srv)
+        self.srv.close()
+        self.sel.close()
+        for node in self.nodes.values():
+            if node.writer is not None:
+                node.writer.close()
+
+
+def _run_collector(port, store, report_port):
+    from lsm303_metrics import HttpEndpoint
+    collector = Collector(port, '127.0.0.1', store)
+    try:
+        collector.serve_forever(0.5, [HttpEndpoint(report_port)])
+    finally:
+        collector.close()
+
+
+def _loadgen(port, nodes, seconds, warmup, batch, window, node_rate, results):
+    # N simulated nodes on non-blocking sockets in one process, each sending
+    # columnar frames of `batch` samples with up to `window` in flight
+    import selectors as sel_mod
+
+    from lsm303_metrics import LogHistogram
+    from lsm303_wire import AckReader, pack_hello
+
+    payload = bytes(RECORD.size * batch)
+    sel = sel_mod.DefaultSelector()
+    state = []
+    for i in range(nodes):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(pack_hello('node%04d' % i))
+        sock.setblocking(False)
+        node = {'sock': sock, 'seq': 0, 'acked': -1, 'acks': AckReader(),
+                'sent': {}, 'out': [], 'frames': 0}
+        state.append(node)
+        sel.register(sock, sel_mod.EVENT_READ, node)
+    latency = LogHistogram()
+    ack_buf = bytearray(65536)
+    acked = 0
+    start = time.monotonic()
+    measure = start + warmup
+    end = measure + seconds
+    counting = False
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        if not counting and now >= measure:
+            counting = True
+            acked = 0
+            latency.reset()
+        for node in state:
+            while node['seq'] - 1 - node['acked'] < window:
+                if node_rate and node['frames'] * batch > \
+                        (now - start) * node_rate:
+                    break
+                if not node['out']:
+                    header = HEADER.pack(MAGIC, VERSION, FLAG_COLUMNS,
+                                         node['seq'], batch, len(payload))
+                    node['out'] = [header, payload]
+                    node['sent'][node['seq']] = time.perf_counter_ns()
+                    node['seq'] += 1
+                    node['frames'] += 1
+                try:
+                    n = node['sock'].sendmsg(node['out'])
+                except (BlockingIOError, InterruptedError):
+                    break
+                total = len(node['out'][0]) + len(node['out'][1])
+                if n < total:
+                    # Keep the rest as one buffer and stop for this pass
+                    rest = b''.join(node['out'])[n:]
+                    node['out'] = [rest, b'']
+                    break
+                node['out'] = []
+        for key, _ in sel.select(0.001):
+            node = key.data
+            try:
+                n = node['sock'].recv_into(ack_buf)
+            except (BlockingIOError, InterruptedError):
+                continue
+            seq = node['acks'].feed(memoryview(ack_buf)[:n])
+            if seq is None:
+                continue
+            t = time.perf_counter_ns()
+            sent = node['sent']
+            for s in range(node['acked'] + 1, seq + 1):
+                ts = sent.pop(s, None)
+                if ts is not None and counting:
+                    latency.record(t - ts)
+                    acked += batch
+            node['acked'] = seq
+    for node in state:
+        node['sock'].close()
+    results.put({'acked': acked, 'seconds': seconds,
+                 'latency': latency.counts, 'max': latency.max})
+
+
+def _bench(node_counts, seconds=3.0, batch=32, window=16, node_rate=0.0,
+           store=True):
+    import json
+    import multiprocessing
+    import shutil
+    import tempfile
+    import urllib.request
+
+    from lsm303_metrics import LogHistogram
+
+    print("{0:>6s} {1:>12s} {2:>12s} {3:>10s} {4:>10s} {5:>10s} "
+          "{6:>22s}".format('nodes', 'samples/s', 'frames/s', 'ack p50',
+                            'ack p99', 'ack max', 'per-node min/max /s'))
+    for nodes in node_counts:
+        store_dir = tempfile.mkdtemp(prefix='lsm303-collector-') \
+            if store else None
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        report_port = probe.getsockname()[1]
+        probe.close()
+
+        collector = multiprocessing.Process(
+            target=_run_collector, args=(port, store_dir, report_port))
+        collector.start()
+        time.sleep(0.3)
+        results = multiprocessing.Queue()
+        gen = multiprocessing.Process(
+            target=_loadgen, args=(port, nodes, seconds, 1.0, batch, window,
+                                   node_rate, results))
+        gen.start()
+        result = results.get()
+        gen.join()
+        with urllib.request.urlopen(
+                'http://127.0.0.1:%d/' % report_port) as resp:
+            report = json.loads(resp.read().decode('utf-8'))
+        collector.terminate()
+        collector.join()
+        if store_dir:
+            shutil.rmtree(store_dir)
+
+        hist = LogHistogram()
+        hist.counts = result['latency']
+        hist.max = result['max']
+        rate = result['acked'] / result['seconds']
+        per_node = [n['rate'] for n in report['nodes'].values()]
+        print("{0:6d} {1:12.0f} {2:12.0f} {3:8.2f}ms {4:8.2f}ms {5:8.2f}ms "
+              "{6:>10.0f} / {7:<10.0f}".format(
+                  nodes, rate, rate / batch, hist.percentile(50) / 1e6,
+                  hist.percentile(99) / 1e6, hist.max / 1e6,
+                  min(per_node), max(per_node)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Collect LSM303 streams from many nodes')
+    parser.add_argument('--port', type=int, default=3001)
+    parser.add_argument('--host', default='')
+    parser.add_argument('--store', help='write one capture per node here')
+    parser.add_argument('--report', type=float, default=10.0,
+                        help='seconds between per-node reports')
+    parser.add_argument('--metrics-file', help='append reports as JSON lines')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve the latest report over HTTP')
+    parser.add_argument('--bench', action='store_true',
+                        help='load test with simulated nodes')
+    parser.add_argument('--nodes', default='1,10,100,500')
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--node-rate', type=float, default=0.0,
+                        help='samples/s per simulated node, 0 for flat out')
+    parser.add_argument('--no-store', action='store_true',
+                        help='bench without writing captures')
+    args = parser.parse_args()
+    if args.bench:
+        _bench([int(n) for n in args.nodes.split(',')], args.seconds,
+               node_rate=args.node_rate, store=not args.no_store)
+    else:
+        from lsm303_metrics import FileSink, HttpEndpoint
+        sinks = []
+        if args.metrics_file:
+            sinks.append(FileSink(args.metrics_file))
+        if args.metrics_port:
+            sinks.append(HttpEndpoint(args.metrics_port))
+        collector = Collector(args.port, args.host, args.store)
+        try:
+            collector.serve_forever(args.report, sinks, verbose=True)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            collector.close()
@@ -0,0 +1,409 @@
+# Delta / deadband compression of the LSM303 sample stream.
+#
+# A FLAG_DELTA frame (lsm303_wire) carries one or more encoded blocks back
+# to back. Each block stands on its own, so blocks can be queued, spilled,
+# resent or dropped independently:
+#
+#   flags u8 | count varint | body length varint | first timestamp varint
+#   [heading step f32]      if flags & QUANT_HEADING
+#   [count step varint]     if flags & QUANT_COUNTS
+#   body:
+#     [heading f32 x count] if the heading is not quantized (lossless)
+#     varints: count timestamp deltas (us, the first one from the
+#              first timestamp, so zero),
+#              [count heading deltas], then accel x, y, z and mag x, y, z
+#              deltas, one axis after the other
+#
+# Varints are LEB128, signed values zigzag encoded first, so a timestamp
+# costs one or two bytes instead of eight and an axis that barely moves
+# costs one byte instead of two. Quantization divides the heading and the
+# accel/mag counts by a step before the deltas are taken; a heading step of
+# None and a count step of 1 keep the data bit for bit.
+#
+# The deadband drops samples that moved less than `heading_band` degrees
+# and `count_band` counts on every axis since the last sample sent, except
+# that one sample is always sent every `keyframe` seconds so the receiver
+# knows the node is alive. A suppressed sample means "unchanged"; the
+# receiver gets the samples that were sent, with their own timestamps.
+#
+# Encoding and decoding are vectorized in NumPy, the varints included; only
+# the deadband, which compares each sample with the last one kept, is a
+# per-sample loop.
+#
+#   python3 lsm303_delta.py [capture]   # bytes and CPU per sample
+import array
+import os
+import struct
+
+import numpy as np
+
+QUANT_HEADING = 0x01
+QUANT_COUNTS = 0x02
+
+STEP = struct.Struct('<f')
+
+INT16_MIN = -32768
+INT16_MAX = 32767
+
+
+def zigzag(values):
+    # int64 array to uint64, small magnitudes to small numbers
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def unzigzag(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return ((values >> np.uint64(1)).view(np.int64) ^
+            -(values & np.uint64(1)).view(np.int64))
+
+
+def varint_encode(values):
+    # uint64 array to LEB128 bytes
+    v = np.asarray(values, dtype=np.uint64)
+    if not len(v):
+        return b''
+    nbytes = np.ones(len(v), dtype=np.int64)
+    for k in range(1, 10):
+        more = v >> np.uint64(7 * k)
+        if not more.any():
+            break
+        nbytes += more != 0
+    ends = np.cumsum(nbytes)
+    starts = ends - nbytes
+    out = np.empty(ends[-1], dtype=np.uint8)
+    for k in range(int(nbytes.max())):
+        if k == 0:
+            sel = slice(None)
+        else:
+            sel = nbytes > k
+        byte = (v[sel] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        byte |= (nbytes[sel] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[sel] + k] = byte
+    return out.tobytes()
+
+
+def varint_decode(data, count):
+    # The first `count` varints of data as a uint64 array, and the number of
+    # bytes they took
+    b = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(b < 0x80)[:count]
+    if len(ends) < count:
+        raise ValueError("truncated varints")
+    if not count:
+        return np.zeros(0, dtype=np.uint64), 0
+    used = int(ends[-1]) + 1
+    starts = np.empty(count, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    shift = np.arange(used) - np.repeat(starts, lengths)
+    parts = (b[:used] & 0x7f).astype(np.uint64) << \
+        (7 * shift).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts), used
+
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _deltas(values):
+    # Zigzagged differences down axis 0, the first row against zero
+    out = np.empty(values.shape, dtype=np.int64)
+    out[0] = values[0]
+    np.subtract(values[1:], values[:-1], out=out[1:])
+    return zigzag(out)
+
+
+class DeltaEncoder(object):
+    def __init__(self, heading_step=None, count_step=1, heading_band=0.0,
+                 count_band=0, keyframe=1.0):
+        self.heading_step = heading_step
+        self.count_step = count_step
+        self.heading_band = heading_band
+        self.count_band = count_band
+        self.keyframe_us = int(keyframe * 1e6)
+        # Last sample sent: (ts, heading, accel + mag), for the deadband
+        self.last = None
+        self.samples_in = 0
+        self.samples_out = 0
+        self.bytes_out = 0
+
+    @property
+    def suppressed(self):
+        return self.samples_in - self.samples_out
+
+    def _select(self, ts, heading, counts):
+        # Indices of the samples outside the deadband (or due a keyframe)
+        last = self.last
+        hb = self.heading_band
+        cb = self.count_band
+        keyframe = self.keyframe_us
+        keep = []
+        rows = zip(ts.tolist(), heading.tolist(), counts.tolist())
+        for i, row in enumerate(rows):
+            if last is not None and row[0] - last[0] < keyframe:
+                turn = abs(row[1] - last[1]) % 360.0
+                c = row[2]
+                r = last[2]
+                if (turn <= hb or turn >= 360.0 - hb) and \
+                        -cb <= c[0] - r[0] <= cb and -cb <= c[1] - r[1] <= cb \
+                        and -cb <= c[2] - r[2] <= cb and \
+                        -cb <= c[3] - r[3] <= cb and \
+                        -cb <= c[4] - r[4] <= cb and -cb <= c[5] - r[5] <= cb:
+                    continue
+            keep.append(i)
+            last = row
+        self.last = last
+        return keep
+
+    def encode(self, ts, heading, accel, mag):
+        # Columns of n samples (arrays or buffers: ts u64, heading f32,
+        # accel and mag interleaved i16) to (samples kept, block bytes)
+        ts = np.frombuffer(ts, dtype=np.uint64).view(np.int64)
+        heading = np.frombuffer(heading, dtype=np.float32)
+        counts = np.empty((len(ts), 6), dtype=np.int64)
+        counts[:, :3] = np.frombuffer(accel, dtype=np.int16).reshape(-1, 3)
+        counts[:, 3:] = np.frombuffer(mag, dtype=np.int16).reshape(-1, 3)
+        self.samples_in += len(ts)
+        if self.heading_band or self.count_band:
+            keep = self._select(ts, heading, counts)
+            if len(keep) < len(ts):
+                ts = ts[keep]
+                heading = heading[keep]
+                counts = counts[keep]
+        n = len(ts)
+        if not n:
+            return 0, b''
+
+        flags = 0
+        head = b''
+        body = []
+        first = int(ts[0])
+        values = [_deltas(ts - first)]
+        if self.heading_step:
+            flags |= QUANT_HEADING
+            head += STEP.pack(self.heading_step)
+            step = np.float32(self.heading_step)
+            values.append(_deltas(np.rint(heading / step).astype(np.int64)))
+        else:
+            body.append(heading.astype('<f4').tobytes())
+        if self.count_step > 1:
+            flags |= QUANT_COUNTS
+            head += _varint(self.count_step)
+            counts = np.rint(counts / float(self.count_step)).astype(np.int64)
+        values.append(_deltas(counts).T.ravel())
+        body.append(varint_encode(np.concatenate(values)))
+        body = b''.join(body)
+        block = b''.join([bytes((flags,)), _varint(n), _varint(len(body)),
+                          _varint(first), head, body])
+        self.samples_out += n
+        self.bytes_out += len(block)
+        return n, block
+
+    def encode_ring(self, ring, pos):
+        # Ring positions [pos, ring.head) as one block: (samples kept, bytes)
+        segments = ring.segments(pos)
+        if len(segments) == 1:
+            index, n = segments[0]
+            return self.encode(*ring.views(index, n))
+        columns = [[], [], [], []]
+        for index, n in segments:
+            for column, view in zip(columns, ring.views(index, n)):
+                column.append(view)
+        return self.encode(*[b''.join(column) for column in columns])
+
+
+def decode_block(data, offset=0):
+    # One block at data[offset:] to ((ts, heading, accel, mag) NumPy
+    # arrays, offset of the next block)
+    flags = data[offset]
+    n, offset = _read_varint(data, offset + 1)
+    length, offset = _read_varint(data, offset)
+    first, offset = _read_varint(data, offset)
+    heading_step = None
+    count_step = 1
+    if flags & QUANT_HEADING:
+        heading_step = STEP.unpack_from(data, offset)[0]
+        offset += STEP.size
+    if flags & QUANT_COUNTS:
+        count_step, offset = _read_varint(data, offset)
+    end = offset + length
+    body = memoryview(data)[offset:end]
+    if heading_step is None:
+        heading = np.frombuffer(body[:4 * n], dtype='<f4').astype(np.float32)
+        body = body[4 * n:]
+        rows = 7
+    else:
+        rows = 8
+    values, used = varint_decode(body, rows * n)
+    values = np.cumsum(unzigzag(values).reshape(-1, n), axis=1)
+    ts = values[0].view(np.uint64) + np.uint64(first)
+    if heading_step is not None:
+        heading = (values[1] * np.float32(heading_step)).astype(np.float32)
+    counts = values[-6:].T
+    if count_step > 1:
+        counts = np.clip(counts * count_step, INT16_MIN, INT16_MAX)
+    counts = counts.astype(np.int16)
+    return (ts, heading, np.ascontiguousarray(counts[:, :3]).ravel(),
+            np.ascontiguousarray(counts[:, 3:]).ravel()), end
+
+
+def decode_payload(payload, count):
+    # A FLAG_DELTA payload to (ts, heading, accel, mag) arrays, as
+    # lsm303_wire.unpack_columns() gives for FLAG_COLUMNS
+    parts = [[], [], [], []]
+    offset = 0
+    total = 0
+    while offset < len(payload):
+        columns, offset = decode_block(payload, offset)
+        total += len(columns[0])
+        for part, column in zip(parts, columns):
+            part.append(column)
+    if total != count:
+        raise ValueError("delta payload holds %d samples, header says %d" %
+                         (total, count))
+    result = []
+    for typecode, part in zip('Qfhh', parts):
+        column = array.array(typecode)
+        for values in part:
+            column.frombytes(values.tobytes())
+        result.append(column)
+    return tuple(result)
+
+
+def _load(path):
+    # A capture's columns as arrays; captures made by lsm303_source.record()
+    # have no headings yet, so those are computed as the sender would
+    from lsm303_heading import heading_batch
+    from lsm303_store import CaptureReader
+
+    reader = CaptureReader(path)
+    ts = np.array(reader['ts'], dtype=np.uint64)
+    heading = np.array(reader['heading'], dtype=np.float32)
+    accel = np.array(reader['accel'], dtype=np.int16).ravel()
+    mag = np.array(reader['mag'], dtype=np.int16).ravel()
+    reader.close()
+    if not heading.any():
+        heading = heading_batch(accel, mag).astype(np.float32)
+    return ts, heading, accel, mag
+
+
+def _simulated_captures(tmp, rate=100.0, seconds=60.0):
+    # A vehicle turning and wobbling, and one parked (only sensor noise)
+    from lsm303_source import SimulatedSource, record
+
+    paths = []
+    for name, kwargs in (('moving', {}),
+                         ('parked', {'rotation_dps': 0.0, 'tilt_deg': 0.0})):
+        path = os.path.join(tmp, name)
+        record(SimulatedSource(rate, start_us=1700000000000000, **kwargs), path,
+               int(rate * seconds))
+        paths.append(path)
+    return paths
+
+
+CONFIGS = [
+    ('lossless', {}),
+    ('quantized', {'heading_step': 0.1, 'count_step': 4}),
+    ('deadband', {'heading_step': 0.1, 'count_step': 4, 'heading_band': 0.5,
+                  'count_band': 32, 'keyframe': 1.0}),
+    ('deadband-1', {'heading_step': 0.1, 'count_step': 4, 'heading_band': 1.0,
+                    'count_band': 32, 'keyframe': 1.0}),
+]
+
+
+def _bench(paths=None, batch=32):
+    import shutil
+    import tempfile
+    import time
+
+    from lsm303_wire import HEADER, RECORD
+
+    tmp = None
+    if not paths:
+        tmp = tempfile.mkdtemp(prefix='lsm303-delta-')
+        paths = _simulated_captures(tmp)
+    try:
+        for path in paths:
+            ts, heading, accel, mag = _load(path)
+            n = len(ts)
+            span = (int(ts[-1]) - int(ts[0])) / 1e6 or 1.0
+            counts = np.concatenate([accel.reshape(-1, 3),
+                                     mag.reshape(-1, 3)], axis=1)
+            text = sum(len(str(int(h))) + 1 + len(str(t))
+                       for h, t in zip(heading.tolist(), ts.tolist()))
+            frames = (n + batch - 1) // batch
+            print("{0}: {1} samples, {2:.0f} s, frames of {3}".format(
+                os.path.basename(path.rstrip('/')), n, span, batch))
+            print("  {0:10s} {1:>8s} {2:>8s} {3:>7s} {4:>9s} {5:>9s} "
+                  "{6:>12s}".format('', 'B/sample', 'B/s', 'kept', 'encode',
+                                    'decode', 'max error'))
+            # The old text lines ("heading timestamp", one send per sample)
+            print("  {0:10s} {1:8.2f} {2:8.0f}".format(
+                'text', text / float(n), text / span))
+            raw = n * RECORD.size + frames * HEADER.size
+            print("  {0:10s} {1:8.2f} {2:8.0f} {3:6.1f}%".format(
+                'columns', raw / float(n), raw / span, 100.0))
+            for name, kwargs in CONFIGS:
+                encoder = DeltaEncoder(**kwargs)
+                blocks = []
+                start = time.process_time()
+                for i in range(0, n, batch):
+                    j = min(n, i + batch)
+                    blocks.append(encoder.encode(ts[i:j], heading[i:j],
+                                                 accel[3 * i:3 * j],
+                                                 mag[3 * i:3 * j]))
+                encode = (time.process_time() - start) / n
+                start = time.process_time()
+                decoded = [decode_payload(block, kept)
+                           for kept, block in blocks if kept]
+                decode = (time.process_time() - start) / n
+                size = sum(HEADER.size + len(block)
+                           for kept, block in blocks if kept)
+
+                # Error of what the receiver holds for every original sample
+                # (the last value sent at or before it)
+                out_ts = np.concatenate([np.frombuffer(d[0], np.uint64)
+                                         for d in decoded])
+                out_heading = np.concatenate([np.frombuffer(d[1], np.float32)
+                                              for d in decoded])
+                out_counts = np.concatenate(
+                    [np.concatenate([np.frombuffer(d[2], np.int16).reshape(-1, 3),
+                                     np.frombuffer(d[3], np.int16).reshape(-1, 3)],
+                                    axis=1) for d in decoded])
+                held = np.searchsorted(out_ts, ts, side='right') - 1
+                turn = np.abs(out_heading[held] - heading) % 360.0
+                heading_err = np.minimum(turn, 360.0 - turn).max()
+                count_err = np.abs(out_counts[held].astype(np.int64) -
+                                   counts).max()
+                print("  {0:10s} {1:8.2f} {2:8.0f} {3:6.1f}% {4:6.2f} us "
+                      "{5:6.2f} us {6:5.2f} deg {7:3d}".format(
+                          name, size / float(n), size / span,
+                          100.0 * encoder.samples_out / n, encode * 1e6,
+                          decode * 1e6, heading_err, int(count_err)))
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    import sys
+    _bench(sys.argv[1:])
@@ -0,0 +1,755 @@
+# Store-and-forward sender for the LSM303 sample stream.
+#
+# The sampling loop never talks to the socket directly. send_ring() copies
+# the new ring samples into a block (columnar payload, as in lsm303_wire)
+# and puts it on a SampleQueue; pump() moves blocks from the queue to the
+# link whenever the link is up. Nothing in either call blocks: the socket is
+# non-blocking, connects happen in the background and partial writes are
+# resumed on the next pump().
+#
+# SampleQueue keeps blocks in memory up to `memory_bytes`. Past that, blocks
+# spill to segment files in `spill_dir` (up to `disk_bytes`). When both are
+# full the drop policy decides: 'oldest' discards the head of the queue,
+# 'newest' discards the incoming block. Dropped samples are counted. Spill
+# segments left behind by a previous run are picked up at start-up. Each
+# segment has a .done file next to it listing the blocks already
+# delivered (or dropped), so those are not sent again after a restart.
+#
+# When the link drops, unacked frames go back into the queue and the sender
+# reconnects with exponential backoff (with jitter). Once it is back, the
+# backlog goes out in large frames of up to `catchup_batch` samples, each
+# gathered straight from the queued blocks into one sendmsg(). Live blocks
+# queued since the reconnect are sent ahead of the backlog, so fresh data
+# is not held behind minutes of old samples. Delivery is at least once: a
+# frame that arrived but whose ack was lost is sent again.
+#
+# With an `encoder` (lsm303_delta.DeltaEncoder) blocks are compressed when
+# they are queued, so the queue and the spill files hold them compressed
+# too, and frames go out as FLAG_DELTA. A spill directory left by a run
+# with the other setting is not readable by this one.
+#
+#   python3 lsm303_forward.py --outage 60     # catch-up benchmark
+import collections
+import errno
+import os
+import random
+import select
+import socket
+import struct
+import time
+
+from lsm303_wire import (AckReader, FLAG_COLUMNS, FLAG_DELTA, HEADER, MAGIC,
+                         MAX_PAYLOAD, NATIVE_LE, RECORD, ProtocolError,
+                         VERSION, pack_hello)
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+# count, payload length; in front of every block in a spill segment
+BLOCK_HEADER = struct.Struct('<II')
+# Offset of a delivered block, appended to the segment's .done file
+DONE = struct.Struct('<Q')
+
+# sendmsg() takes at most IOV_MAX (1024 on Linux) buffers, four per block
+MAX_GATHER = 250
+
+
+class _Block(object):
+    __slots__ = ('serial', 'count', 'payload', 'length', 'segment', 'offset')
+
+    def __init__(self, serial, count, payload, segment=None, offset=0,
+                 length=None):
+        self.serial = serial
+        self.count = count
+        # None while the block only lives on disk
+        self.payload = payload
+        self.length = len(payload) if length is None else length
+        self.segment = segment
+        self.offset = offset
+
+    def size(self):
+        return self.length
+
+
+class _Segment(object):
+    def __init__(self, path):
+        self.path = path
+        self.done_path = path[:-len('.seg')] + '.done'
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.done_fd = os.open(self.done_path,
+                               os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.refs = 0
+
+    def append(self, data):
+        offset = self.size
+        os.write(self.fd, data)
+        self.size += len(data)
+        return offset
+
+    def read(self, offset, length):
+        return os.pread(self.fd, length, offset)
+
+    def mark_done(self, offset):
+        os.write(self.done_fd, DONE.pack(offset))
+
+    def done(self):
+        # Offsets of the blocks delivered so far; a torn last entry (crash
+        # mid-write) is ignored and that block sent again
+        size = os.fstat(self.done_fd).st_size
+        data = os.pread(self.done_fd, size - size % DONE.size, 0)
+        return set(offset for offset, in DONE.iter_unpack(data))
+
+    def truncate(self):
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.done_fd, 0)
+        self.size = 0
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.done_fd)
+
+    def unlink(self):
+        os.unlink(self.path)
+        os.unlink(self.done_path)
+
+
+class SampleQueue(object):
+    def __init__(self, memory_bytes=8 << 20, spill_dir=None,
+                 disk_bytes=256 << 20, segment_bytes=4 << 20,
+                 drop=DROP_OLDEST):
+        if drop not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("unknown drop policy %r" % drop)
+        self.memory_bytes = memory_bytes
+        self.spill_dir = spill_dir
+        self.disk_bytes = disk_bytes
+        self.segment_bytes = segment_bytes
+        self.drop = drop
+        self.blocks = collections.deque()
+        self.serial = 0
+        self.samples = 0
+        self.mem_used = 0
+        self.disk_used = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.segments = []
+        self.segment = None
+        self.next_segment = 0
+        if spill_dir is not None:
+            if not os.path.isdir(spill_dir):
+                os.makedirs(spill_dir)
+            self._recover()
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def _recover(self):
+        # Queue whatever a previous run left in the spill directory
+        files = os.listdir(self.spill_dir)
+        names = sorted(n for n in files
+                       if n.startswith('spill-') and n.endswith('.seg'))
+        for name in files:
+            # Left by a crash between removing a segment and its list
+            if name.startswith('spill-') and name.endswith('.done') and \
+               name[:-len('.done')] + '.seg' not in files:
+                os.unlink(os.path.join(self.spill_dir, name))
+        for name in names:
+            segment = _Segment(os.path.join(self.spill_dir, name))
+            done = segment.done()
+            offset = 0
+            while offset + BLOCK_HEADER.size <= segment.size:
+                count, length = BLOCK_HEADER.unpack(
+                    segment.read(offset, BLOCK_HEADER.size))
+                if offset + BLOCK_HEADER.size + length > segment.size:
+                    break
+                start = offset + BLOCK_HEADER.size
+                offset = start + length
+                if start in done:
+                    continue
+                self.blocks.append(_Block(self.serial, count, None, segment,
+                                          start, length))
+                self.serial += 1
+                self.samples += count
+                segment.refs += 1
+            self.disk_used += segment.size
+            self.next_segment = int(name[6:-4]) + 1
+            if segment.refs:
+                self.segments.append(segment)
+            else:
+                self._remove(segment)
+
+    def push(self, count, payload):
+        # Queue one block; returns False if it (or older data) was dropped
+        block = _Block(self.serial, count, payload)
+        self.serial += 1
+        ok = True
+        while not self._place(block):
+            if self.drop == DROP_NEWEST or not self.blocks:
+                self.dropped += count
+                return False
+            self._drop(self.pop())
+            ok = False
+        self.blocks.append(block)
+        self.samples += count
+        return ok
+
+    def _place(self, block):
+        size = len(block.payload)
+        if self.mem_used + size <= self.memory_bytes:
+            self.mem_used += size
+            return True
+        if self.spill_dir is None:
+            return False
+        record = BLOCK_HEADER.size + size
+        if self.disk_used + record > self.disk_bytes:
+            return False
+        segment = self.segment
+        if segment is None or segment.size + record > self.segment_bytes:
+            segment = self.segment = _Segment(os.path.join(
+                self.spill_dir, 'spill-%08d.seg' % self.next_segment))
+            self.next_segment += 1
+            self.segments.append(segment)
+        block.offset = segment.append(
+            BLOCK_HEADER.pack(block.count, size) + block.payload) + \
+            BLOCK_HEADER.size
+        block.segment = segment
+        block.payload = None
+        segment.refs += 1
+        self.disk_used += record
+        self.spilled += block.count
+        return True
+
+    def _drop(self, block):
+        self.dropped += block.count
+        self.release(block)
+
+    def load(self, block):
+        # The block's payload, read back from its segment if spilled
+        if block.payload is None:
+            block.payload = block.segment.read(block.offset, block.size())
+        return block.payload
+
+    def pop(self):
+        block = self.blocks.popleft()
+        self.samples -= block.count
+        return block
+
+    def take(self, index):
+        # Remove and return the block at index (near the tail for live data)
+        block = self.blocks[index]
+        del self.blocks[index]
+        self.samples -= block.count
+        return block
+
+    def requeue(self, blocks):
+        # Put blocks taken out for sending back in serial order
+        if not blocks:
+            return
+        for block in blocks:
+            self.samples += block.count
+            if block.segment is not None:
+                block.payload = None
+        merged = sorted(list(self.blocks) + list(blocks),
+                        key=lambda b: b.serial)
+        self.blocks = collections.deque(merged)
+
+    def release(self, block):
+        # The block was delivered (or dropped): free its memory or disk
+        segment = block.segment
+        if segment is None:
+            self.mem_used -= len(block.payload)
+            return
+        block.payload = None
+        segment.mark_done(block.offset)
+        segment.refs -= 1
+        if segment.refs:
+            return
+        if segment is self.segment:
+            # Reuse the current segment from the start
+            self.disk_used -= segment.size
+            segment.truncate()
+        else:
+            self._remove(segment)
+
+    def _remove(self, segment):
+        self.disk_used -= segment.size
+        segment.close()
+        segment.unlink()
+        if segment in self.segments:
+            self.segments.remove(segment)
+
+    def close(self):
+        # Spilled blocks stay on disk for the next run; memory ones are lost
+        for segment in list(self.segments):
+            if segment.refs:
+                segment.close()
+            else:
+                self._remove(segment)
+        self.segments = []
+        self.segment = None
+
+
+def ring_block(ring, pos):
+    # Columnar payload of ring positions [pos, ring.head) as one bytes
+    # object, and its sample count
+    parts = [[], [], [], []]
+    count = 0
+    for index, n in ring.segments(pos):
+        for column, view in zip(parts, ring.views(index, n)):
+            column.append(view)
+        count += n
+    return count, b''.join(v for column in parts for v in column)
+
+
+class ForwardSender(object):
+    def __init__(self, address, queue=None, window=16, catchup_batch=4096,
+                 backoff_min=0.1, backoff_max=5.0, connect_timeout=3.0,
+                 name=None, encoder=None, clock=time.monotonic):
+        if not NATIVE_LE:
+            raise RuntimeError("columnar send needs a little-endian host")
+        self.address = address
+        self.queue = queue if queue is not None else SampleQueue()
+        self.window = window
+        self.catchup_batch = min(catchup_batch, MAX_PAYLOAD // RECORD.size)
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.backoff = backoff_min
+        self.connect_timeout = connect_timeout
+        # Node name announced in a hello frame on every connect
+        self.name = name
+        self.encoder = encoder
+        self.clock = clock
+        self.sock = None
+        self.connecting = False
+        self.connect_start = 0.0
+        self.connected_at = None
+        self.retry_at = 0.0
+        self.live_from = 0
+        self.out = []
+        self.in_flight = collections.deque()
+        self.seq = 0
+        self.acks = AckReader()
+        self.ack_buf = bytearray(4096)
+        self.rtt = None
+        self.connects = 0
+        self.disconnects = 0
+        self.frames_sent = 0
+        self.samples_sent = 0
+        self.samples_acked = 0
+        self.last_error = None
+
+    def connected(self):
+        return self.sock is not None and not self.connecting
+
+    def pending(self):
+        # Samples queued or awaiting an ack
+        return self.queue.samples + sum(
+            b.count for _, _, blocks in self.in_flight for b in blocks)
+
+    def send_ring(self, ring, pos):
+        # Queue ring positions [pos, ring.head) and push what the link takes;
+        # returns the new position
+        if self.encoder is not None:
+            count, payload = self.encoder.encode_ring(ring, pos)
+        else:
+            count, payload = ring_block(ring, pos)
+        if count:
+            self.queue.push(count, payload)
+        self.pump()
+        return ring.head
+
+    def pump(self):
+        if self.sock is None:
+            if self.clock() >= self.retry_at:
+                self._connect()
+            return
+        try:
+            if self.connecting and not self._finish_connect():
+                return
+            self._read_acks()
+            self._send()
+        except (OSError, ProtocolError) as exc:
+            self._disconnect(exc)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(self.address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self._retry(OSError(err, os.strerror(err)))
+            return
+        self.sock = sock
+        self.connecting = True
+        self.connect_start = self.clock()
+
+    def _finish_connect(self):
+        _, writable, _ = select.select([], [self.sock], [], 0)
+        if not writable:
+            if self.clock() - self.connect_start > self.connect_timeout:
+                raise socket.timeout("connect timed out")
+            return False
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise OSError(err, os.strerror(err))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connecting = False
+        self.connects += 1
+        self.connected_at = self.clock()
+        self.seq = 0
+        self.acks = AckReader()
+        if self.name:
+            self.out = [pack_hello(self.name)]
+        # Blocks queued from here on are live and jump the backlog
+        self.live_from = self.queue.serial
+        return True
+
+    def _retry(self, exc):
+        self.last_error = exc
+        self.retry_at = self.clock() + self.backoff * random.uniform(0.5, 1.0)
+        self.backoff = min(self.backoff * 2, self.backoff_max)
+
+    def _disconnect(self, exc):
+        if not self.connecting:
+            self.disconnects += 1
+        self.sock.close()
+        self.sock = None
+        self.connecting = False
+        self.out = []
+        blocks = [b for _, _, frame in self.in_flight for b in frame]
+        self.in_flight.clear()
+        self.queue.requeue(blocks)
+        self._retry(exc)
+
+    def _read_acks(self):
+        while True:
+            try:
+                n = self.sock.recv_into(self.ack_buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not n:
+                raise ConnectionError("receiver closed the connection")
+            seq = self.acks.feed(memoryview(self.ack_buf)[:n])
+            if seq is not None:
+                self._acked(seq)
+
+    def _acked(self, seq):
+        now = self.clock()
+        while self.in_flight and self.in_flight[0][0] <= seq:
+            s, sent, blocks = self.in_flight.popleft()
+            if s == seq:
+                self.rtt = now - sent
+            for block in blocks:
+                self.samples_acked += block.count
+                self.queue.release(block)
+        self.backoff = self.backoff_min
+
+    def catching_up(self):
+        # True while samples queued before the last reconnect are undelivered
+        if not self.connected():
+            return self.pending() > 0
+        queue = self.queue
+        if queue.blocks and queue.blocks[0].serial < self.live_from:
+            return True
+        return any(blocks[0].serial < self.live_from
+                   for _, _, blocks in self.in_flight)
+
+    def _next_frame(self):
+        # The oldest live block first, then the backlog in large frames
+        queue = self.queue
+        blocks = queue.blocks
+        if not blocks:
+            return None
+        if blocks[-1].serial >= self.live_from:
+            i = len(blocks) - 1
+            while i > 0 and blocks[i - 1].serial >= self.live_from:
+                i -= 1
+            return [queue.take(i)]
+        frame = [queue.pop()]
+        count = frame[0].count
+        size = frame[0].size()
+        while blocks and len(frame) < MAX_GATHER and \
+                blocks[0].serial < self.live_from and \
+                count + blocks[0].count <= self.catchup_batch and \
+                size + blocks[0].size() <= MAX_PAYLOAD:
+            block = queue.pop()
+            frame.append(block)
+            count += block.count
+            size += block.size()
+        return frame
+
+    def _frame_buffers(self, blocks):
+        # Header plus the blocks' columns, gathered in place
+        count = sum(b.count for b in blocks)
+        if self.encoder is not None:
+            # Compressed blocks are self-contained and simply follow
+            # each other
+            payloads = [self.queue.load(b) for b in blocks]
+            header = HEADER.pack(MAGIC, VERSION, FLAG_DELTA, self.seq, count,
+                                 sum(len(p) for p in payloads))
+            return [header] + payloads, count
+        header = HEADER.pack(MAGIC, VERSION, FLAG_COLUMNS, self.seq, count,
+                             count * RECORD.size)
+        columns = [[], [], [], []]
+        for block in blocks:
+            payload = memoryview(self.queue.load(block))
+            n = block.count
+            columns[0].append(payload[:8 * n])
+            columns[1].append(payload[8 * n:12 * n])
+            columns[2].append(payload[12 * n:18 * n])
+            columns[3].append(payload[18 * n:24 * n])
+        return [header] + [v for column in columns for v in column], count
+
+    def _send(self):
+        while True:
+            if self.out:
+                try:
+                    sent = self.sock.sendmsg(self.out)
+                except (BlockingIOError, InterruptedError):
+                    return
+                self._advance(sent)
+                if self.out:
+                    return
+            if len(self.in_flight) >= self.window:
+                return
+            blocks = self._next_frame()
+            if blocks is None:
+                return
+            self.out, count = self._frame_buffers(blocks)
+            self.in_flight.append((self.seq, self.clock(), blocks))
+            self.seq += 1
+            self.frames_sent += 1
+            self.samples_sent += count
+
+    def _advance(self, sent):
+        # Drop what sendmsg() wrote from the front of the pending buffers
+        out = self.out
+        while out and sent:
+            n = memoryview(out[0]).nbytes
+            if sent < n:
+                out[0] = memoryview(out[0]).cast('B')[sent:]
+                return
+            sent -= n
+            out.pop(0)
+
+    def wait(self, timeout):
+        # Sleep until the socket can make progress or timeout passes
+        if self.sock is None:
+            time.sleep(max(0.0, min(timeout, self.retry_at - self.clock())))
+            return
+        writable = [self.sock] if self.out or self.connecting else []
+        select.select([self.sock], writable, [], timeout)
+
+    def close(self, timeout=5.0):
+        # Try to deliver the backlog for up to timeout seconds; whatever is
+        # left stays in the spill directory if there is one
+        deadline = self.clock() + timeout
+        while self.pending() and self.clock() < deadline:
+            self.pump()
+            self.wait(min(0.05, max(0.0, deadline - self.clock())))
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        blocks = [b for _, _, frame in self.in_flight for b in frame]
+        self.in_flight.clear()
+        self.queue.requeue(blocks)
+        left = self.queue.samples
+        self.queue.close()
+        return left
+
+    def stats(self):
+        queue = self.queue
+        return {'connected': self.connected(),
+                'connects': self.connects,
+                'disconnects': self.disconnects,
+                'queued': queue.samples,
+                'memory_bytes': queue.mem_used,
+                'disk_bytes': queue.disk_used,
+                'spilled': queue.spilled,
+                'dropped': queue.dropped,
+                'acked': self.samples_acked,
+                'suppressed': self.encoder.suppressed
+                if self.encoder is not None else 0}
+
+
+class _Receiver(object):
+    # Stand-in receiver that can be taken down and brought back on the
+    # same port, recording which samples arrived and how late the live
+    # ones were
+    def __init__(self, port=0):
+        import threading
+        self.threading = threading
+        self.port = port
+        self.srv = None
+        self.conn = None
+        self.thread = None
+        self.received = 0
+        self.unique = set()
+        self.live_after = None
+        self.live_latency = []
+        self.start()
+
+    def start(self):
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind(('127.0.0.1', self.port))
+        srv.listen(1)
+        self.port = srv.getsockname()[1]
+        self.srv = srv
+        self.thread = self.threading.Thread(target=self._run, args=(srv,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _handle(self, frame):
+        # The bench numbers samples through the heading field
+        from lsm303_wire import unpack_columns
+        ts, ids = unpack_columns(frame.payload, frame.count)[:2]
+        self.received += frame.count
+        self.unique.update(ids)
+        if self.live_after is not None and ts[0] >= self.live_after:
+            now = int(time.time() * 1000000)
+            self.live_latency.append(now - ts[-1])
+
+    def _run(self, srv):
+        from lsm303_wire import serve_connection
+        while True:
+            try:
+                conn, _ = srv.accept()
+            except OSError:
+                return
+            self.conn = conn
+            try:
+                serve_connection(conn, self._handle)
+            except (OSError, ProtocolError):
+                pass
+            conn.close()
+
+    def stop(self):
+        # shutdown() rather than close() wakes the thread blocked in accept()
+        for sock in (self.srv, self.conn):
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.thread.join()
+        self.srv.close()
+        self.conn = None
+
+
+def _bench(outage=60.0, rate=1000.0, memory_mb=0.5, spill_dir=None,
+           drop=DROP_OLDEST, spill=True):
+    import shutil
+    import tempfile
+
+    from lsm303_ring import SampleRing
+    from lsm303_sched import RateScheduler
+    from lsm303_source import SimulatedSource
+
+    own_dir = spill and spill_dir is None
+    if own_dir:
+        spill_dir = tempfile.mkdtemp(prefix='lsm303-spill-')
+    receiver = _Receiver()
+    queue = SampleQueue(int(memory_mb * (1 << 20)), spill_dir, drop=drop)
+    sender = ForwardSender(('127.0.0.1', receiver.port), queue,
+                           backoff_min=0.05, backoff_max=0.5)
+    ring = SampleRing(4096)
+    source = SimulatedSource(rate, start_us=0)
+    batch = max(1, int(rate * 0.05))
+    pos = 0
+
+    def produce(n, ts_us):
+        # n samples with timestamps counting up from ts_us, numbered
+        # through the heading so the receiver can spot gaps and repeats
+        nonlocal pos
+        for i in range(n):
+            _, accel, mag = source.read()
+            ring.append(ts_us + int(i * 1e6 / rate), float(ring.head),
+                        accel, mag)
+            if ring.head - pos >= batch:
+                pos = sender.send_ring(ring, pos)
+
+    def tick():
+        # One batch of live samples, the newest taken now
+        produce(batch, int(time.time() * 1000000) - int((batch - 1) * 1e6 / rate))
+
+    def live(seconds):
+        sched = RateScheduler(rate / batch)
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            sched.wait()
+            tick()
+            sender.pump()
+
+    # Link up, then down for `outage` seconds of samples. Those are
+    # generated at once with past timestamps rather than waited for.
+    live(1.0)
+    receiver.stop()
+    outage_start = int(time.time() * 1000000) - int(outage * 1e6)
+    n_outage = int(outage * rate)
+    step = batch * 20
+    for k in range(0, n_outage, step):
+        produce(min(step, n_outage - k), outage_start + int(k * 1e6 / rate))
+        sender.pump()
+    backlog = sender.pending()
+    stats = sender.stats()
+
+    # Link back: keep sampling live, pumping the sender between batches the
+    # way the sampling loop would, and time the backlog from the reconnect
+    receiver.live_after = int(time.time() * 1000000)
+    receiver.start()
+    start = time.monotonic()
+    deadline = start
+    while sender.catching_up() and time.monotonic() - start < outage:
+        if time.monotonic() >= deadline:
+            tick()
+            deadline += batch / rate
+        sender.pump()
+        sender.wait(max(0.0, deadline - time.monotonic()))
+    done = time.monotonic()
+    reconnect = sender.connected_at - start
+    catchup = done - sender.connected_at
+    live(1.0)
+    left = sender.close(5.0)
+    time.sleep(0.2)
+    receiver.stop()
+
+    produced = ring.head
+    lost = produced - len(receiver.unique)
+    latency = sorted(receiver.live_latency) or [0]
+    print("outage {0:.0f} s at {1:.0f} Hz: {2} samples queued ({3} spilled "
+          "to disk, {4} dropped, {5:.1f} MB memory limit)".format(
+              outage, rate, backlog, stats['spilled'], stats['dropped'],
+              memory_mb))
+    print("reconnected after {0:.0f} ms, backlog drained in {1:.1f} ms: "
+          "{2:.0f} samples/s ({3:.0f}x the sample rate)".format(
+              reconnect * 1e3, catchup * 1e3, backlog / catchup,
+              backlog / catchup / rate))
+    print("live latency after the reconnect: p50 {0:.1f} ms, max {1:.1f} ms "
+          "({2} live frames)".format(
+              latency[len(latency) // 2] / 1000.0, latency[-1] / 1000.0,
+              len(receiver.live_latency)))
+    print("{0} produced, {1} received ({2} resent), {3} missing, {4} left "
+          "queued".format(produced, receiver.received,
+                          receiver.received - len(receiver.unique), lost,
+                          left))
+    if own_dir:
+        shutil.rmtree(spill_dir)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Store-and-forward catch-up benchmark')
+    parser.add_argument('--outage', type=float, default=60.0,
+                        help='simulated outage in seconds')
+    parser.add_argument('--rate', type=float, default=1000.0)
+    parser.add_argument('--memory-mb', type=float, default=0.5)
+    parser.add_argument('--spill-dir')
+    parser.add_argument('--no-spill', action='store_true',
+                        help='memory only, so the drop policy kicks in')
+    parser.add_argument('--drop', choices=[DROP_OLDEST, DROP_NEWEST],
+                        default=DROP_OLDEST)
+    args = parser.parse_args()
+    _bench(args.outage, args.rate, args.memory_mb, args.spill_dir, args.drop,
+           not args.no_spill)
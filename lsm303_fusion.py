@@ -0,0 +1,647 @@
+# Fused orientation (roll, pitch, heading) for the LSM303.
+#
+# The tilt-compensated heading of lsm303_heading.py is computed from each
+# sample on its own, so every bit of sensor noise and every jolt the motor
+# puts into the accelerometer goes straight into the output. The filters
+# here keep a little state between samples and smooth that out, at the
+# sampling rate and O(1) work per sample:
+#
+#   ComplementaryFilter  first-order low pass of roll, pitch and heading
+#                        (time constant `tau`); with a gyro the rates are
+#                        integrated and the accel/mag angles only correct
+#                        their drift
+#   MadgwickFilter       Madgwick's gradient-descent MARG filter
+#                        (MadgwickAHRS.c), quaternion state, gain `beta`
+#
+# The LSM303 has no gyro, so `gyro` is optional everywhere and taken as zero
+# when missing (body rates in rad/s, x/y/z as the accelerometer axes). The
+# output follows lsm303_heading: roll and pitch in degrees, heading in
+# degrees 0..360, increasing clockwise seen from above.
+#
+# update() takes one sample. update_batch() takes N of them (arrays or the
+# ring's interleaved views) and returns an (N, 3) array of roll, pitch,
+# heading; it gives the same numbers as N update() calls but does the
+# trigonometry, calibration and normalization in NumPy:
+#
+#   - the complementary filter is linear once the angles are measured, so
+#     the recursion runs as one small matrix product per 64 samples
+#   - Madgwick's update is not, so its loop stays sequential but only the
+#     quaternion arithmetic is left in it
+#
+# feed_ring() filters ring positions in place and stores the fused heading
+# in the ring's heading column, in place of ring_headings().
+#
+#   python3 lsm303_fusion.py     # updates/s, and accuracy against the
+#                                # reference Madgwick code and the simulator
+import math
+
+import numpy as np
+
+from lsm303_heading import angles_batch, angles_scalar
+
+# Low-pass time constant of the complementary filter, in seconds
+TAU = 0.1
+
+# Madgwick's gain. Without a gyro it bounds how fast the estimate can turn,
+# so it is set well above the 0.5 rad/s or so a turning vehicle does, at
+# the cost of some jitter; MadgwickAHRS.c uses 0.1 with a gyro.
+BETA = 4.0
+
+# Settings for a board with a gyro (the bench fakes its readings)
+WITH_GYRO = {'complementary': {'tau': 1.0}, 'madgwick': {'beta': 0.1}}
+
+# Samples per block of the complementary filter's batched recursion
+BLOCK = 64
+
+TWO_PI = 2.0 * math.pi
+
+
+def _wrap(angle):
+    # -pi..pi
+    return (angle + math.pi) % TWO_PI - math.pi
+
+
+def _euler_rates(roll, pitch, gx, gy, gz):
+    # Body rates to roll, pitch and yaw rates (scalars or arrays)
+    sr = np.sin(roll)
+    cr = np.cos(roll)
+    cp = np.cos(pitch)
+    tp = np.tan(pitch)
+    return (gx + (sr * gy + cr * gz) * tp,
+            cr * gy - sr * gz,
+            (sr * gy + cr * gz) / cp)
+
+
+def _output(roll, pitch, heading):
+    # Unwrapped radians to degrees: roll -180..180, heading 0..360
+    return (math.degrees(_wrap(roll)), math.degrees(pitch),
+            math.degrees(heading % TWO_PI))
+
+
+class OrientationFilter(object):
+    def __init__(self, rate_hz=100.0, cal=None):
+        self.rate = rate_hz
+        self.dt = 1.0 / rate_hz
+        self.cal = cal
+        # (roll, pitch, heading) of the last sample
+        self.last = None
+
+    def update(self, accel, mag, gyro=None):
+        raise NotImplementedError
+
+    def update_batch(self, accel, mag, gyro=None, out=None):
+        raise NotImplementedError
+
+    def feed_ring(self, ring, pos, end=None):
+        # Filter ring positions [pos, end) and store the fused headings in
+        # the ring; returns the new pos
+        if end is None:
+            end = ring.head
+        for index, count in ring.segments(pos, end):
+            ts, heading, accel, mag = ring.views(index, count)
+            angles = self.update_batch(np.frombuffer(accel, dtype=np.int16),
+                                       np.frombuffer(mag, dtype=np.int16))
+            np.frombuffer(heading, dtype=np.float32)[:] = angles[:, 2]
+        return end
+
+
+class ComplementaryFilter(OrientationFilter):
+    # Per axis, with x the angle measured from accel/mag and g the gyro
+    # rate (zero without one):
+    #
+    #   y[n] = a (y[n-1] + g dt) + (1 - a) x[n],  a = tau / (tau + dt)
+    #
+    # Roll and heading wrap around, so the measurements are unwrapped
+    # against the previous one first and the state is kept unwrapped. Body
+    # rates are turned into angle rates with the measured roll and pitch
+    # rather than the filtered ones, which keeps the recursion linear.
+    def __init__(self, rate_hz=100.0, tau=TAU, cal=None):
+        OrientationFilter.__init__(self, rate_hz, cal)
+        self.tau = tau
+        a = tau / (tau + self.dt)
+        self.alpha = a
+        # Block form of the recursion: over block samples i = 0..B-1,
+        #   y[i] = a^(i+1) y[-1] + sum_k<=i a^(i-k) v[k]
+        # with v[k] = (1 - a) x[k] + a g[k] dt
+        steps = np.arange(BLOCK)
+        lag = np.subtract.outer(steps, steps)
+        self._decay = a ** (steps + 1.0)
+        self._gain = np.where(lag >= 0, a ** np.maximum(lag, 0), 0.0).T
+        self.reset()
+
+    def reset(self):
+        self.state = None
+        self.measured = None
+
+    def update(self, accel, mag, gyro=None):
+        roll, pitch, heading = angles_scalar(accel, mag, self.cal)
+        # Heading the other way round from yaw
+        heading = -heading
+        if self.state is None:
+            self.state = [roll, pitch, heading]
+            self.measured = [roll, pitch, heading]
+        measured = self.measured
+        roll = measured[0] + _wrap(roll - measured[0])
+        heading = measured[2] + _wrap(heading - measured[2])
+        self.measured = [roll, pitch, heading]
+
+        a = self.alpha
+        b = 1.0 - a
+        state = self.state
+        if gyro is None:
+            state[0] = a * state[0] + b * roll
+            state[1] = a * state[1] + b * pitch
+            state[2] = a * state[2] + b * heading
+        else:
+            droll, dpitch, dyaw = _euler_rates(roll, pitch, *gyro)
+            dt = self.dt
+            state[0] = a * (state[0] + droll * dt) + b * roll
+            state[1] = a * (state[1] + dpitch * dt) + b * pitch
+            state[2] = a * (state[2] + dyaw * dt) + b * heading
+        self.last = _output(state[0], state[1], -state[2])
+        return self.last
+
+    def update_batch(self, accel, mag, gyro=None, out=None):
+        # Measured roll, pitch and yaw, one row each
+        x = np.array(angles_batch(accel, mag, self.cal))
+        n = x.shape[1]
+        if out is None:
+            out = np.empty((n, 3))
+        if n == 0:
+            return out
+        np.negative(x[2], out=x[2])
+        if self.state is None:
+            self.state = x[:, 0].tolist()
+            self.measured = x[:, 0].tolist()
+
+        # Unwrap roll and heading against the previous measurement
+        wrapped = x[::2]
+        prev = np.array(self.measured[::2])
+        step = np.empty_like(wrapped)
+        np.subtract(wrapped[:, 0], prev, out=step[:, 0])
+        np.subtract(wrapped[:, 1:], wrapped[:, :-1], out=step[:, 1:])
+        step += math.pi
+        step %= TWO_PI
+        step -= math.pi
+        np.cumsum(step, axis=1, out=step)
+        step += prev[:, None]
+        x[::2] = step
+        self.measured = x[:, -1].tolist()
+
+        a = self.alpha
+        if gyro is not None:
+            gyro = np.asarray(gyro, dtype=np.float64).reshape(-1, 3)
+            rates = np.array(_euler_rates(x[0], x[1], *gyro.T))
+        v = x
+        v *= 1.0 - a
+        if gyro is not None:
+            v += (a * self.dt) * rates
+
+        y = np.empty((3, n))
+        last = np.array(self.state)
+        for i in range(0, n, BLOCK):
+            m = min(BLOCK, n - i)
+            block = np.dot(v[:, i:i + m], self._gain[:m, :m])
+            block += np.outer(last, self._decay[:m])
+            y[:, i:i + m] = block
+            last = block[:, -1]
+        self.state = last.tolist()
+
+        np.degrees(y.T, out=out)
+        out[:, 0] += 180.0
+        out[:, 0] %= 360.0
+        out[:, 0] -= 180.0
+        np.negative(out[:, 2], out=out[:, 2])
+        out[:, 2] %= 360.0
+        self.last = tuple(out[-1].tolist())
+        return out
+
+
+def euler_quaternion(roll, pitch, heading):
+    # Quaternion (w, x, y, z) of Madgwick's filter for the given angles in
+    # radians; its yaw is minus our heading
+    cr = math.cos(roll / 2.0)
+    sr = math.sin(roll / 2.0)
+    cp = math.cos(pitch / 2.0)
+    sp = math.sin(pitch / 2.0)
+    cy = math.cos(-heading / 2.0)
+    sy = math.sin(-heading / 2.0)
+    return (cr * cp * cy + sr * sp * sy,
+            sr * cp * cy - cr * sp * sy,
+            cr * sp * cy + sr * cp * sy,
+            cr * cp * sy - sr * sp * cy)
+
+
+def quaternion_angles(q, out=None):
+    # (N, 4) quaternions to an (N, 3) array of roll, pitch, heading in
+    # degrees
+    q = np.asarray(q, dtype=np.float64).reshape(-1, 4)
+    q0 = q[:, 0]
+    q1 = q[:, 1]
+    q2 = q[:, 2]
+    q3 = q[:, 3]
+    if out is None:
+        out = np.empty((len(q), 3))
+    out[:, 0] = np.arctan2(2.0 * (q0 * q1 + q2 * q3),
+                           1.0 - 2.0 * (q1 * q1 + q2 * q2))
+    out[:, 1] = np.arcsin(np.clip(2.0 * (q0 * q2 - q1 * q3), -1.0, 1.0))
+    out[:, 2] = -np.arctan2(2.0 * (q0 * q3 + q1 * q2),
+                            1.0 - 2.0 * (q2 * q2 + q3 * q3))
+    np.degrees(out, out=out)
+    out[:, 2] %= 360.0
+    return out
+
+
+def _madgwick_step(q, ax, ay, az, mx, my, mz, gx, gy, gz, beta, dt):
+    # One update of MadgwickAHRSupdate() on normalized accel and mag, with
+    # the objective function f1..f6 computed once instead of once per
+    # gradient component
+    q0, q1, q2, q3 = q
+
+    # Rate of change of quaternion from the gyro
+    qdot0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+    qdot1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+    qdot2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+    qdot3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+    # A zero vector (sensor not ready) gives no direction to correct to
+    if (ax or ay or az) and (mx or my or mz):
+        q0q0 = q0 * q0
+        q0q1 = q0 * q1
+        q0q2 = q0 * q2
+        q0q3 = q0 * q3
+        q1q1 = q1 * q1
+        q1q2 = q1 * q2
+        q1q3 = q1 * q3
+        q2q2 = q2 * q2
+        q2q3 = q2 * q3
+        q3q3 = q3 * q3
+        _2q0 = 2.0 * q0
+        _2q1 = 2.0 * q1
+        _2q2 = 2.0 * q2
+        _2q3 = 2.0 * q3
+
+        # Reference direction of Earth's magnetic field: the measurement
+        # rotated into the earth frame, with its horizontal part along x
+        hx = (mx * (q0q0 + q1q1 - q2q2 - q3q3) +
+              2.0 * (my * (q1q2 - q0q3) + mz * (q0q2 + q1q3)))
+        hy = (my * (q0q0 - q1q1 + q2q2 - q3q3) +
+              2.0 * (mx * (q0q3 + q1q2) + mz * (q2q3 - q0q1)))
+        _2bx = math.sqrt(hx * hx + hy * hy)
+        _2bz = (mz * (q0q0 - q1q1 - q2q2 + q3q3) +
+                2.0 * (mx * (q1q3 - q0q2) + my * (q0q1 + q2q3)))
+        _4bx = 2.0 * _2bx
+        _4bz = 2.0 * _2bz
+
+        # Objective function: predicted minus measured gravity and field
+        f1 = 2.0 * (q1q3 - q0q2) - ax
+        f2 = 2.0 * (q0q1 + q2q3) - ay
+        f3 = 1.0 - 2.0 * (q1q1 + q2q2) - az
+        f4 = _2bx * (0.5 - q2q2 - q3q3) + _2bz * (q1q3 - q0q2) - mx
+        f5 = _2bx * (q1q2 - q0q3) + _2bz * (q0q1 + q2q3) - my
+        f6 = _2bx * (q0q2 + q1q3) + _2bz * (0.5 - q1q1 - q2q2) - mz
+
+        # Gradient descent corrective step, J^T f
+        s0 = (-_2q2 * f1 + _2q1 * f2 - _2bz * q2 * f4 +
+              (-_2bx * q3 + _2bz * q1) * f5 + _2bx * q2 * f6)
+        s1 = (_2q3 * f1 + _2q0 * f2 - 4.0 * q1 * f3 + _2bz * q3 * f4 +
+              (_2bx * q2 + _2bz * q0) * f5 + (_2bx * q3 - _4bz * q1) * f6)
+        s2 = (-_2q0 * f1 + _2q3 * f2 - 4.0 * q2 * f3 +
+              (-_4bx * q2 - _2bz * q0) * f4 + (_2bx * q1 + _2bz * q3) * f5 +
+              (_2bx * q0 - _4bz * q2) * f6)
+        s3 = (_2q1 * f1 + _2q2 * f2 + (-_4bx * q3 + _2bz * q1) * f4 +
+              (-_2bx * q0 + _2bz * q2) * f5 + _2bx * q1 * f6)
+        norm = s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3
+        if norm > 0.0:
+            norm = beta / math.sqrt(norm)
+            qdot0 -= norm * s0
+            qdot1 -= norm * s1
+            qdot2 -= norm * s2
+            qdot3 -= norm * s3
+
+    q0 += qdot0 * dt
+    q1 += qdot1 * dt
+    q2 += qdot2 * dt
+    q3 += qdot3 * dt
+    norm = 1.0 / math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+    return (q0 * norm, q1 * norm, q2 * norm, q3 * norm)
+
+
+def _unit(x, y, z):
+    norm = math.sqrt(x * x + y * y + z * z)
+    if norm == 0.0:
+        return 0.0, 0.0, 0.0
+    return x / norm, y / norm, z / norm
+
+
+def _unit_batch(v):
+    norm = np.sqrt((v * v).sum(axis=1))
+    norm[norm == 0.0] = np.inf
+    return v / norm[:, None]
+
+
+class MadgwickFilter(OrientationFilter):
+    # MadgwickAHRS.c starts from the identity quaternion and takes a few
+    # seconds to turn round to the board's orientation; here the first
+    # sample's tilt-compensated angles are the starting point instead.
+    def __init__(self, rate_hz=100.0, beta=BETA, cal=None):
+        OrientationFilter.__init__(self, rate_hz, cal)
+        self.beta = beta
+        self.reset()
+
+    def reset(self, q=None):
+        self.q = q
+
+    def _start(self, accel, mag):
+        # mag is already calibrated
+        self.q = euler_quaternion(*angles_scalar(accel, mag))
+
+    def update(self, accel, mag, gyro=None):
+        if self.cal is not None:
+            mag = self.cal.apply_scalar(mag)
+        if self.q is None:
+            self._start(accel, mag)
+        ax, ay, az = _unit(*accel)
+        mx, my, mz = _unit(*mag)
+        if gyro is None:
+            gx = gy = gz = 0.0
+        else:
+            gx, gy, gz = gyro
+        self.q = _madgwick_step(self.q, ax, ay, az, mx, my, mz, gx, gy, gz,
+                                self.beta, self.dt)
+        q0, q1, q2, q3 = self.q
+        self.last = (
+            math.degrees(math.atan2(2.0 * (q0 * q1 + q2 * q3),
+                                    1.0 - 2.0 * (q1 * q1 + q2 * q2))),
+            math.degrees(math.asin(max(-1.0, min(1.0,
+                                                 2.0 * (q0 * q2 - q1 * q3))))),
+            math.degrees(-math.atan2(2.0 * (q0 * q3 + q1 * q2),
+                                     1.0 - 2.0 * (q2 * q2 + q3 * q3))) % 360.0)
+        return self.last
+
+    def update_batch(self, accel, mag, gyro=None, out=None):
+        accel = np.asarray(accel, dtype=np.float64).reshape(-1, 3)
+        if self.cal is not None:
+            mag = self.cal.apply(mag)
+        else:
+            mag = np.asarray(mag, dtype=np.float64).reshape(-1, 3)
+        n = len(accel)
+        if out is None:
+            out = np.empty((n, 3))
+        if n == 0:
+            return out
+        if self.q is None:
+            self._start(accel[0].tolist(), mag[0].tolist())
+
+        a = _unit_batch(accel).tolist()
+        m = _unit_batch(mag).tolist()
+        if gyro is None:
+            g = [(0.0, 0.0, 0.0)] * n
+        else:
+            g = np.asarray(gyro, dtype=np.float64).reshape(-1, 3).tolist()
+        q = self.q
+        beta = self.beta
+        dt = self.dt
+        step = _madgwick_step
+        quats = [None] * n
+        for i in range(n):
+            (ax, ay, az), (mx, my, mz), (gx, gy, gz) = a[i], m[i], g[i]
+            q = step(q, ax, ay, az, mx, my, mz, gx, gy, gz, beta, dt)
+            quats[i] = q
+        self.q = q
+
+        quaternion_angles(quats, out)
+        self.last = tuple(out[-1].tolist())
+        return out
+
+
+FILTERS = {'complementary': ComplementaryFilter, 'madgwick': MadgwickFilter}
+
+
+def _madgwick_reference(q, gx, gy, gz, ax, ay, az, mx, my, mz, beta,
+                        sample_freq):
+    # MadgwickAHRSupdate() from MadgwickAHRS.c, line for line (with an
+    # exact 1/sqrt for invSqrt), as the reference for _madgwick_step
+    q0, q1, q2, q3 = q
+
+    qDot1 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+    qDot2 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+    qDot3 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+    qDot4 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+    if not ((ax == 0.0) and (ay == 0.0) and (az == 0.0)):
+        recipNorm = 1.0 / math.sqrt(ax * ax + ay * ay + az * az)
+        ax *= recipNorm
+        ay *= recipNorm
+        az *= recipNorm
+
+        recipNorm = 1.0 / math.sqrt(mx * mx + my * my + mz * mz)
+        mx *= recipNorm
+        my *= recipNorm
+        mz *= recipNorm
+
+        _2q0mx = 2.0 * q0 * mx
+        _2q0my = 2.0 * q0 * my
+        _2q0mz = 2.0 * q0 * mz
+        _2q1mx = 2.0 * q1 * mx
+        _2q0 = 2.0 * q0
+        _2q1 = 2.0 * q1
+        _2q2 = 2.0 * q2
+        _2q3 = 2.0 * q3
+        _2q0q2 = 2.0 * q0 * q2
+        _2q2q3 = 2.0 * q2 * q3
+        q0q0 = q0 * q0
+        q0q1 = q0 * q1
+        q0q2 = q0 * q2
+        q0q3 = q0 * q3
+        q1q1 = q1 * q1
+        q1q2 = q1 * q2
+        q1q3 = q1 * q3
+        q2q2 = q2 * q2
+        q2q3 = q2 * q3
+        q3q3 = q3 * q3
+
+        hx = (mx * q0q0 - _2q0my * q3 + _2q0mz * q2 + mx * q1q1 +
+              _2q1 * my * q2 + _2q1 * mz * q3 - mx * q2q2 - mx * q3q3)
+        hy = (_2q0mx * q3 + my * q0q0 - _2q0mz * q1 + _2q1mx * q2 -
+              my * q1q1 + my * q2q2 + _2q2 * mz * q3 - my * q3q3)
+        _2bx = math.sqrt(hx * hx + hy * hy)
+        _2bz = (-_2q0mx * q2 + _2q0my * q1 + mz * q0q0 + _2q1mx * q3 -
+                mz * q1q1 + _2q2 * my * q3 - mz * q2q2 + mz * q3q3)
+        _4bx = 2.0 * _2bx
+        _4bz = 2.0 * _2bz
+
+        s0 = (-_2q2 * (2.0 * q1q3 - _2q0q2 - ax) +
+              _2q1 * (2.0 * q0q1 + _2q2q3 - ay) -
+              _2bz * q2 * (_2bx * (0.5 - q2q2 - q3q3) +
+                           _2bz * (q1q3 - q0q2) - mx) +
+              (-_2bx * q3 + _2bz * q1) * (_2bx * (q1q2 - q0q3) +
+                                          _2bz * (q0q1 + q2q3) - my) +
+              _2bx * q2 * (_2bx * (q0q2 + q1q3) +
+                           _2bz * (0.5 - q1q1 - q2q2) - mz))
+        s1 = (_2q3 * (2.0 * q1q3 - _2q0q2 - ax) +
+              _2q0 * (2.0 * q0q1 + _2q2q3 - ay) -
+              4.0 * q1 * (1 - 2.0 * q1q1 - 2.0 * q2q2 - az) +
+              _2bz * q3 * (_2bx * (0.5 - q2q2 - q3q3) +
+                           _2bz * (q1q3 - q0q2) - mx) +
+              (_2bx * q2 + _2bz * q0) * (_2bx * (q1q2 - q0q3) +
+                                         _2bz * (q0q1 + q2q3) - my) +
+              (_2bx * q3 - _4bz * q1) * (_2bx * (q0q2 + q1q3) +
+                                         _2bz * (0.5 - q1q1 - q2q2) - mz))
+        s2 = (-_2q0 * (2.0 * q1q3 - _2q0q2 - ax) +
+              _2q3 * (2.0 * q0q1 + _2q2q3 - ay) -
+              4.0 * q2 * (1 - 2.0 * q1q1 - 2.0 * q2q2 - az) +
+              (-_4bx * q2 - _2bz * q0) * (_2bx * (0.5 - q2q2 - q3q3) +
+                                          _2bz * (q1q3 - q0q2) - mx) +
+              (_2bx * q1 + _2bz * q3) * (_2bx * (q1q2 - q0q3) +
+                                         _2bz * (q0q1 + q2q3) - my) +
+              (_2bx * q0 - _4bz * q2) * (_2bx * (q0q2 + q1q3) +
+                                         _2bz * (0.5 - q1q1 - q2q2) - mz))
+        s3 = (_2q1 * (2.0 * q1q3 - _2q0q2 - ax) +
+              _2q2 * (2.0 * q0q1 + _2q2q3 - ay) +
+              (-_4bx * q3 + _2bz * q1) * (_2bx * (0.5 - q2q2 - q3q3) +
+                                          _2bz * (q1q3 - q0q2) - mx) +
+              (-_2bx * q0 + _2bz * q2) * (_2bx * (q1q2 - q0q3) +
+                                          _2bz * (q0q1 + q2q3) - my) +
+              _2bx * q1 * (_2bx * (q0q2 + q1q3) +
+                           _2bz * (0.5 - q1q1 - q2q2) - mz))
+        recipNorm = 1.0 / math.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+        s0 *= recipNorm
+        s1 *= recipNorm
+        s2 *= recipNorm
+        s3 *= recipNorm
+
+        qDot1 -= beta * s0
+        qDot2 -= beta * s1
+        qDot3 -= beta * s2
+        qDot4 -= beta * s3
+
+    q0 += qDot1 * (1.0 / sample_freq)
+    q1 += qDot2 * (1.0 / sample_freq)
+    q2 += qDot3 * (1.0 / sample_freq)
+    q3 += qDot4 * (1.0 / sample_freq)
+
+    recipNorm = 1.0 / math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+    return (q0 * recipNorm, q1 * recipNorm, q2 * recipNorm, q3 * recipNorm)
+
+
+def _simulate(rate, seconds, vibration=60.0, seed=242):
+    # Samples of the simulated board turning at 30 deg/s with a 10 deg
+    # wobble, plus random motor vibration on the accelerometer; returns
+    # accel, mag, the true angles and the gyro readings a board with one
+    # would have given (rates of the true angles)
+    from lsm303_source import SimulatedSource
+
+    n = int(rate * seconds)
+    src = SimulatedSource(rate, start_us=0, seed=seed)
+    accel = np.empty((n, 3))
+    mag = np.empty((n, 3))
+    for i in range(n):
+        ts, accel[i], mag[i] = src.read()
+    t = np.arange(n) / rate
+    truth = np.stack([src.tilt * np.sin(src.wobble * t),
+                      src.tilt * np.cos(src.wobble * t),
+                      src.rotation * t], axis=1)
+    # Body rates from the true orientation, w = 2 conj(q) dq/dt
+    q = np.array([euler_quaternion(*angles) for angles in truth])
+    dq = np.gradient(q, 1.0 / rate, axis=0)
+    q0, q1, q2, q3 = q.T
+    d0, d1, d2, d3 = dq.T
+    gyro = 2.0 * np.stack([q0 * d1 - q1 * d0 - q2 * d3 + q3 * d2,
+                           q0 * d2 + q1 * d3 - q2 * d0 - q3 * d1,
+                           q0 * d3 - q1 * d2 + q2 * d1 - q3 * d0], axis=1)
+    rng = np.random.RandomState(seed)
+    accel += rng.normal(0.0, vibration, accel.shape)
+    return (np.round(accel).astype(np.int16), np.round(mag).astype(np.int16),
+            np.degrees(truth), gyro)
+
+
+def _errors(angles, truth):
+    # RMS error of roll, pitch, heading in degrees (heading modulo 360)
+    err = angles - truth
+    err[:, 2] = (err[:, 2] + 180.0) % 360.0 - 180.0
+    return np.sqrt((err * err).mean(axis=0))
+
+
+def _bench(rate=100.0, seconds=60.0, block=32, settle=2.0):
+    import time
+
+    accel, mag, truth, gyro = _simulate(rate, seconds)
+    n = len(accel)
+    accel_list = [tuple(v) for v in accel.tolist()]
+    mag_list = [tuple(v) for v in mag.tolist()]
+    skip = int(settle * rate)
+
+    def scalar(filt, use_gyro=False):
+        gyro_list = gyro.tolist() if use_gyro else [None] * n
+        out = np.empty((n, 3))
+        update = filt.update
+        start = time.process_time()
+        for i in range(n):
+            out[i] = update(accel_list[i], mag_list[i], gyro_list[i])
+        return out, (time.process_time() - start) / n
+
+    def batched(filt, use_gyro=False):
+        out = np.empty((n, 3))
+        start = time.process_time()
+        for i in range(0, n, block):
+            filt.update_batch(accel[i:i + block], mag[i:i + block],
+                              gyro[i:i + block] if use_gyro else None,
+                              out=out[i:i + block])
+        return out, (time.process_time() - start) / n
+
+    print("{0} samples at {1:.0f} Hz, batches of {2}".format(n, rate, block))
+    print("{0:14s} {1:>12s} {2:>12s} {3:>14s}".format(
+        '', 'scalar', 'batched', 'batch - scalar'))
+    start = time.process_time()
+    raw = np.stack(angles_batch(accel, mag), axis=1)
+    raw_cpu = (time.process_time() - start) / n
+    raw = np.degrees(raw)
+    raw[:, 2] %= 360.0
+    print("{0:14s} {1:>12s} {2:9.0f}/s".format('tilt-comp', '', 1 / raw_cpu))
+    results = {}
+    for name, cls in sorted(FILTERS.items()):
+        ref, t_scalar = scalar(cls(rate))
+        out, t_batch = batched(cls(rate))
+        diff = np.abs(out - ref)
+        diff[:, 2] = np.abs((out[:, 2] - ref[:, 2] + 180.0) % 360.0 - 180.0)
+        print("{0:14s} {1:9.0f}/s {2:9.0f}/s {3:11.1e} deg".format(
+            name, 1 / t_scalar, 1 / t_batch, diff.max()))
+        results[name] = out
+        # With a gyro the accel/mag correction can be much slower
+        results[name + ' + gyro'] = batched(cls(rate, **WITH_GYRO[name]),
+                                            True)[0]
+
+    # The Madgwick step against the original code, same start and inputs
+    filt = MadgwickFilter(rate)
+    filt.update(accel_list[0], mag_list[0])
+    q = q_ref = filt.q
+    worst = 0.0
+    for i in range(1, n):
+        ax, ay, az = _unit(*accel_list[i])
+        mx, my, mz = _unit(*mag_list[i])
+        q = _madgwick_step(q, ax, ay, az, mx, my, mz, 0.0, 0.0, 0.0,
+                           filt.beta, filt.dt)
+        q_ref = _madgwick_reference(q_ref, 0.0, 0.0, 0.0, accel_list[i][0],
+                                    accel_list[i][1], accel_list[i][2],
+                                    mag_list[i][0], mag_list[i][1],
+                                    mag_list[i][2], filt.beta, rate)
+        worst = max(worst, max(abs(x - y) for x, y in zip(q, q_ref)))
+    print("madgwick vs MadgwickAHRS.c: max |dq| = {0:.1e}".format(worst))
+
+    # Accuracy against the simulator's true orientation; jitter is the RMS
+    # of the sample-to-sample change after removing the true change
+    print("\nvs truth, after {0:.0f} s    RMS error (roll pitch heading)    "
+          "heading jitter".format(settle))
+    step_truth = np.diff(truth[skip:, 2])
+    for name in ['tilt-comp', 'complementary', 'complementary + gyro',
+                 'madgwick', 'madgwick + gyro']:
+        angles = raw if name == 'tilt-comp' else results[name]
+        rms = _errors(angles[skip:], truth[skip:])
+        jitter = (np.diff(angles[skip:, 2]) - step_truth + 180.0) % 360.0 - 180.0
+        print("{0:22s} {1:6.2f} {2:6.2f} {3:6.2f} deg {4:14.3f} deg".format(
+            name, rms[0], rms[1], rms[2], np.sqrt((jitter * jitter).mean())))
+
+
+if __name__ == '__main__':
+    _bench()
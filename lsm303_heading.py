@@ -0,0 +1,173 @@
+# Tilt-compensated compass heading for the LSM303, scalar and batched.
+#
+# The magnetometer vector is first corrected for hard-iron (offset) and
+# soft-iron (3x3 matrix) distortion, then rotated back into the horizontal
+# plane using roll and pitch from the accelerometer:
+#
+#   roll  = atan2(ay, az)
+#   pitch = atan2(-ax, ay sin(roll) + az cos(roll))
+#   Xh = mx cos(pitch) + my sin(roll) sin(pitch) + mz cos(roll) sin(pitch)
+#   Yh = my cos(roll) - mz sin(roll)
+#   heading = atan2(Yh, Xh) in degrees, 0..360
+#
+# With the board flat this reduces to atan2(my, mx), the formula the lab
+# code used before. heading_batch() does the whole computation over N
+# samples in one NumPy pass; heading_scalar() is the per-sample reference.
+# angles_scalar() and angles_batch() also return the roll and pitch they use
+# (lsm303_fusion.py filters all three).
+#
+#   python3 lsm303_heading.py      # speed and accuracy, 4096 samples
+import math
+
+import numpy as np
+
+
+class Calibration(object):
+    def __init__(self, hard_iron=(0.0, 0.0, 0.0), soft_iron=None):
+        self.hard_iron = np.asarray(hard_iron, dtype=np.float64)
+        if soft_iron is None:
+            soft_iron = np.eye(3)
+        self.soft_iron = np.asarray(soft_iron, dtype=np.float64)
+        # Plain lists for the per-sample path
+        self._hard = self.hard_iron.tolist()
+        self._soft = self.soft_iron.tolist()
+
+    @classmethod
+    def fit(cls, mag):
+        # Min/max fit from raw mag samples taken while rotating the board
+        # through all orientations: the offset centres the ellipsoid and a
+        # diagonal scale makes it a sphere
+        mag = np.asarray(mag, dtype=np.float64).reshape(-1, 3)
+        lo = mag.min(axis=0)
+        hi = mag.max(axis=0)
+        radius = (hi - lo) / 2.0
+        radius[radius == 0] = 1.0
+        return cls((hi + lo) / 2.0, np.diag(radius.mean() / radius))
+
+    def apply(self, mag):
+        mag = np.asarray(mag, dtype=np.float64).reshape(-1, 3)
+        return (mag - self.hard_iron) @ self.soft_iron.T
+
+    def apply_scalar(self, mag):
+        # Same as apply() for one sample, in plain Python
+        x = mag[0] - self._hard[0]
+        y = mag[1] - self._hard[1]
+        z = mag[2] - self._hard[2]
+        return [r[0] * x + r[1] * y + r[2] * z for r in self._soft]
+
+
+def angles_scalar(accel, mag, cal=None):
+    # Roll, pitch and heading of one sample in radians, heading in -pi..pi
+    ax, ay, az = accel
+    if cal is not None:
+        mx, my, mz = cal.apply_scalar(mag)
+    else:
+        mx, my, mz = mag
+
+    roll = math.atan2(ay, az)
+    sr = math.sin(roll)
+    cr = math.cos(roll)
+    pitch = math.atan2(-ax, ay * sr + az * cr)
+    sp = math.sin(pitch)
+    cp = math.cos(pitch)
+
+    xh = mx * cp + my * sr * sp + mz * cr * sp
+    yh = my * cr - mz * sr
+    return roll, pitch, math.atan2(yh, xh)
+
+
+def heading_scalar(accel, mag, cal=None):
+    heading = math.degrees(angles_scalar(accel, mag, cal)[2])
+    if heading < 0:
+        heading += 360.0
+    return heading
+
+
+def angles_batch(accel, mag, cal=None):
+    # accel, mag: (N, 3) arrays or flat x,y,z interleaved buffers (such as
+    # SampleRing.views()); returns roll, pitch and heading of N samples in
+    # radians, heading in -pi..pi
+    accel = np.asarray(accel).reshape(-1, 3)
+    if cal is not None:
+        m = cal.apply(mag)
+    else:
+        m = np.asarray(mag, dtype=np.float64).reshape(-1, 3)
+    ax = accel[:, 0].astype(np.float64)
+    ay = accel[:, 1].astype(np.float64)
+    az = accel[:, 2].astype(np.float64)
+    mx = m[:, 0]
+    my = m[:, 1]
+    mz = m[:, 2]
+
+    roll = np.arctan2(ay, az)
+    sr = np.sin(roll)
+    cr = np.cos(roll)
+    pitch = np.arctan2(-ax, ay * sr + az * cr)
+    sp = np.sin(pitch)
+    cp = np.cos(pitch)
+
+    xh = mx * cp + (my * sr + mz * cr) * sp
+    yh = my * cr - mz * sr
+    return roll, pitch, np.arctan2(yh, xh)
+
+
+def heading_batch(accel, mag, cal=None, out=None):
+    # Headings in degrees, 0..360, of N samples (see angles_batch); returns
+    # them or fills `out`
+    heading = np.degrees(angles_batch(accel, mag, cal)[2])
+    heading %= 360.0
+    if out is not None:
+        out[:] = heading
+        return out
+    return heading
+
+
+def ring_headings(ring, start, end=None, cal=None):
+    # Recompute the headings of ring positions [start, end) in place from
+    # the stored accel/mag samples
+    for index, count in ring.segments(start, end):
+        ts, heading, accel, mag = ring.views(index, count)
+        heading_batch(np.frombuffer(accel, dtype=np.int16),
+                      np.frombuffer(mag, dtype=np.int16), cal,
+                      out=np.frombuffer(heading, dtype=np.float32))
+
+
+def _bench(n=4096, repeat=20):
+    import time
+
+    rng = np.random.RandomState(242)
+    # Random orientations of a 1 g / 400 count field, plus sensor noise
+    roll = rng.uniform(-0.6, 0.6, n)
+    pitch = rng.uniform(-0.6, 0.6, n)
+    yaw = rng.uniform(0, 2 * np.pi, n)
+    g = 1000.0
+    accel = np.stack([-g * np.sin(pitch),
+                      g * np.sin(roll) * np.cos(pitch),
+                      g * np.cos(roll) * np.cos(pitch)], axis=1)
+    field = np.stack([400 * np.cos(yaw), 400 * np.sin(yaw),
+                      np.full(n, -300.0)], axis=1)
+    cal = Calibration((35.0, -20.0, 12.0), np.diag([1.05, 0.97, 1.0]))
+    mag = field @ np.linalg.inv(cal.soft_iron).T + cal.hard_iron
+    accel = np.round(accel + rng.normal(0, 4, accel.shape)).astype(np.int16)
+    mag = np.round(mag).astype(np.int16)
+
+    accel_list = accel.tolist()
+    mag_list = mag.tolist()
+    start = time.perf_counter()
+    ref = [heading_scalar(a, m, cal) for a, m in zip(accel_list, mag_list)]
+    scalar = (time.perf_counter() - start) / n
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = heading_batch(accel, mag, cal)
+    batch = (time.perf_counter() - start) / (repeat * n)
+
+    diff = np.abs((out - np.array(ref) + 180.0) % 360.0 - 180.0)
+    print("scalar : {0:8.3f} us/sample".format(scalar * 1e6))
+    print("batch  : {0:8.3f} us/sample  ({1:.0f}x faster, N={2})".format(
+        batch * 1e6, scalar / batch, n))
+    print("max |batch - scalar| = {0:.2e} deg".format(diff.max()))
+
+
+if __name__ == '__main__':
+    _bench()
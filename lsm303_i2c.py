@@ -0,0 +1,288 @@
+# LSM303DLHC FIFO/burst reader.
+#
+# Adafruit_LSM303 reads one accelerometer sample and one magnetometer sample
+# per call, two I2C transactions per sample. Here the accelerometer runs in
+# its hardware FIFO (stream mode, 32 samples deep) and is drained with a
+# single auto-incrementing block read from OUT_X_L_A (with the FIFO enabled
+# the address rolls back from OUT_Z_H_A to OUT_X_L_A, so 6 * n bytes return
+# n samples). The magnetometer has no FIFO; it is read once per drain as one
+# 7 byte auto-increment read of OUT_X_H_M..SR_REG_M and held for the samples
+# of that drain.
+#
+# Samples are timestamped from the drain time and the accelerometer ODR.
+# FifoSource plugs the reader into the sample source interface of
+# lsm303_source.py ("--source fifo" in lsm303_tcp.py).
+#
+#   python3 lsm303_i2c.py      # I2C transactions per sample on a mock bus
+import struct
+import time
+
+from lsm303_source import SensorSource
+
+ACCEL_ADDR = 0x19
+MAG_ADDR = 0x1E
+
+# Accelerometer registers
+CTRL_REG1_A = 0x20
+CTRL_REG4_A = 0x23
+CTRL_REG5_A = 0x24
+OUT_X_L_A = 0x28
+FIFO_CTRL_REG_A = 0x2E
+FIFO_SRC_REG_A = 0x2F
+AUTO_INCREMENT = 0x80
+
+# Magnetometer registers
+CRA_REG_M = 0x00
+CRB_REG_M = 0x01
+MR_REG_M = 0x02
+OUT_X_H_M = 0x03
+
+FIFO_DEPTH = 32
+FIFO_STREAM = 0x80
+FIFO_EN = 0x40
+FIFO_OVRN = 0x40
+FIFO_EMPTY = 0x20
+HR_BDU = 0x88
+
+# ODR field of CTRL_REG1_A and DO field of CRA_REG_M, by rate in Hz
+ACCEL_ODR = {1: 1, 10: 2, 25: 3, 50: 4, 100: 5, 200: 6, 400: 7, 1344: 9}
+MAG_ODR = {15: 4, 30: 5, 75: 6, 220: 7}
+ACCEL_ODR_HZ = dict((v, k) for k, v in ACCEL_ODR.items())
+
+
+class SMBusI2C(object):
+    # Register access through smbus2. Each method is one bus transaction;
+    # block reads use i2c_rdwr so they are not limited to 32 bytes.
+    def __init__(self, busnum=1):
+        import smbus2
+        self.smbus2 = smbus2
+        self.bus = smbus2.SMBus(busnum)
+
+    def write_reg(self, addr, reg, value):
+        self.bus.write_byte_data(addr, reg, value)
+
+    def read_reg(self, addr, reg):
+        return self.bus.read_byte_data(addr, reg)
+
+    def read_block(self, addr, reg, n):
+        write = self.smbus2.i2c_msg.write(addr, [reg])
+        read = self.smbus2.i2c_msg.read(addr, n)
+        self.bus.i2c_rdwr(write, read)
+        return bytes(read)
+
+    def close(self):
+        self.bus.close()
+
+
+class FifoReader(object):
+    def __init__(self, bus, accel_odr=400, mag_odr=220,
+                 clock=time.monotonic, sleep=time.sleep):
+        if accel_odr not in ACCEL_ODR:
+            raise ValueError("unsupported accel ODR %r" % accel_odr)
+        if mag_odr not in MAG_ODR:
+            raise ValueError("unsupported mag ODR %r" % mag_odr)
+        self.bus = bus
+        self.accel_odr = accel_odr
+        self.mag_odr = mag_odr
+        self.period = 1.0 / accel_odr
+        self.clock = clock
+        self.sleep = sleep
+        self.mag = (0, 0, 0)
+        self.overruns = 0
+        self.drains = 0
+        # wall clock = monotonic + offset, for microsecond timestamps
+        self.offset = time.time() - clock()
+        self.configure()
+
+    def configure(self):
+        bus = self.bus
+        bus.write_reg(ACCEL_ADDR, CTRL_REG1_A,
+                      (ACCEL_ODR[self.accel_odr] << 4) | 0x07)
+        bus.write_reg(ACCEL_ADDR, CTRL_REG4_A, HR_BDU)
+        bus.write_reg(ACCEL_ADDR, CTRL_REG5_A, FIFO_EN)
+        # Going through bypass mode clears anything left in the FIFO
+        bus.write_reg(ACCEL_ADDR, FIFO_CTRL_REG_A, 0x00)
+        bus.write_reg(ACCEL_ADDR, FIFO_CTRL_REG_A, FIFO_STREAM)
+        bus.write_reg(MAG_ADDR, CRA_REG_M, MAG_ODR[self.mag_odr] << 2)
+        bus.write_reg(MAG_ADDR, MR_REG_M, 0x00)
+
+    def fifo_level(self):
+        src = self.bus.read_reg(ACCEL_ADDR, FIFO_SRC_REG_A)
+        if src & FIFO_OVRN:
+            self.overruns += 1
+            return FIFO_DEPTH
+        if src & FIFO_EMPTY:
+            return 0
+        return src & 0x1F
+
+    def drain(self):
+        # All samples waiting in the FIFO as [(ts_us, accel, mag), ...]
+        n = self.fifo_level()
+        if n == 0:
+            return []
+        now = self.clock()
+        raw = self.bus.read_block(ACCEL_ADDR, OUT_X_L_A | AUTO_INCREMENT, 6 * n)
+        m = self.bus.read_block(MAG_ADDR, OUT_X_H_M, 7)
+        if m[6] & 0x01:
+            # Register order is X, Z, Y, high byte first
+            x, z, y = struct.unpack('>hhh', m[:6])
+            self.mag = (x, y, z)
+        self.drains += 1
+
+        samples = []
+        mag = self.mag
+        # The newest sample was taken at most one period before `now`
+        last = now + self.offset
+        values = struct.unpack('<%dh' % (3 * n), raw)
+        for i in range(n):
+            ts = int((last - (n - 1 - i) * self.period) * 1000000)
+            accel = (values[3 * i] >> 4, values[3 * i + 1] >> 4,
+                     values[3 * i + 2] >> 4)
+            samples.append((ts, accel, mag))
+        return samples
+
+    def __iter__(self):
+        while True:
+            samples = self.drain()
+            if not samples:
+                # Wait for roughly half a FIFO rather than polling the bus
+                self.sleep(self.period * FIFO_DEPTH / 2)
+                continue
+            for sample in samples:
+                yield sample
+
+
+class FifoSource(SensorSource):
+    # The FIFO paces the reads at the accelerometer ODR
+    paced = True
+
+    def __init__(self, busnum=1, accel_odr=400, mag_odr=220, bus=None):
+        if bus is None:
+            bus = SMBusI2C(busnum)
+        self.bus = bus
+        self.samples = iter(FifoReader(bus, accel_odr, mag_odr))
+
+    def read(self):
+        return next(self.samples)
+
+    def close(self):
+        if hasattr(self.bus, 'close'):
+            self.bus.close()
+
+
+class MockBus(object):
+    # Register-level stand-in for an LSM303DLHC that fills its accel FIFO
+    # at the configured ODR on the given clock. Counts transactions and the
+    # bytes on the wire so read strategies can be compared.
+    def __init__(self, clock=time.monotonic, khz=100):
+        self.clock = clock
+        self.khz = khz
+        self.regs = {ACCEL_ADDR: bytearray(0x40), MAG_ADDR: bytearray(0x10)}
+        self.transactions = 0
+        self.bits = 0
+        self.fifo = []
+        self.produced = 0
+        self.start = clock()
+        # 12-bit counts, 1 mg each at +-2 g in high resolution mode
+        self.accel = (16, -32, 1000)
+
+    def bus_time(self):
+        return self.bits / (self.khz * 1000.0)
+
+    def _count(self, nbytes, read):
+        # START, address, register, data bytes (9 bits each with ACK), STOP;
+        # reads add a repeated START and a second address byte
+        self.transactions += 1
+        self.bits += 2 + 9 * (2 + nbytes) + (10 if read else 0)
+
+    def _fill(self):
+        odr = ACCEL_ODR_HZ.get(self.regs[ACCEL_ADDR][CTRL_REG1_A] >> 4)
+        if not odr:
+            return
+        due = int((self.clock() - self.start) * odr)
+        while self.produced < due:
+            self.produced += 1
+            if len(self.fifo) == FIFO_DEPTH:
+                self.fifo.pop(0)
+            self.fifo.append(self.accel)
+
+    def write_reg(self, addr, reg, value):
+        self._count(1, False)
+        self.regs[addr][reg] = value
+        if addr == ACCEL_ADDR and reg in (CTRL_REG1_A, FIFO_CTRL_REG_A):
+            self.fifo = []
+            self.start = self.clock()
+            self.produced = 0
+
+    def read_reg(self, addr, reg):
+        self._count(1, True)
+        if addr == ACCEL_ADDR and reg == FIFO_SRC_REG_A:
+            self._fill()
+            n = len(self.fifo)
+            if n == 0:
+                return FIFO_EMPTY
+            if n == FIFO_DEPTH:
+                return FIFO_OVRN
+            return n
+        return self.regs[addr][reg]
+
+    def read_block(self, addr, reg, n):
+        self._count(n, True)
+        if addr == MAG_ADDR:
+            return struct.pack('>hhhB', 300, -250, 120, 0x01)[:n]
+        self._fill()
+        out = bytearray()
+        for _ in range(n // 6):
+            # An empty FIFO keeps returning the last sample
+            sample = self.fifo.pop(0) if self.fifo else self.accel
+            out += struct.pack('<hhh', *[v << 4 for v in sample])
+        return bytes(out)
+
+
+class _VirtualClock(object):
+    def __init__(self):
+        self.t = 0.0
+
+    def now(self):
+        return self.t
+
+    def sleep(self, dt):
+        self.t += dt
+
+
+def _bench(samples=4000, odr=400):
+    # Per-sample reads the way Adafruit_LSM303 does them
+    clock = _VirtualClock()
+    bus = MockBus(clock.now)
+    for _ in range(samples):
+        bus.read_block(ACCEL_ADDR, OUT_X_L_A | AUTO_INCREMENT, 6)
+        bus.read_block(MAG_ADDR, OUT_X_H_M, 6)
+        clock.sleep(1.0 / odr)
+    old = (bus.transactions, bus.bus_time())
+
+    clock = _VirtualClock()
+    bus = MockBus(clock.now)
+    reader = FifoReader(bus, accel_odr=odr, clock=clock.now,
+                        sleep=clock.sleep)
+    setup = bus.transactions
+    bus.transactions = 0
+    bus.bits = 0
+    n = 0
+    for _ in reader:
+        n += 1
+        if n == samples:
+            break
+    new = (bus.transactions, bus.bus_time())
+
+    print("{0} samples at {1} Hz, 100 kHz bus".format(samples, odr))
+    print("per-sample reads : {0:6.3f} transactions/sample, "
+          "{1:7.1f} us bus time/sample".format(
+              old[0] / float(samples), old[1] / samples * 1e6))
+    print("FIFO burst reads : {0:6.3f} transactions/sample, "
+          "{1:7.1f} us bus time/sample ({2} setup writes, {3} overruns)"
+          .format(new[0] / float(samples), new[1] / samples * 1e6,
+                  setup, reader.overruns))
+
+
+if __name__ == '__main__':
+    _bench()
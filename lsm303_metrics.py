@@ -0,0 +1,241 @@
+# Low-overhead latency metrics for the LSM303 pipeline.
+#
+# LogHistogram counts nanosecond durations in log-linear buckets: values
+# below 16 ns get their own bucket and every power of two above that is
+# split into 8 buckets, so a percentile is never off by more than ~12%.
+# record() is a few integer operations and one list increment, cheap
+# enough to time every sample.
+#
+# Metrics groups one histogram per stage (rtt, i2c, compute, send, ...) and
+# rolls them over every `window` seconds: the closed window's p50/p95/p99/max
+# go to the sinks (JSON lines file, a Unix datagram socket, or the latest
+# summary served over HTTP) and the histograms start again from zero.
+#
+#   python3 lsm303_metrics.py      # overhead per record / per sample
+import json
+import socket
+import threading
+import time
+
+SUB_BITS = 3
+BUCKETS = 320
+
+
+def bucket_value(index):
+    # Lower bound of a bucket
+    if index < 2 << SUB_BITS:
+        return index
+    shift = (index >> SUB_BITS) - 1
+    return (index - (shift << SUB_BITS)) << shift
+
+
+class LogHistogram(object):
+    def __init__(self):
+        # A list of ints increments faster than array('Q') in CPython
+        self.counts = [0] * BUCKETS
+        self.max = 0
+
+    def record(self, ns):
+        # Bucket = (power of two, top SUB_BITS bits below the leading one),
+        # written out with SUB_BITS = 3 to keep this path short
+        shift = ns.bit_length() - 4
+        if shift > 0:
+            i = (shift << 3) + (ns >> shift)
+            if i >= BUCKETS:
+                i = BUCKETS - 1
+        else:
+            i = ns if ns > 0 else 0
+        self.counts[i] += 1
+        if ns > self.max:
+            self.max = ns
+
+    def count(self):
+        return sum(self.counts)
+
+    def reset(self):
+        self.counts[:] = [0] * BUCKETS
+        self.max = 0
+
+    def percentile(self, p):
+        count = self.count()
+        if count == 0:
+            return 0
+        target = p / 100.0 * count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                # Middle of the bucket, capped by the exact maximum
+                mid = (bucket_value(i) + bucket_value(i + 1)) // 2
+                return min(mid, self.max)
+        return self.max
+
+    def summary(self):
+        # Microseconds, as floats
+        return {'count': self.count(),
+                'p50': self.percentile(50) / 1000.0,
+                'p95': self.percentile(95) / 1000.0,
+                'p99': self.percentile(99) / 1000.0,
+                'max': self.max / 1000.0}
+
+
+class FileSink(object):
+    # One JSON object per line
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def write(self, report):
+        self.file.write(json.dumps(report) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class UnixSink(object):
+    # One datagram per report to a listening AF_UNIX SOCK_DGRAM socket;
+    # reports are dropped while nobody listens
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def write(self, report):
+        try:
+            self.sock.sendto(json.dumps(report).encode('utf-8'), self.path)
+        except (OSError, IOError):
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+class HttpEndpoint(object):
+    # Serves the latest report as JSON on http://host:port/ from a
+    # background thread
+    def __init__(self, port, host='127.0.0.1'):
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        endpoint = self
+        self.latest = b'{}'
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = endpoint.latest
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, report):
+        self.latest = json.dumps(report).encode('utf-8')
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Metrics(object):
+    def __init__(self, names, window=10.0, sinks=(), clock=time.monotonic):
+        self.hist = dict((name, LogHistogram()) for name in names)
+        self.window = window
+        self.sinks = list(sinks)
+        self.clock = clock
+        self.window_start = clock()
+        self.last = None
+
+    def __getitem__(self, name):
+        return self.hist[name]
+
+    def record(self, name, ns):
+        self.hist[name].record(ns)
+
+    def report(self, extra=None):
+        now = self.clock()
+        report = {'time': time.time(),
+                  'window': now - self.window_start}
+        for name, hist in self.hist.items():
+            report[name] = hist.summary()
+        if extra:
+            report.update(extra)
+        return report
+
+    def roll(self, extra=None):
+        # Close the current window: publish it and start a new one
+        self.last = self.report(extra)
+        for sink in self.sinks:
+            sink.write(self.last)
+        for hist in self.hist.values():
+            hist.reset()
+        self.window_start = self.clock()
+        return self.last
+
+    def due(self):
+        return self.clock() - self.window_start >= self.window
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def _bench(n=200000):
+    import random
+
+    rng = random.Random(242)
+    values = [int(rng.lognormvariate(11, 1)) for _ in range(4096)]
+    hist = LogHistogram()
+    record = hist.record
+
+    start = time.perf_counter()
+    for i in range(n):
+        record(values[i & 4095])
+    per_record = (time.perf_counter() - start) / n
+
+    # A sample as lsm303_tcp.py times it: one clock read and the i2c time
+    # per sample; compute and send per batch of 32, rtt per ack
+    metrics = Metrics(['i2c', 'compute', 'send', 'rtt'])
+    clock = time.perf_counter_ns
+    i2c, compute, send, rtt = (metrics[name].record
+                               for name in ('i2c', 'compute', 'send', 'rtt'))
+
+    def loop(timed):
+        t0 = t1 = t2 = t3 = 0
+        start = time.perf_counter()
+        for i in range(n):
+            if timed:
+                t1 = clock()
+                i2c(t1 - t0)
+            if i & 31 == 31 and timed:
+                t2 = clock()
+                t3 = clock()
+                compute(t2 - t1)
+                send(t3 - t2)
+                rtt(values[i & 4095])
+            t0 = t1
+        return (time.perf_counter() - start) / n
+
+    per_sample = loop(True) - loop(False)
+
+    exact = sorted(values * (n // 4096))
+    print("record()              : {0:6.0f} ns".format(per_record * 1e9))
+    print("per sample (4 stages) : {0:6.0f} ns including clock reads".format(
+        per_sample * 1e9))
+    for p in (50, 95, 99):
+        print("p{0}: histogram {1:8.1f} us, exact {2:8.1f} us".format(
+            p, hist.percentile(p) / 1000.0,
+            exact[int(p / 100.0 * len(exact))] / 1000.0))
+
+
+if __name__ == '__main__':
+    _bench()
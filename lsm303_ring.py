@@ -0,0 +1,182 @@
+# Preallocated struct-of-arrays ring buffer for LSM303 samples.
+#
+# Each field lives in its own typed array (timestamps u64, heading f32,
+# accel and mag as interleaved x,y,z i16) allocated once at start-up.
+# Appending a sample only stores numbers into those arrays, and readers get
+# memoryview slices of them, so the socket layer can hand the samples to
+# sendmsg() without building per-sample Python objects or copying bytes.
+#
+# Positions are absolute sample counts: `head` is the number of samples ever
+# appended and the oldest one still held is `head - capacity`. Each consumer
+# (sender, recorder, ...) keeps its own position and asks for the samples
+# between it and head.
+#
+#   python3 lsm303_ring.py     # allocation / copy comparison with the text path
+import array
+
+
+class SampleRing(object):
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.ts = array.array('Q', bytes(8 * capacity))
+        self.heading = array.array('f', bytes(4 * capacity))
+        self.accel = array.array('h', bytes(2 * 3 * capacity))
+        self.mag = array.array('h', bytes(2 * 3 * capacity))
+        self.head = 0
+
+    def __len__(self):
+        return min(self.head, self.capacity)
+
+    def tail(self):
+        # Oldest position still held in the ring
+        return max(0, self.head - self.capacity)
+
+    def append(self, ts, heading, accel, mag):
+        i = self.head % self.capacity
+        self.ts[i] = ts
+        self.heading[i] = heading
+        j = 3 * i
+        self.accel[j] = accel[0]
+        self.accel[j + 1] = accel[1]
+        self.accel[j + 2] = accel[2]
+        self.mag[j] = mag[0]
+        self.mag[j + 1] = mag[1]
+        self.mag[j + 2] = mag[2]
+        self.head += 1
+
+    def segments(self, start, end=None):
+        # Split positions [start, end) into at most two contiguous
+        # (index, count) ranges of the underlying arrays
+        if end is None:
+            end = self.head
+        start = max(start, self.tail())
+        if start >= end:
+            return []
+        i = start % self.capacity
+        n = end - start
+        if i + n <= self.capacity:
+            return [(i, n)]
+        first = self.capacity - i
+        return [(i, first), (0, n - first)]
+
+    def views(self, index, count):
+        # memoryviews of one contiguous range: (ts, heading, accel, mag)
+        return (memoryview(self.ts)[index:index + count],
+                memoryview(self.heading)[index:index + count],
+                memoryview(self.accel)[3 * index:3 * (index + count)],
+                memoryview(self.mag)[3 * index:3 * (index + count)])
+
+    def get(self, pos):
+        # One sample as (ts, heading, accel, mag); for debugging, not hot paths
+        if pos < self.tail() or pos >= self.head:
+            raise IndexError("sample %d is not in the ring" % pos)
+        i = pos % self.capacity
+        j = 3 * i
+        return (self.ts[i], self.heading[i],
+                tuple(self.accel[j:j + 3]), tuple(self.mag[j:j + 3]))
+
+
+def _bench(samples=20000, batch=32):
+    import math
+    import os
+    import socket
+    import time
+    import tracemalloc
+
+    from lsm303_wire import FrameSender, HEADER, RECORD, serve_connection
+
+    accel = (12, -40, 1010)
+    mag = (200, -150, -480)
+
+    def drain(conn):
+        while conn.recv(65536):
+            pass
+
+    def connect(target):
+        # The receiver runs in a child process so its buffers are not
+        # counted by tracemalloc
+        a, b = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            a.close()
+            target(b)
+            os._exit(0)
+        b.close()
+        return a, pid
+
+    def text_path(sock):
+        def step(n):
+            copied = 0
+            for _ in range(n):
+                time_cur = int(round(time.time() * 1000000))
+                time_str = str(time_cur)
+                heading_f = (math.atan2(mag[1], mag[0]) * 180) / 3.14159
+                if heading_f < 0:
+                    heading_f = 360 + heading_f
+                heading_str = str(int(heading_f))
+                complete_str = heading_str + " " + time_str
+                data = complete_str.encode('utf-8')
+                sock.sendall(data)
+                # digits into the two strs, the concatenation, the encode
+                copied += len(heading_str) + len(time_str) + \
+                    len(complete_str) + len(data)
+            return copied
+        return step
+
+    def ring_path(sock):
+        ring = SampleRing(4 * batch)
+        sender = FrameSender(sock, batch=batch, window=1 << 30)
+        heading_f = (math.atan2(mag[1], mag[0]) * 180) / math.pi % 360
+        state = [0]
+
+        def step(n):
+            pos = state[0]
+            frames = sender.seq
+            for _ in range(n):
+                ring.append(int(time.time() * 1000000), heading_f, accel, mag)
+                if ring.head - pos >= batch:
+                    pos = sender.send_ring(ring, pos)
+            state[0] = sender.send_ring(ring, pos)
+            # the fields stored into the ring and each frame's packed
+            # header; sendmsg() is handed the ring's own memory
+            return n * RECORD.size + (sender.seq - frames) * HEADER.size
+        return step
+
+    def measure(path, step, target):
+        sock, pid = connect(target)
+        fn = path(sock)
+        fn(1024)                    # warm up
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        heap = 0
+        copied = 0
+        start = time.perf_counter()
+        for _ in range(samples // step):
+            tracemalloc.reset_peak()
+            copied += fn(step)
+            heap += tracemalloc.get_traced_memory()[1] - base
+        elapsed = time.perf_counter() - start
+        growth = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        sock.close()
+        os.waitpid(pid, 0)
+        n = samples // step * step
+        return elapsed / n * 1e6, heap / float(n), growth, copied / float(n)
+
+    # heap/sample: peak traced heap above the baseline while handling one
+    # sample (text) or one batch (ring), i.e. transient allocations per
+    # sample. Timings include the tracemalloc overhead.
+    print("{0:14s} {1:>10s} {2:>12s} {3:>10s} {4:>14s}".format(
+        '', 'us/sample', 'heap/sample', 'growth', 'copied/sample'))
+    for name, path, step, target in (
+            ('text + encode', text_path, 1, drain),
+            ('ring + sendmsg', ring_path, batch, serve_connection)):
+        us, peak, growth, copied = measure(path, step, target)
+        print("{0:14s} {1:10.2f} {2:10.1f} B {3:8d} B {4:12.1f} B".format(
+            name, us, peak, growth, copied))
+    print("(wire bytes per sample: text ~20, framed {0} + header/{1})".format(
+        RECORD.size, batch))
+
+
+if __name__ == '__main__':
+    _bench()
@@ -0,0 +1,168 @@
+# Fixed-rate sampling scheduler for the LSM303 loop.
+#
+# Tick k is due at start + k * period on the monotonic clock, so a slow
+# iteration never shifts the ticks after it (no drift). When the loop falls
+# more than one period behind, the missed ticks are either run back-to-back
+# (catch_up=True) or skipped and counted (catch_up=False, the default).
+#
+# Every tick records its jitter (wake-up time minus deadline) so we can see
+# when the Pi/Jetson can no longer hold the requested rate. wait_async() is
+# the same tick for a coroutine on an asyncio event loop.
+#
+#   python3 lsm303_sched.py --rates 100 400 1000
+import array
+import asyncio
+import math
+import time
+
+# Jitter samples kept for percentiles
+HISTORY = 4096
+# Spin margin of wait_async(): asyncio's timer resolution plus a little
+ASYNC_SPIN = 0.0012
+
+
+class JitterStats(object):
+    def __init__(self, history=HISTORY):
+        self.history = array.array('d', bytes(8 * history))
+        self.ticks = 0
+        self.overruns = 0
+        self.missed = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.max = 0.0
+
+    def add(self, jitter):
+        self.history[self.ticks % len(self.history)] = jitter
+        self.ticks += 1
+        self.total += jitter
+        self.total_sq += jitter * jitter
+        if jitter > self.max:
+            self.max = jitter
+
+    def mean(self):
+        return self.total / self.ticks if self.ticks else 0.0
+
+    def rms(self):
+        return math.sqrt(self.total_sq / self.ticks) if self.ticks else 0.0
+
+    def percentile(self, p):
+        n = min(self.ticks, len(self.history))
+        if n == 0:
+            return 0.0
+        values = sorted(self.history[:n])
+        return values[min(n - 1, int(p / 100.0 * n))]
+
+    def summary(self):
+        return ("ticks {0} overruns {1} missed {2} jitter mean {3:.1f} us "
+                "p99 {4:.1f} us max {5:.1f} us").format(
+                    self.ticks, self.overruns, self.missed,
+                    self.mean() * 1e6, self.percentile(99) * 1e6,
+                    self.max * 1e6)
+
+
+class RateScheduler(object):
+    # spin: the last `spin` seconds before a deadline are busy-waited, which
+    # trades a little CPU for much lower jitter than sleep() alone
+    def __init__(self, rate_hz, catch_up=False, spin=0.0002,
+                 clock=time.monotonic, sleep=time.sleep):
+        if rate_hz <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate_hz
+        self.period = 1.0 / rate_hz
+        self.catch_up = catch_up
+        self.spin = spin
+        self.clock = clock
+        self.sleep = sleep
+        self.start = None
+        self.tick = 0
+        self.stats = JitterStats()
+
+    def deadline(self, tick):
+        return self.start + tick * self.period
+
+    def wait(self):
+        # Block until the next tick is due; returns (tick, deadline)
+        deadline = self._next()
+        remaining = deadline - self.clock()
+        if remaining > self.spin:
+            self.sleep(remaining - self.spin)
+        return self._arrive(deadline)
+
+    async def wait_async(self, spin=ASYNC_SPIN):
+        # The same for a coroutine on an asyncio loop. The loop rounds its
+        # timeouts up to the millisecond, so the coarse sleep has to stop
+        # a millisecond early and the rest is spun, blocking the loop
+        deadline = self._next()
+        remaining = deadline - self.clock()
+        if remaining > spin:
+            await asyncio.sleep(remaining - spin)
+        return self._arrive(deadline)
+
+    def _next(self):
+        now = self.clock()
+        if self.start is None:
+            self.start = now
+        deadline = self.deadline(self.tick)
+
+        if now - deadline >= self.period:
+            # More than one period late: this tick is an overrun
+            self.stats.overruns += 1
+            if not self.catch_up:
+                behind = int((now - self.start) / self.period)
+                self.stats.missed += behind - self.tick
+                self.tick = behind
+                deadline = self.deadline(self.tick)
+        return deadline
+
+    def _arrive(self, deadline):
+        now = self.clock()
+        while now < deadline:
+            now = self.clock()
+
+        self.stats.add(now - deadline)
+        tick = self.tick
+        self.tick += 1
+        return tick, deadline
+
+    def reset(self):
+        self.start = None
+        self.tick = 0
+        self.stats = JitterStats()
+
+
+def bench(rates, seconds=2.0, load=0.0):
+    for rate in rates:
+        # Naive pacing: sleep one period after the work
+        period = 1.0 / rate
+        n = int(seconds * rate)
+        start = time.monotonic()
+        for _ in range(n):
+            if load:
+                time.sleep(load)
+            time.sleep(period)
+        naive_rate = n / (time.monotonic() - start)
+
+        sched = RateScheduler(rate)
+        start = time.monotonic()
+        for _ in range(n):
+            sched.wait()
+            if load:
+                time.sleep(load)
+        sched_rate = n / (time.monotonic() - start)
+
+        print("{0:6.0f} Hz  sleep(): {1:8.1f} Hz   scheduler: {2:8.1f} Hz"
+              .format(rate, naive_rate, sched_rate))
+        print("           " + sched.stats.summary())
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='LSM303 fixed-rate scheduler benchmark')
+    parser.add_argument('--rates', type=float, nargs='+',
+                        default=[100, 400, 1000])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--load-us', type=float, default=0.0,
+                        help='emulated work per sample')
+    args = parser.parse_args()
+    bench(args.rates, args.seconds, args.load_us / 1e6)
@@ -0,0 +1,259 @@
+# Sample sources for the LSM303 pipeline.
+#
+# Every source has read() -> (timestamp_us, (ax, ay, az), (mx, my, mz)) and
+# raises EOFError when it has nothing more to give:
+#
+#   AdafruitSource   the sensor on the board, through Adafruit_LSM303
+#   FifoSource       the sensor read in FIFO bursts (lsm303_i2c.py)
+#   SimulatedSource  deterministic synthetic board: spins at a set rate,
+#                    wobbles in roll/pitch, adds sensor noise and can
+#                    emulate I2C latency
+#   ReplaySource     plays back a capture at its original pace, `speed`
+#                    times faster, or as fast as possible (speed=0)
+#
+# Captures are lsm303_store directories; record() writes one from any
+# source. A file holding a plain sequence of lsm303_wire frames (as saved
+# from the link) can be replayed too. With the simulator or a replay the
+# whole streaming path runs on a plain Linux box, far faster than real time
+# if asked to.
+#
+#   python3 lsm303_source.py sim capture --seconds 60
+#   python3 lsm303_source.py replay capture --speed 0
+import math
+import os
+import random
+import time
+
+from lsm303_sched import RateScheduler
+from lsm303_store import CaptureReader, CaptureWriter
+from lsm303_wire import FrameReader
+
+
+class SensorSource(object):
+    # Sources that pace themselves (replays) set this so callers do not
+    # put a scheduler in front of them
+    paced = False
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.read()
+        except EOFError:
+            return
+
+
+class AdafruitSource(SensorSource):
+    def __init__(self, busnum=None):
+        # Imported here so the other sources work without the library
+        import Adafruit_LSM303
+        if busnum is None:
+            self.lsm303 = Adafruit_LSM303.LSM303()
+        else:
+            self.lsm303 = Adafruit_LSM303.LSM303(busnum=busnum)
+
+    def read(self):
+        accel = self.lsm303.read_accel()
+        mag = self.lsm303.read_mag()
+        return int(round(time.time() * 1000000)), accel, mag
+
+
+class SimulatedSource(SensorSource):
+    # Timestamps advance by exactly 1/rate_hz per read, whatever the wall
+    # clock does, so runs are reproducible at any speed. `heading()` gives
+    # the true heading of the last sample for checking the pipeline.
+    def __init__(self, rate_hz=100.0, rotation_dps=30.0, tilt_deg=10.0,
+                 wobble_hz=0.5, noise=4.0, i2c_latency=0.0, seed=242,
+                 count=None, start_us=None, gravity=1000.0,
+                 field=(400.0, -300.0)):
+        self.period_us = 1e6 / rate_hz
+        self.rotation = math.radians(rotation_dps)
+        self.tilt = math.radians(tilt_deg)
+        self.wobble = 2 * math.pi * wobble_hz
+        self.noise = noise
+        self.i2c_latency = i2c_latency
+        self.rng = random.Random(seed)
+        self.count = count
+        if start_us is None:
+            start_us = int(round(time.time() * 1000000))
+        self.start_us = start_us
+        self.gravity = gravity
+        self.horizontal, self.vertical = field
+        self.n = 0
+        self.yaw = 0.0
+
+    def heading(self):
+        return math.degrees(self.yaw) % 360.0
+
+    def read(self):
+        if self.count is not None and self.n >= self.count:
+            raise EOFError
+        if self.i2c_latency:
+            time.sleep(self.i2c_latency)
+        t = self.n * self.period_us / 1e6
+        ts = self.start_us + int(round(self.n * self.period_us))
+        self.n += 1
+
+        roll = self.tilt * math.sin(self.wobble * t)
+        pitch = self.tilt * math.cos(self.wobble * t)
+        self.yaw = self.rotation * t
+        sr, cr = math.sin(roll), math.cos(roll)
+        sp, cp = math.sin(pitch), math.cos(pitch)
+
+        # Field in the level frame, rotated into the body frame (inverse of
+        # the tilt compensation in lsm303_heading)
+        hx = self.horizontal * math.cos(self.yaw)
+        hy = self.horizontal * math.sin(self.yaw)
+        hz = self.vertical
+        mag = (cp * hx - sp * hz,
+               sr * sp * hx + cr * hy + sr * cp * hz,
+               cr * sp * hx - sr * hy + cr * cp * hz)
+        g = self.gravity
+        accel = (-sp * g, sr * cp * g, cr * cp * g)
+
+        gauss = self.rng.gauss
+        noise = self.noise
+        accel = tuple(int(round(v + gauss(0.0, noise))) for v in accel)
+        mag = tuple(int(round(v + gauss(0.0, noise))) for v in mag)
+        return ts, accel, mag
+
+
+class ReplaySource(SensorSource):
+    paced = True
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.store = None
+        self.file = None
+        if os.path.isdir(path):
+            self.store = CaptureReader(path)
+        else:
+            self.file = open(path, 'rb')
+            self.reader = FrameReader()
+        self.chunks = self._chunks()
+        self.pending = []
+        self.index = 0
+        self.first_ts = None
+        self.start = None
+
+    def _chunks(self):
+        # Lists of (ts, accel, mag) from the capture, a few thousand at a time
+        if self.store is not None:
+            for chunk in self.store.chunks():
+                yield list(zip(chunk['ts'].tolist(), chunk['accel'].tolist(),
+                               chunk['mag'].tolist()))
+            return
+        while True:
+            data = self.file.read(65536)
+            if not data:
+                return
+            yield [(ts, accel, mag) for frame in self.reader.feed(data)
+                   for ts, heading, accel, mag in frame.records()]
+
+    def _refill(self):
+        while self.index >= len(self.pending):
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                if not self.loop:
+                    raise EOFError
+                if self.file is not None:
+                    self.file.seek(0)
+                    self.reader = FrameReader()
+                self.chunks = self._chunks()
+                self.first_ts = None
+                self.pending = []
+            self.index = 0
+
+    def read(self):
+        self._refill()
+        ts, accel, mag = self.pending[self.index]
+        self.index += 1
+        if self.speed > 0:
+            if self.first_ts is None:
+                self.first_ts = ts
+                self.start = time.monotonic()
+            due = self.start + (ts - self.first_ts) / 1e6 / self.speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return ts, accel, mag
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+        else:
+            self.file.close()
+
+
+def open_source(spec, rate_hz=100.0, speed=1.0):
+    # 'adafruit[:busnum]', 'fifo[:busnum]', 'sim' or 'replay:<path>'
+    kind, _, arg = spec.partition(':')
+    if kind == 'adafruit':
+        return AdafruitSource(int(arg) if arg else None)
+    if kind == 'sim':
+        return SimulatedSource(rate_hz)
+    if kind == 'replay':
+        return ReplaySource(arg, speed)
+    if kind == 'fifo':
+        from lsm303_i2c import FifoSource
+        return FifoSource(int(arg) if arg else 1)
+    raise ValueError("unknown sensor source %r" % spec)
+
+
+def record(source, path, count=None, rate_hz=None):
+    # Write samples from source into a capture directory, paced at rate_hz
+    # if given (for the real sensor); returns the number of samples written.
+    # An existing capture is appended to
+    sched = None
+    if rate_hz:
+        sched = RateScheduler(rate_hz)
+    writer = CaptureWriter(path)
+    start = writer.count
+    try:
+        for ts, accel, mag in source:
+            if sched is not None:
+                sched.wait()
+            writer.append(ts, 0.0, accel, mag)
+            if count is not None and writer.count - start >= count:
+                break
+    finally:
+        writer.close()
+    return writer.count - start
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Record or replay LSM303 captures')
+    parser.add_argument('mode', choices=['sim', 'adafruit', 'replay'])
+    parser.add_argument('path')
+    parser.add_argument('--rate', type=float, default=100.0)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--speed', type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.mode == 'replay':
+        source = ReplaySource(args.path, args.speed)
+        start = time.monotonic()
+        n = sum(1 for _ in source)
+        elapsed = time.monotonic() - start
+        print("{0} samples in {1:.2f} s ({2:.0f} samples/s)".format(
+            n, elapsed, n / elapsed))
+    else:
+        if args.mode == 'sim':
+            source = SimulatedSource(args.rate)
+            rate = None
+        else:
+            source = AdafruitSource()
+            rate = args.rate
+        n = record(source, args.path, int(args.seconds * args.rate),
+                   rate_hz=rate)
+        print("{0} samples written to {1}".format(n, args.path))
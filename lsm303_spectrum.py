@@ -0,0 +1,349 @@
+# Streaming power spectra of LSM303 (or ADC) sample streams.
+#
+# fft_radix2() is the decimation-in-frequency radix-2 FFT of fft.c
+# (butterflies X[i] + X[IP] and (X[i] - X[IP]) * U with U stepping by
+# W = exp(-j pi / LE1), followed by the bit-reversal shuffle), generalized
+# from 4 points to any power of two and vectorized: each stage is a handful
+# of NumPy operations over every butterfly of every window at once.
+#
+# SpectrumStage cuts a stream into windows of `size` samples with the given
+# overlap, applies a window function and returns the one-sided power
+# spectrum of every complete window. Samples can be fed in any block size;
+# all windows that complete within a block are computed in one batch.
+#
+# When only a few bins are wanted (a motor's rotation frequency, mains hum)
+# a full FFT is wasted work and the stage switches to one of two fast paths:
+#
+#   'dft'      one dot product per bin and window, with the window folded
+#              into the coefficients; the result Goertzel's recurrence
+#              gives, with NumPy doing the N-sample loop as a matrix product
+#   'sliding'  sliding DFT, O(bins) per input sample whatever the window
+#              size; pays off when windows overlap heavily (small hops)
+#
+# All window functions are periodic cosine sums, so the sliding DFT applies
+# them exactly by combining neighbouring bins, and all three paths give the
+# same numbers.
+#
+#   python3 lsm303_spectrum.py      # windows/s and CPU per second at 1 kSPS
+import numpy as np
+
+# Cosine-sum coefficients: w[n] = a0 - a1 cos(2 pi n / N) + a2 cos(4 pi n / N)
+WINDOWS = {
+    'rect': (1.0,),
+    'hann': (0.5, 0.5),
+    'hamming': (0.54, 0.46),
+    'blackman': (0.42, 0.5, 0.08),
+}
+
+CHANNELS = {'ax': ('accel', 0), 'ay': ('accel', 1), 'az': ('accel', 2),
+            'mx': ('mag', 0), 'my': ('mag', 1), 'mz': ('mag', 2),
+            'heading': ('heading', 0)}
+
+_plans = {}
+
+
+def _plan(n):
+    # Twiddles per stage and the bit-reversal permutation for an n-point FFT
+    plan = _plans.get(n)
+    if plan is not None:
+        return plan
+    m = n.bit_length() - 1
+    if n < 1 or 1 << m != n:
+        raise ValueError("FFT size must be a power of two, not %d" % n)
+    twiddles = []
+    for k in range(m):
+        le1 = (n >> k) // 2
+        twiddles.append(np.exp(-1j * np.pi * np.arange(le1) / le1))
+    rev = np.zeros(n, dtype=np.intp)
+    for bit in range(m):
+        rev |= ((np.arange(n) >> bit) & 1) << (m - 1 - bit)
+    plan = _plans[n] = (twiddles, rev)
+    return plan
+
+
+def fft_radix2(x):
+    # DFT over the last axis (a power of two), same result as np.fft.fft
+    x = np.array(x, dtype=np.complex128)
+    n = x.shape[-1]
+    lead = x.shape[:-1]
+    twiddles, rev = _plan(n)
+    for k, u in enumerate(twiddles):
+        le = n >> k
+        v = x.reshape(lead + (n // le, 2, le // 2))
+        top = v[..., 0, :]
+        bottom = v[..., 1, :]
+        diff = top - bottom
+        top += bottom
+        np.multiply(diff, u, out=bottom)
+    return x[..., rev]
+
+
+def rfft_radix2(x):
+    # One-sided DFT (bins 0..N/2) of real input over the last axis, from an
+    # N/2-point complex FFT of the even samples + j * the odd samples
+    x = np.asarray(x, dtype=np.float64)
+    n = x.shape[-1]
+    half = n // 2
+    z = fft_radix2(x[..., 0::2] + 1j * x[..., 1::2])
+    z = np.concatenate((z, z[..., :1]), axis=-1)
+    zr = np.conj(z[..., ::-1])
+    even = (z + zr) / 2
+    odd = (z - zr) / 2j
+    return even + np.exp(-2j * np.pi * np.arange(half + 1) / n) * odd
+
+
+def window_function(name, size):
+    coeffs = WINDOWS[name]
+    n = np.arange(size)
+    w = np.zeros(size)
+    for m, a in enumerate(coeffs):
+        w += (-1) ** m * a * np.cos(2 * np.pi * m * n / size)
+    return w
+
+
+def ring_signal(ring, start, end=None, channel='az'):
+    # One channel of ring positions [start, end) as float64
+    field, axis = CHANNELS[channel]
+    parts = []
+    for index, count in ring.segments(start, end):
+        view = ring.views(index, count)[('ts', 'heading', 'accel',
+                                         'mag').index(field)]
+        if field == 'heading':
+            parts.append(np.frombuffer(view, dtype=np.float32))
+        else:
+            parts.append(np.frombuffer(view, dtype=np.int16)[axis::3])
+    if not parts:
+        return np.zeros(0)
+    return np.concatenate(parts).astype(np.float64)
+
+
+class SpectrumStage(object):
+    def __init__(self, size=256, overlap=0.5, window='hann', rate=1000.0,
+                 bins=None, method=None, channel='az'):
+        if window not in WINDOWS:
+            raise ValueError("unknown window %r" % window)
+        self.size = size
+        self.hop = max(1, size - int(round(size * overlap)))
+        self.window_name = window
+        self.window = window_function(window, size)
+        self.rate = rate
+        self.channel = channel
+        # |X|^2 / (sum w)^2, doubled off DC and Nyquist, gives the power of
+        # a sinusoid centred on a bin
+        self.scale = 1.0 / self.window.sum() ** 2
+        if bins is None:
+            self.bins = np.arange(size // 2 + 1)
+        else:
+            self.bins = np.unique(np.round(np.asarray(bins, dtype=np.float64)
+                                           * size / rate).astype(np.intp))
+            if self.bins.min() < 0 or self.bins.max() > size // 2:
+                raise ValueError("bins must lie within 0..rate/2")
+        self.onesided = np.where((self.bins == 0) | (self.bins == size // 2),
+                                 1.0, 2.0) * self.scale
+        if method is None:
+            method = self._choose()
+        if method not in ('fft', 'dft', 'sliding'):
+            raise ValueError("unknown method %r" % method)
+        if method == 'fft':
+            _plan(size)
+        self.method = method
+        self._setup()
+        self.buf = np.zeros(0)
+        self.start = 0
+        self.next_end = size
+        self.windows = 0
+        # Spectrum of the latest window
+        self.last = None
+
+    def _choose(self):
+        # Rough cost per input sample of each path, in complex multiply-adds;
+        # the dft path is one BLAS matrix product, several times faster per
+        # operation than the others
+        size = self.size
+        k = len(self.bins)
+        fft = size * (size.bit_length() - 1) / 2.0 / self.hop
+        dft = size * k / float(self.hop) / 8.0
+        sliding = 4.0 * k * (2 * len(WINDOWS[self.window_name]) - 1)
+        if k == size // 2 + 1:
+            return 'fft'
+        return min((fft, 'fft'), (dft, 'dft'), (sliding, 'sliding'))[1]
+
+    def _setup(self):
+        size = self.size
+        if self.method == 'dft':
+            n = np.arange(size)
+            self.kernel = (self.window[:, None] *
+                           np.exp(-2j * np.pi * np.outer(n, self.bins) / size))
+        elif self.method == 'sliding':
+            # Rectangular bins needed to apply the window in frequency
+            coeffs = WINDOWS[self.window_name]
+            needed = set()
+            for k in self.bins:
+                for m in range(len(coeffs)):
+                    needed.add((k - m) % size)
+                    needed.add((k + m) % size)
+            self.raw_bins = np.array(sorted(needed), dtype=np.intp)
+            slot = dict((k, i) for i, k in enumerate(self.raw_bins))
+            # bins x raw_bins mixing matrix
+            mix = np.zeros((len(self.bins), len(self.raw_bins)))
+            for row, k in enumerate(self.bins):
+                for m, a in enumerate(coeffs):
+                    c = (-1) ** m * a * (1.0 if m == 0 else 0.5)
+                    mix[row, slot[(k - m) % size]] += c
+                    if m:
+                        mix[row, slot[(k + m) % size]] += c
+            self.mix = mix
+            n = np.arange(size)
+            self.rotate = np.exp(-2j * np.pi * np.outer(n, self.raw_bins)
+                                 / size)
+
+    def freqs(self):
+        return self.bins * self.rate / self.size
+
+    def peak(self, power):
+        # (frequency, power) of the strongest bin of one spectrum, leaving
+        # out DC and its main lobe (gravity on an accelerometer axis)
+        lobe = len(WINDOWS[self.window_name])
+        usable = np.nonzero(self.bins >= lobe)[0]
+        if not len(usable):
+            return None
+        i = usable[np.argmax(power[usable])]
+        return float(self.bins[i] * self.rate / self.size), float(power[i])
+
+    def feed(self, samples):
+        # Append samples; returns (ends, power): the absolute sample index
+        # just past each completed window and its power per bin
+        self.buf = np.concatenate((self.buf,
+                                   np.asarray(samples, dtype=np.float64)))
+        total = self.start + len(self.buf)
+        if total < self.next_end:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(self.bins)))
+        n = (total - self.next_end) // self.hop + 1
+        first = self.next_end - self.size - self.start
+        ends = self.next_end + self.hop * np.arange(n, dtype=np.int64)
+        power = getattr(self, '_' + self.method)(first, n)
+        self.next_end += n * self.hop
+        drop = self.next_end - self.size - self.start
+        self.buf = self.buf[drop:]
+        self.start += drop
+        self.windows += n
+        self.last = power[-1]
+        return ends, power
+
+    def _frames(self, first, n):
+        # (n, size) view of the windows, no copy
+        buf = self.buf[first:]
+        return np.lib.stride_tricks.as_strided(
+            buf, shape=(n, self.size),
+            strides=(self.hop * buf.strides[0], buf.strides[0]),
+            writeable=False)
+
+    def _fft(self, first, n):
+        spectrum = rfft_radix2(self._frames(first, n) * self.window)
+        return (spectrum.real ** 2 + spectrum.imag ** 2) * self.onesided
+
+    def _dft(self, first, n):
+        spectrum = self._frames(first, n) @ self.kernel
+        return (spectrum.real ** 2 + spectrum.imag ** 2) * self.onesided
+
+    def _sliding(self, first, n):
+        # Running sums of x[m] e^(-j 2 pi k m / N) over the block: a window
+        # starting at s is the difference of two sums, turned back to start
+        # at phase 0. Sums restart every call, so rounding does not build up
+        # over a long stream.
+        size = self.size
+        span = (n - 1) * self.hop + size
+        x = self.buf[first:first + span]
+        m = np.arange(span) % size
+        sums = np.zeros((span + 1, len(self.raw_bins)), dtype=np.complex128)
+        np.cumsum(x[:, None] * self.rotate[m], axis=0, out=sums[1:])
+        starts = self.hop * np.arange(n)
+        raw = (sums[starts + size] - sums[starts]) * \
+            np.conj(self.rotate[starts % size])
+        spectrum = raw @ self.mix.T
+        return (spectrum.real ** 2 + spectrum.imag ** 2) * self.onesided
+
+    def feed_ring(self, ring, pos):
+        # Feed `channel` of ring positions [pos, ring.head); returns
+        # (new pos, ends, power)
+        ends, power = self.feed(ring_signal(ring, pos, channel=self.channel))
+        return ring.head, ends, power
+
+
+def _bench(rate=1000.0, seconds=60.0, size=256, block=50):
+    import time
+
+    rng = np.random.RandomState(242)
+    t = np.arange(int(rate * seconds)) / rate
+    # Accel z at 1 kSPS: gravity, a 47 Hz motor vibration, a weaker 120 Hz
+    # component and sensor noise, in counts
+    signal = (1000 + 40 * np.sin(2 * np.pi * 47 * t) +
+              10 * np.sin(2 * np.pi * 120 * t) + rng.normal(0, 4, len(t)))
+    tracked = [47.0, 120.0]
+
+    def run(stage):
+        start = time.process_time()
+        outputs = []
+        for i in range(0, len(signal), block):
+            ends, power = stage.feed(signal[i:i + block])
+            if len(ends):
+                outputs.append(power)
+        cpu = time.process_time() - start
+        return np.concatenate(outputs), cpu
+
+    print("{0:.0f} SPS, {1} point windows, fed {2} samples at a time, "
+          "{3:.0f} s of input".format(rate, size, block, seconds))
+    print("{0:34s} {1:>10s} {2:>11s} {3:>14s}".format(
+        'path', 'windows/s', 'needed/s', 'CPU ms per s'))
+    for overlap, label in ((0.5, '50% overlap'), (1 - 1.0 / size, 'hop 1')):
+        full, cpu = run(SpectrumStage(size, overlap, 'hann', rate))
+        ref_stage = SpectrumStage(size, overlap, 'hann', rate)
+        hop = ref_stage.hop
+        needed = rate / hop
+        rows = [('fft, all bins, ' + label, len(full), cpu)]
+        results = {}
+        for method in ('dft', 'sliding'):
+            power, cpu = run(SpectrumStage(size, overlap, 'hann', rate,
+                                           bins=tracked, method=method))
+            rows.append(('%s, %d bins, %s' % (method, len(tracked), label),
+                         len(power), cpu))
+            results[method] = power
+        for name, windows, cpu in rows:
+            print("{0:34s} {1:10.0f} {2:11.1f} {3:14.2f}".format(
+                name, windows / cpu, needed, cpu / seconds * 1000))
+        bins = ref_stage.bins
+        picked = full[:, np.round(np.array(tracked) * size / rate).astype(int)]
+        for method, power in results.items():
+            err = np.abs(power - picked).max() / picked.max()
+            print("  {0} vs fft on tracked bins: max rel error {1:.1e}".format(
+                method, err))
+        assert len(bins) == size // 2 + 1
+
+    x = rng.normal(size=(64, size))
+    err = np.abs(rfft_radix2(x) - np.fft.rfft(x)).max()
+    start = time.process_time()
+    for _ in range(100):
+        np.fft.rfft(x * ref_stage.window)
+    numpy_rate = 6400 / (time.process_time() - start)
+    start = time.process_time()
+    for _ in range(100):
+        rfft_radix2(x * ref_stage.window)
+    ours_rate = 6400 / (time.process_time() - start)
+    print("rfft_radix2: {0:.0f} windows/s in batches of 64 (np.fft.rfft "
+          "{1:.0f}), max abs error {2:.1e}".format(
+              ours_rate, numpy_rate, err))
+    freq, power = ref_stage.peak(full.mean(axis=0))
+    print("strongest line {0:.1f} Hz, {1:.0f} counts^2 (40 count sine: 800 "
+          "less scalloping)".format(freq, power))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Streaming power spectrum benchmark')
+    parser.add_argument('--rate', type=float, default=1000.0)
+    parser.add_argument('--seconds', type=float, default=60.0)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--block', type=int, default=50)
+    args = parser.parse_args()
+    _bench(args.rate, args.seconds, args.size, args.block)
@@ -0,0 +1,307 @@
+# Append-only, memory-mapped columnar capture files for LSM303 samples.
+#
+# A capture is a directory with one raw file per column:
+#
+#   ts.u64       timestamp in microseconds
+#   heading.f32  heading in degrees
+#   accel.i16    accel x, y, z per sample
+#   mag.i16      mag x, y, z per sample
+#   index.u64    timestamp of every INDEX_STRIDE-th sample (time index)
+#   count.u64    number of complete samples, updated after every append
+#   meta.json    layout and byte order
+#
+# The writer preallocates each file in chunks and maps it, so appending a
+# batch is a memcpy from the sample ring into the page cache; the kernel
+# writes it back in its own time and the sampling loop never waits on disk.
+# The reader maps the same files and returns time windows as NumPy views
+# into them, without parsing or copying. The count file is written last so
+# a crashed capture is still readable up to its last complete batch.
+#
+# Opening a writer on an existing capture appends after its last
+# complete sample (a restarted recorder or collector carries on where it
+# stopped); truncate=True starts the capture over.
+#
+#   python3 lsm303_store.py /tmp/capture --seconds 3600 --rate 1000
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+
+INDEX_STRIDE = 1024
+CHUNK = 1 << 16
+
+# name, array typecode, values per sample
+COLUMNS = (('ts', 'Q', 1), ('heading', 'f', 1), ('accel', 'h', 3),
+           ('mag', 'h', 3))
+SUFFIX = {'Q': 'u64', 'f': 'f32', 'h': 'i16'}
+SIZE = {'Q': 8, 'f': 4, 'h': 2}
+DTYPE = {'Q': '<u8', 'f': '<f4', 'h': '<i2'}
+
+
+class _Column(object):
+    # One preallocated, memory-mapped column file, grown by `chunk` rows
+    def __init__(self, path, typecode, width, chunk):
+        self.itemsize = SIZE[typecode] * width
+        self.chunk = chunk
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.map = None
+        # Rows already in the file (reopened capture) are kept
+        self.capacity = os.fstat(self.fd).st_size // self.itemsize
+        if self.capacity:
+            self.map = mmap.mmap(self.fd, self.capacity * self.itemsize)
+        self.ensure(chunk)
+
+    def ensure(self, rows):
+        if rows <= self.capacity:
+            return
+        capacity = (rows + self.chunk - 1) // self.chunk * self.chunk
+        if self.map is not None:
+            self.map.close()
+        os.ftruncate(self.fd, capacity * self.itemsize)
+        self.map = mmap.mmap(self.fd, capacity * self.itemsize)
+        self.capacity = capacity
+
+    def write(self, row, buf):
+        buf = memoryview(buf).cast('B')
+        start = row * self.itemsize
+        self.map[start:start + len(buf)] = buf
+
+    def close(self, rows):
+        self.map.close()
+        os.ftruncate(self.fd, rows * self.itemsize)
+        os.close(self.fd)
+
+
+class CaptureWriter(object):
+    def __init__(self, path, chunk=CHUNK, truncate=False):
+        if sys.byteorder != 'little':
+            raise RuntimeError("capture files are little-endian only")
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        count = 0
+        count_path = os.path.join(path, 'count.u64')
+        if not truncate and os.path.exists(count_path):
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            if meta['columns'] != [list(c) for c in COLUMNS] or \
+               meta['index_stride'] != INDEX_STRIDE:
+                raise RuntimeError("%s has another capture layout" % path)
+            with open(count_path, 'rb') as f:
+                count = struct.unpack('<Q', f.read(8))[0]
+        self.columns = {}
+        for name, typecode, width in COLUMNS:
+            self.columns[name] = _Column(
+                os.path.join(path, '%s.%s' % (name, SUFFIX[typecode])),
+                typecode, width, chunk)
+        self.index = _Column(os.path.join(path, 'index.u64'), 'Q', 1,
+                             max(1, chunk // INDEX_STRIDE))
+        with open(count_path, 'wb') as f:
+            f.write(struct.pack('<Q', count))
+        fd = os.open(count_path, os.O_RDWR)
+        self.count_map = mmap.mmap(fd, 8)
+        os.close(fd)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'version': 1, 'byteorder': 'little',
+                       'index_stride': INDEX_STRIDE,
+                       'columns': [list(c) for c in COLUMNS]}, f)
+        self.count = count
+
+    def _commit(self, n):
+        start = self.count
+        self.count += n
+        # Time index entries for any stride boundary in the new rows
+        first = (start + INDEX_STRIDE - 1) // INDEX_STRIDE
+        ts = self.columns['ts'].map
+        for k in range(first, (self.count - 1) // INDEX_STRIDE + 1):
+            self.index.ensure(k + 1)
+            row = k * INDEX_STRIDE
+            self.index.map[8 * k:8 * k + 8] = ts[8 * row:8 * row + 8]
+        struct.pack_into('<Q', self.count_map, 0, self.count)
+
+    def append(self, ts, heading, accel, mag):
+        row = self.count
+        cols = self.columns
+        for column in cols.values():
+            column.ensure(row + 1)
+        struct.pack_into('<Q', cols['ts'].map, 8 * row, ts)
+        struct.pack_into('<f', cols['heading'].map, 4 * row, heading)
+        struct.pack_into('<3h', cols['accel'].map, 6 * row, *accel)
+        struct.pack_into('<3h', cols['mag'].map, 6 * row, *mag)
+        self._commit(1)
+
+    def append_columns(self, count, ts, heading, accel, mag):
+        # Append `count` samples given as little-endian column buffers
+        # (ring views, or slices of a FLAG_COLUMNS frame payload)
+        row = self.count
+        cols = self.columns
+        for column in cols.values():
+            column.ensure(row + count)
+        cols['ts'].write(row, ts)
+        cols['heading'].write(row, heading)
+        cols['accel'].write(row, accel)
+        cols['mag'].write(row, mag)
+        self._commit(count)
+
+    def append_ring(self, ring, pos):
+        # Copy ring positions [pos, ring.head) into the capture; returns the
+        # new position. This is the only copy on the recording path.
+        for index, count in ring.segments(pos):
+            self.append_columns(count, *ring.views(index, count))
+        return ring.head
+
+    def flush(self):
+        # Force the data to disk; not needed for crash safety against a
+        # process crash, only against power loss
+        for column in self.columns.values():
+            column.map.flush()
+        self.index.map.flush()
+        self.count_map.flush()
+
+    def close(self):
+        for column in self.columns.values():
+            column.close(self.count)
+        self.index.close((self.count + INDEX_STRIDE - 1) // INDEX_STRIDE)
+        self.count_map.close()
+
+
+class CaptureReader(object):
+    # Columns come back as NumPy arrays viewing the mapped files; they stay
+    # valid until close()
+    def __init__(self, path):
+        import numpy as np
+        self.np = np
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.stride = self.meta['index_stride']
+        self.maps = []
+        self.cols = {}
+        self.refresh()
+
+    def _map(self, name):
+        fd = os.open(os.path.join(self.path, name), os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0:
+                return b''
+            m = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self.maps.append(m)
+        return m
+
+    def refresh(self):
+        # Pick up rows appended since the last call (for a live capture)
+        np = self.np
+        self.close()
+        with open(os.path.join(self.path, 'count.u64'), 'rb') as f:
+            self.count = struct.unpack('<Q', f.read(8))[0]
+        self.cols = {}
+        for name, typecode, width in COLUMNS:
+            m = self._map('%s.%s' % (name, SUFFIX[typecode]))
+            col = np.frombuffer(m, dtype=DTYPE[typecode],
+                                count=self.count * width)
+            if width > 1:
+                col = col.reshape(-1, width)
+            self.cols[name] = col
+        n_index = (self.count + self.stride - 1) // self.stride
+        self.index = np.frombuffer(self._map('index.u64'), dtype='<u8',
+                                   count=n_index).tolist()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        return self.cols[name]
+
+    def slice(self, start, end):
+        return dict((name, col[start:end]) for name, col in self.cols.items())
+
+    def locate(self, t):
+        # First row with ts >= t: bisect the sparse index, then search one
+        # stride of the mapped timestamp column
+        k = bisect.bisect_left(self.index, t)
+        if k == 0:
+            return 0
+        lo = (k - 1) * self.stride
+        hi = min(self.count, k * self.stride + 1)
+        ts = self.cols['ts']
+        return lo + int(self.np.searchsorted(ts[lo:hi], t))
+
+    def window(self, t0, t1):
+        # Rows with t0 <= ts < t1, as views
+        return self.slice(self.locate(t0), self.locate(t1))
+
+    def chunks(self, size=4096):
+        for start in range(0, self.count, size):
+            yield self.slice(start, min(start + size, self.count))
+
+    def close(self):
+        self.cols = {}
+        for m in self.maps:
+            try:
+                m.close()
+            except BufferError:
+                # A caller still holds a view; the map goes with it
+                pass
+        self.maps = []
+
+
+def _bench(path, seconds, rate):
+    import time
+
+    import numpy as np
+
+    from lsm303_ring import SampleRing
+    from lsm303_source import SimulatedSource
+
+    n = int(seconds * rate)
+    ring = SampleRing(4096)
+    source = SimulatedSource(rate, noise=0.0, start_us=0)
+    # One second of simulated samples, repeated with shifted timestamps
+    block = [source.read() for _ in range(int(rate))]
+
+    writer = CaptureWriter(path, truncate=True)
+    pos = 0
+    worst = 0.0
+    start = time.perf_counter()
+    for i in range(n):
+        ts, accel, mag = block[i % len(block)]
+        ring.append(ts + (i // len(block)) * 1000000, 0.0, accel, mag)
+        if ring.head - pos >= 256:
+            t = time.perf_counter()
+            pos = writer.append_ring(ring, pos)
+            worst = max(worst, time.perf_counter() - t)
+    pos = writer.append_ring(ring, pos)
+    writer.close()
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(os.path.join(path, f))
+               for f in os.listdir(path))
+    print("wrote {0} samples ({1:.0f} s at {2:.0f} Hz) in {3:.2f} s, "
+          "{4:.1f} MB".format(n, seconds, rate, elapsed, size / 1e6))
+    print("append of 256 samples: worst {0:.0f} us".format(worst * 1e6))
+
+    reader = CaptureReader(path)
+    t0 = int(seconds / 2 * 1e6)
+    start = time.perf_counter()
+    for k in range(1000):
+        w = reader.window(t0 + k * 1000, t0 + k * 1000 + 1000000)
+    lookup = (time.perf_counter() - start) / 1000
+    assert np.all(w['ts'] >= t0 + 999000) and len(w['ts']) == int(rate)
+    print("1 s window lookup: {0:.1f} us ({1} rows, no copy)".format(
+        lookup * 1e6, len(w['ts'])))
+    reader.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Write and read back a simulated LSM303 capture')
+    parser.add_argument('path')
+    parser.add_argument('--seconds', type=float, default=600)
+    parser.add_argument('--rate', type=float, default=1000)
+    args = parser.parse_args()
+    _bench(args.path, args.seconds, args.rate)
@@ -1,59 +1,304 @@
  # the LSM303 accelerometer & magnetometer library.
-# Will print the accelerometer & magnetometer X, Y, Z axis values every half
-# second.
+# Streams the accelerometer & magnetometer X, Y, Z axis values and heading
+# to the receiver, --rate samples per second (RATE_HZ by default).
 # Author: Liuting Chen
 # 
-import time
-import math
+# The sensor is reached through a sample source (see lsm303_source.py), so
+# the same loop runs against the board, a simulator or a recorded capture:
+#   python3 lsm303_tcp.py                            # Adafruit_LSM303 driver
+#   python3 lsm303_tcp.py --source sim --speed 50    # simulator, 50x real time
+#   python3 lsm303_tcp.py --source replay:run1 --host 127.0.0.1
+#   python3 lsm303_tcp.py --record run2     # also keep a local capture
+#
+# Captures are lsm303_store directories: the ring is appended to the mapped
+# column files batch by batch, so recording costs a memcpy per batch.
+#
+# Per-sample printing is off unless --verbose is given; instead the I2C
+# read, heading compute, send and ack round-trip times go into histograms
+# (lsm303_metrics.py) whose percentiles are reported every --metrics-window
+# seconds to stdout, a JSON lines file, a Unix socket or an HTTP endpoint.
+#
+# The link may come and go: samples are queued (in memory, spilling to
+# --spill-dir) and forwarded by lsm303_forward.ForwardSender, which
+# reconnects with backoff and catches up on the backlog, so a Wi-Fi drop
+# no longer ends the run.
+#
+# --spectrum az (or ax, ay, mx, ..., heading) runs that channel through a
+# streaming power spectrum (lsm303_spectrum.py) and adds the strongest line
+# of each metrics window to the report.
+#
+# --fusion complementary (or madgwick) filters roll, pitch and heading
+# together (lsm303_fusion.py) and sends the fused heading instead of the
+# per-sample tilt-compensated one.
+#
+# --compress sends delta/varint coded blocks instead of fixed records
+# (lsm303_delta.py); --heading-step/--count-step quantize, --deadband holds
+# back samples that did not change, with a keyframe every --keyframe s.
+# The collector decodes them transparently.
+#
+# --transport udp sends MTU-sized datagrams instead (lsm303_udp.py); with a
+# multicast group as --host, every consumer gets the stream from one send.
+import argparse
 import socket
+import time
 
-# Import the LSM303 module.
-import Adafruit_LSM303
+from lsm303_forward import DROP_NEWEST, DROP_OLDEST, ForwardSender, SampleQueue
+from lsm303_delta import DeltaEncoder
+from lsm303_fusion import FILTERS
+from lsm303_heading import Calibration, ring_headings
+from lsm303_metrics import FileSink, HttpEndpoint, Metrics, UnixSink
+from lsm303_ring import SampleRing
+from lsm303_sched import RateScheduler
+from lsm303_source import open_source
+from lsm303_spectrum import CHANNELS, SpectrumStage
+from lsm303_store import CaptureWriter
+from lsm303_udp import UdpSender
 
 #set up the receiver IP address
 #IP_ADDR = '192.168.1.27'
 IP_ADDR = '192.168.2.3'
 PORT = 3001
-BUFFERSIZE = 1024
-
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect((IP_ADDR, PORT))
-
-# Create a LSM303 instance.
-lsm303 = Adafruit_LSM303.LSM303()
-pi = 3.14159
-
-# Alternatively you can specify the I2C bus with a bus parameter:
-#lsm303 = Adafruit_LSM303.LSM303(busum=2)
-
-print('Printing accelerometer & magnetometer X, Y, Z axis values, press Ctrl-C to quit...')
-while True:
-    # Read the X, Y, Z axis acceleration values and print them.
-    accel = lsm303.read_accel()
-    mag = lsm303.read_mag()
-    # Grab the X, Y, Z components from the reading and print them out.
-    accel_x, accel_y, accel_z = accel 
-    mag_x, mag_y, mag_z = mag
-    time_cur = int(round(time.time() * 1000000))
-    time_str = str(time_cur)
-    #print("the current time is:", time_str)
-    #s.sendto(time_str.encode('utf-8'), (IP_ADDR, PORT))
-    # Calculate the angle of the vector x, y
-    heading_f = (math.atan2(mag_y, mag_x) * 180) / pi
-
-    if heading_f < 0:
-        heading_f = 360 + heading_f
-    #print('Accel X={0}, Accel Y={1}, Accel Z={2}, Mag X={3}, Mag Y={4}, Mag Z={5}'.format(
-         # accel_x, accel_y, accel_z, mag_x, mag_y, mag_z))
-    heading_int = int(heading_f)
-    heading_str = str(heading_int)
-    complete_str=heading_str +" "+ time_str
-    #s.sendto(heading_str.encode('utf-8'),(IP_ADDR, PORT))
-    s.sendto(complete_str.encode('utf-8'),(IP_ADDR, PORT))
-    print(complete_str)
-    # Wait half a second and repeat.
-   # time.sleep(0.5)
-    data_recv = s.recv(1024)
-    time_recv=int(round(time.time() * 1000000))
-    print("RTT wifi : " +str(time_recv-time_cur))
-    #print("--------------------the data received is : ", data_recv)
+
+# Samples go out as packed binary records, BATCH per frame, with up to
+# WINDOW frames awaiting an ack (see lsm303_wire.py for the receiver)
+BATCH = 32
+WINDOW = 16
+
+# Samples are stored in a preallocated ring and sent from it in place,
+# once BATCH are pending or the oldest has waited MAX_DELAY seconds
+MAX_DELAY = 0.05
+
+# Sampling rate; ticks are scheduled on absolute deadlines so the rate does
+# not drift, and missed ticks are counted instead of silently slowing down
+RATE_HZ = 100
+
+# Samples held while the link is down before spilling to disk (or dropping)
+QUEUE_MB = 8
+
+
+def report(metrics, sched, sender, sinks, spectrum=None, fusion=None):
+    extra = {'link': sender.stats()}
+    if fusion is not None and fusion.last is not None:
+        extra['orientation'] = dict(zip(('roll', 'pitch', 'heading'),
+                                        fusion.last))
+    # No peak until a window has completed, nor when the window is too
+    # short to leave any bin outside the DC lobe
+    peak = None
+    if spectrum is not None and spectrum.last is not None:
+        peak = spectrum.peak(spectrum.last)
+    if peak is not None:
+        extra['spectrum'] = {'channel': spectrum.channel, 'peak_hz': peak[0],
+                             'peak_power': peak[1]}
+    if sched is not None:
+        stats = sched.stats
+        extra['sampling'] = {'ticks': stats.ticks,
+                             'overruns': stats.overruns,
+                             'missed': stats.missed,
+                             'jitter_p99': stats.percentile(99) * 1e6,
+                             'jitter_max': stats.max * 1e6}
+    last = metrics.roll(extra)
+    if not sinks:
+        print(' '.join("{0} p50/p99/max {1:.0f}/{2:.0f}/{3:.0f} us".format(
+            name, last[name]['p50'], last[name]['p99'], last[name]['max'])
+            for name in ('i2c', 'compute', 'send', 'rtt')))
+        link = extra['link']
+        if 'orientation' in extra:
+            print("roll {roll:.1f} pitch {pitch:.1f} heading {heading:.1f} "
+                  "deg".format(**extra['orientation']))
+        if 'spectrum' in extra:
+            print("{channel} strongest line {peak_hz:.1f} Hz "
+                  "({peak_power:.1f})".format(**extra['spectrum']))
+        elif spectrum is not None:
+            print("{0} strongest line n/a".format(spectrum.channel))
+        if not link['connected'] or link['queued'] or link['dropped']:
+            print("link {0}: {1} samples queued, {2} spilled, {3} dropped".format(
+                'up' if link['connected'] else 'down', link['queued'],
+                link['spilled'], link['dropped']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Stream LSM303 samples to the receiver')
+    parser.add_argument('--host', default=IP_ADDR)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--transport', choices=['tcp', 'udp'], default='tcp',
+                        help='udp: datagrams to a host or multicast group, '
+                        'no acks or retransmits')
+    parser.add_argument('--mtu', type=int, default=1500,
+                        help='datagram size limit for --transport udp')
+    parser.add_argument('--iface', default='0.0.0.0',
+                        help='interface address to send multicast from')
+    parser.add_argument('--node', default=socket.gethostname(),
+                        help='name announced to the collector')
+    parser.add_argument('--source', default='adafruit',
+                        help="adafruit[:busnum], fifo[:busnum], sim or replay:<path>")
+    parser.add_argument('--record', help='also write a capture to this directory')
+    parser.add_argument('--queue-mb', type=float, default=QUEUE_MB,
+                        help='memory for samples waiting on the link')
+    parser.add_argument('--spill-dir',
+                        help='spill the queue here once memory is full')
+    parser.add_argument('--drop', choices=[DROP_OLDEST, DROP_NEWEST],
+                        default=DROP_OLDEST,
+                        help='what to drop when the queue is full')
+    parser.add_argument('--compress', action='store_true',
+                        help='delta-encode samples (lossless unless the '
+                        'options below say otherwise)')
+    parser.add_argument('--heading-step', type=float,
+                        help='quantize headings to this many degrees')
+    parser.add_argument('--count-step', type=int, default=1,
+                        help='quantize accel/mag to this many counts')
+    parser.add_argument('--deadband', type=float, default=0.0,
+                        help='hold back samples whose heading moved less '
+                        'than this (degrees) ...')
+    parser.add_argument('--deadband-counts', type=int, default=0,
+                        help='... and whose accel/mag moved less than this')
+    parser.add_argument('--keyframe', type=float, default=1.0,
+                        help='send a sample at least this often (seconds)')
+    parser.add_argument('--spectrum', choices=sorted(CHANNELS),
+                        help='report the power spectrum peak of a channel')
+    parser.add_argument('--spectrum-size', type=int, default=256,
+                        help='spectrum window in samples (a power of two)')
+    parser.add_argument('--fusion', choices=sorted(FILTERS),
+                        help='filter the orientation instead of computing '
+                        'each heading on its own')
+    parser.add_argument('--rate', type=float, default=RATE_HZ,
+                        help='sampling rate in Hz')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='sim/replay speed-up, 0 for as fast as possible')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print every batch and ack')
+    parser.add_argument('--metrics-window', type=float, default=10.0)
+    parser.add_argument('--metrics-file', help='append reports as JSON lines')
+    parser.add_argument('--metrics-uds', help='send reports to a Unix socket')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve the latest report over HTTP')
+    args = parser.parse_args()
+    if args.heading_step or args.count_step > 1 or args.deadband or \
+            args.deadband_counts:
+        args.compress = True
+    if args.compress and args.transport == 'udp':
+        parser.error('--compress needs --transport tcp')
+
+    sinks = []
+    if args.metrics_file:
+        sinks.append(FileSink(args.metrics_file))
+    if args.metrics_uds:
+        sinks.append(UnixSink(args.metrics_uds))
+    if args.metrics_port:
+        sinks.append(HttpEndpoint(args.metrics_port))
+    metrics = Metrics(['i2c', 'compute', 'send', 'rtt'],
+                      args.metrics_window, sinks)
+    i2c_hist = metrics['i2c']
+    clock = time.perf_counter_ns
+
+    # Create a LSM303 instance.
+    # Alternatively you can specify the I2C bus with --source adafruit:2
+    lsm303 = open_source(args.source, args.rate, args.speed)
+
+    # Hard/soft-iron correction for the magnetometer; fill in the values from
+    # Calibration.fit() on samples taken while turning the board around
+    cal = Calibration()
+
+    if args.transport == 'udp':
+        sender = UdpSender((args.host, args.port), args.mtu, iface=args.iface)
+    else:
+        queue = SampleQueue(int(args.queue_mb * (1 << 20)), args.spill_dir,
+                            drop=args.drop)
+        encoder = None
+        if args.compress:
+            encoder = DeltaEncoder(args.heading_step, args.count_step,
+                                   args.deadband, args.deadband_counts,
+                                   args.keyframe)
+        sender = ForwardSender((args.host, args.port), queue, window=WINDOW,
+                               name=args.node, encoder=encoder)
+
+    ring = SampleRing(8 * BATCH)
+    sent_pos = 0
+    fusion = None
+    if args.fusion:
+        fusion = FILTERS[args.fusion](args.rate, cal=cal)
+    spectrum = None
+    if args.spectrum:
+        spectrum = SpectrumStage(args.spectrum_size, 0.5, 'hann', args.rate,
+                                 channel=args.spectrum)
+    writer = None
+    if args.record:
+        writer = CaptureWriter(args.record)
+    sent_at = 0.0
+
+    # Self-paced sources (replays) and speed 0 run without the scheduler
+    sched = None
+    if not lsm303.paced and args.speed > 0:
+        sched = RateScheduler(args.rate * args.speed)
+
+    print('Streaming accelerometer & magnetometer X, Y, Z axis values, press Ctrl-C to quit...')
+    start = time.monotonic()
+    while True:
+        if sched is not None:
+            sched.wait()
+        # Read the X, Y, Z axis acceleration and magnetometer values.
+        t0 = clock()
+        try:
+            time_cur, accel, mag = lsm303.read()
+        except EOFError:
+            break
+        t1 = clock()
+        i2c_hist.record(t1 - t0)
+        now = time.monotonic()
+        #print('Accel X={0}, Accel Y={1}, Accel Z={2}, Mag X={3}, Mag Y={4}, Mag Z={5}'.format(
+             # accel_x, accel_y, accel_z, mag_x, mag_y, mag_z))
+        # The heading is filled in for the whole batch just before sending:
+        # tilt-compensated with the accelerometer, in one vectorized pass
+        ring.append(time_cur, 0.0, accel, mag)
+        if ring.head - sent_pos >= BATCH or now - sent_at >= MAX_DELAY:
+            if fusion is not None:
+                fusion.feed_ring(ring, sent_pos)
+            else:
+                ring_headings(ring, sent_pos, cal=cal)
+            t2 = clock()
+            if writer is not None:
+                writer.append_ring(ring, sent_pos)
+            if spectrum is not None:
+                spectrum.feed_ring(ring, sent_pos)
+            sent_pos = sender.send_ring(ring, sent_pos)
+            t3 = clock()
+            metrics.record('compute', t2 - t1)
+            metrics.record('send', t3 - t2)
+            sent_at = now
+            if args.verbose:
+                heading_f = ring.heading[(ring.head - 1) % ring.capacity]
+                print("{0:.1f} {1}".format(heading_f, time_cur))
+        elif sender.in_flight:
+            # Pick up acks between batches so the rtt is not quantized to
+            # the batch interval
+            sender.pump()
+        if sender.rtt is not None:
+            metrics.record('rtt', int(sender.rtt * 1e9))
+            if args.verbose:
+                print("RTT wifi : " + str(int(sender.rtt * 1000000)))
+            sender.rtt = None
+        if metrics.due():
+            report(metrics, sched, sender, sinks, spectrum, fusion)
+
+    if fusion is not None:
+        fusion.feed_ring(ring, sent_pos)
+    else:
+        ring_headings(ring, sent_pos, cal=cal)
+    if writer is not None:
+        writer.append_ring(ring, sent_pos)
+        writer.close()
+    sender.send_ring(ring, sent_pos)
+    left = sender.close()
+    lsm303.close()
+    report(metrics, sched, sender, sinks, spectrum, fusion)
+    metrics.close()
+    elapsed = time.monotonic() - start
+    print("{0} samples in {1:.2f} s ({2:.0f} samples/s)".format(
+        ring.head, elapsed, ring.head / elapsed))
+    if left:
+        print("{0} samples not delivered{1}".format(
+            left, ' (kept in ' + args.spill_dir + ')' if args.spill_dir else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,467 @@
+# UDP transport for the LSM303 sample stream, unicast or multicast.
+#
+# One datagram is one lsm303_wire frame with FLAG_COLUMNS | FLAG_SEQ: the
+# header's seq numbers the datagrams and the payload starts with the u64
+# sequence number of its first sample, followed by the usual columns. A
+# datagram holds as many samples as fit in `mtu` (60 at 1500 bytes) so it
+# is never fragmented, and is gathered from the sample ring with sendmsg()
+# like the TCP path.
+#
+# There are no acks and no retransmits. Each receiver keeps a LossTracker
+# per sender that counts lost, late (reordered) and duplicate datagrams
+# and lost samples from the sequence numbers, so a slow or lossy consumer
+# costs the sender nothing and never holds up the others. Sent to a
+# multicast group, the stream reaches any number of consumers (logger, PID
+# loop, dashboard) for the cost of one send.
+#
+#   python3 lsm303_tcp.py --transport udp --host 239.242.3.3
+#   python3 lsm303_udp.py --listen 239.242.3.3:3001     # loss report
+#   python3 lsm303_udp.py --bench                        # UDP vs TCP
+import errno
+import select
+import socket
+import struct
+import time
+
+from lsm303_wire import (FLAG_COLUMNS, FLAG_SEQ, HEADER, MAGIC, NATIVE_LE,
+                         RECORD, VERSION, ProtocolError, unpack_columns)
+
+SAMPLE_SEQ = struct.Struct('<Q')
+
+# IPv4 + UDP headers
+IP_UDP_OVERHEAD = 28
+
+# Datagrams this far behind the newest one mean the sender restarted
+RESET_GAP = 1 << 16
+
+
+def samples_per_datagram(mtu):
+    return (mtu - IP_UDP_OVERHEAD - HEADER.size - SAMPLE_SEQ.size) // \
+        RECORD.size
+
+
+def is_multicast(host):
+    try:
+        return 224 <= socket.inet_aton(host)[0] <= 239
+    except OSError:
+        return False
+
+
+class UdpSender(object):
+    # Same send_ring() interface as the TCP senders. A datagram the kernel
+    # will not take right now is counted and dropped, never waited for.
+    in_flight = ()
+    rtt = None
+
+    def __init__(self, address, mtu=1500, ttl=1, iface='0.0.0.0'):
+        if not NATIVE_LE:
+            raise RuntimeError("columnar send needs a little-endian host")
+        self.address = address
+        self.per_datagram = samples_per_datagram(mtu)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        if is_multicast(address[0]):
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                                 ttl)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                 socket.inet_aton(iface))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP,
+                                 1)
+        self.header = bytearray(HEADER.size)
+        self.first = bytearray(SAMPLE_SEQ.size)
+        self.seq = 0
+        self.datagrams = 0
+        self.samples_sent = 0
+        self.dropped = 0
+
+    def send_ring(self, ring, pos):
+        pos = max(pos, ring.tail())
+        for index, count in ring.segments(pos):
+            while count > 0:
+                n = min(count, self.per_datagram)
+                HEADER.pack_into(self.header, 0, MAGIC, VERSION,
+                                 FLAG_COLUMNS | FLAG_SEQ, self.seq & 0xFFFFFFFF,
+                                 n, SAMPLE_SEQ.size + n * RECORD.size)
+                SAMPLE_SEQ.pack_into(self.first, 0, pos)
+                buffers = [self.header, self.first]
+                buffers.extend(ring.views(index, n))
+                try:
+                    self.sock.sendmsg(buffers, (), 0, self.address)
+                    self.datagrams += 1
+                    self.samples_sent += n
+                except (BlockingIOError, InterruptedError):
+                    self.dropped += n
+                except OSError as exc:
+                    # No route or interface down: the link is not up
+                    if exc.errno not in (errno.ENETUNREACH,
+                                         errno.EHOSTUNREACH, errno.ENOBUFS,
+                                         errno.ECONNREFUSED):
+                        raise
+                    self.dropped += n
+                self.seq += 1
+                pos += n
+                index += n
+                count -= n
+        return ring.head
+
+    def pump(self):
+        pass
+
+    def stats(self):
+        return {'connected': True, 'queued': 0, 'spilled': 0,
+                'dropped': self.dropped, 'datagrams': self.datagrams,
+                'sent': self.samples_sent}
+
+    def close(self, timeout=0.0):
+        self.sock.close()
+        return 0
+
+
+class LossTracker(object):
+    # Loss, reorder and duplicate accounting for one sender's datagrams.
+    # The sequence numbers skipped in the last `history` datagrams are
+    # remembered: one of them arriving late is taken off the losses, any
+    # other datagram behind the newest (repeated, or older than the
+    # window) is a duplicate
+    def __init__(self, history=1024):
+        self.history = history
+        self.expected = None
+        self.next_sample = None
+        self.missing = set()
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+        self.duplicates = 0
+        self.samples = 0
+        self.samples_lost = 0
+        self.resets = 0
+
+    def add(self, seq, first_sample, count):
+        # Returns False for a duplicate the caller should ignore
+        gap = 0
+        if self.expected is not None:
+            gap = (seq - self.expected) & 0xFFFFFFFF
+            if gap >= 0x80000000:
+                gap -= 1 << 32
+            if gap < -RESET_GAP or gap > RESET_GAP:
+                self.resets += 1
+                self.expected = None
+                self.missing.clear()
+        if self.expected is not None and gap < 0:
+            if -gap > self.history or seq not in self.missing:
+                self.duplicates += 1
+                return False
+            # Counted lost when its successor arrived first
+            self.missing.discard(seq)
+            self.lost -= 1
+            self.late += 1
+            self.received += 1
+            self.samples += count
+            self.samples_lost = max(0, self.samples_lost - count)
+            return True
+        self.received += 1
+        self.samples += count
+        if self.expected is None:
+            self.expected = (seq + 1) & 0xFFFFFFFF
+            self.next_sample = first_sample + count
+            return True
+        if gap > 0:
+            self.lost += gap
+            for k in range(1, min(gap, self.history) + 1):
+                self.missing.add((seq - k) & 0xFFFFFFFF)
+        self.expected = (seq + 1) & 0xFFFFFFFF
+        if len(self.missing) > 2 * self.history:
+            # Forget those out of the window; they can only be stale now
+            self.missing = set(
+                s for s in self.missing
+                if (seq - s) & 0xFFFFFFFF <= self.history)
+        if first_sample >= self.next_sample:
+            self.samples_lost += first_sample - self.next_sample
+            self.next_sample = first_sample + count
+        else:
+            self.samples_lost = max(0, self.samples_lost - count)
+        return True
+
+    def summary(self):
+        total = self.received + self.lost
+        return {'received': self.received, 'lost': self.lost,
+                'late': self.late, 'duplicates': self.duplicates,
+                'loss': self.lost / float(total) if total else 0.0,
+                'samples': self.samples, 'samples_lost': self.samples_lost,
+                'resets': self.resets}
+
+
+class UdpReceiver(object):
+    # Receives datagrams on port (and group, for multicast) and calls
+    # handler(addr, first_sample, ts, heading, accel, mag) for each new one
+    def __init__(self, port, group=None, iface='0.0.0.0', handler=None,
+                 rcvbuf=1 << 20):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind(('', port))
+        if group is not None and is_multicast(group):
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                 socket.inet_aton(group) +
+                                 socket.inet_aton(iface))
+        self.handler = handler
+        self.buf = bytearray(65536)
+        self.trackers = {}
+        self.errors = 0
+
+    def poll(self, timeout=None):
+        # Handle every datagram waiting, after waiting up to timeout for one
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return 0
+        handled = 0
+        while True:
+            try:
+                n, addr = self.sock.recvfrom_into(self.buf, 0,
+                                                  socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return handled
+            try:
+                self._datagram(memoryview(self.buf)[:n], addr)
+            except ProtocolError:
+                self.errors += 1
+            handled += 1
+
+    def _datagram(self, data, addr):
+        if len(data) < HEADER.size + SAMPLE_SEQ.size:
+            raise ProtocolError("short datagram")
+        magic, version, flags, seq, count, length = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ProtocolError("not an lsm303 datagram")
+        if not flags & FLAG_SEQ or \
+                length != SAMPLE_SEQ.size + count * RECORD.size or \
+                len(data) != HEADER.size + length:
+            raise ProtocolError("bad datagram length")
+        first = SAMPLE_SEQ.unpack_from(data, HEADER.size)[0]
+        tracker = self.trackers.get(addr)
+        if tracker is None:
+            tracker = self.trackers[addr] = LossTracker()
+        if not tracker.add(seq, first, count) or self.handler is None:
+            return
+        payload = data[HEADER.size + SAMPLE_SEQ.size:]
+        self.handler(addr, first, *unpack_columns(payload, count))
+
+    def summary(self):
+        return dict(('%s:%d' % addr, t.summary())
+                    for addr, t in self.trackers.items())
+
+    def close(self):
+        self.sock.close()
+
+
+def _udp_consumer(port, group, seconds, results):
+    from lsm303_metrics import LogHistogram
+    latency = LogHistogram()
+
+    def handler(addr, first, ts, heading, accel, mag):
+        latency.record(int(time.time() * 1e9) - ts[-1] * 1000)
+
+    receiver = UdpReceiver(port, group, '127.0.0.1', handler)
+    results.put('ready')
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        receiver.poll(0.05)
+    summary = list(receiver.summary().values())
+    results.put({'latency': latency.counts, 'max': latency.max,
+                 'loss': summary[0] if summary else None})
+    receiver.close()
+
+
+def _tcp_consumer(srv, seconds, results):
+    from lsm303_metrics import LogHistogram
+    from lsm303_wire import serve_connection
+    latency = LogHistogram()
+
+    def handler(frame):
+        ts = frame.columns()[0]
+        latency.record(int(time.time() * 1e9) - ts[-1] * 1000)
+
+    results.put('ready')
+    conn, _ = srv.accept()
+    with conn:
+        try:
+            serve_connection(conn, handler)
+        except (OSError, ProtocolError):
+            pass
+    results.put({'latency': latency.counts, 'max': latency.max,
+                 'loss': None})
+
+
+def _bench(consumers=(1, 3), samples=200000, rate=1000.0, seconds=3.0,
+           batch=10, mtu=1500):
+    import multiprocessing
+
+    from lsm303_forward import ForwardSender, SampleQueue
+    from lsm303_metrics import LogHistogram
+    from lsm303_ring import SampleRing
+
+    group = '239.242.3.3'
+    accel = (12, -40, 1010)
+    mag = (200, -150, -480)
+
+    def free_port():
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        return port
+
+    def start(transport, n, duration):
+        # Consumers in child processes; returns (senders, processes, queue)
+        results = multiprocessing.Queue()
+        procs = []
+        senders = []
+        if transport == 'udp':
+            port = free_port()
+            for _ in range(n):
+                procs.append(multiprocessing.Process(
+                    target=_udp_consumer, args=(port, group, duration,
+                                                results)))
+                procs[-1].start()
+            senders.append(UdpSender((group, port), mtu, iface='127.0.0.1'))
+        else:
+            for _ in range(n):
+                srv = socket.socket()
+                srv.bind(('127.0.0.1', 0))
+                srv.listen(1)
+                procs.append(multiprocessing.Process(
+                    target=_tcp_consumer, args=(srv, duration, results)))
+                procs[-1].start()
+                senders.append(ForwardSender(srv.getsockname(), SampleQueue()))
+                srv.close()
+        for _ in procs:
+            results.get()
+        for sender in senders:
+            # Let the TCP connections come up before timing anything
+            deadline = time.monotonic() + 2.0
+            while isinstance(sender, ForwardSender) and \
+                    not sender.connected() and time.monotonic() < deadline:
+                sender.pump()
+                time.sleep(0.01)
+        return senders, procs, results
+
+    def finish(senders, procs, results):
+        for sender in senders:
+            sender.close(2.0)
+        hist = LogHistogram()
+        loss = []
+        for _ in procs:
+            result = results.get()
+            hist.counts = [a + b for a, b in zip(hist.counts,
+                                                 result['latency'])]
+            hist.max = max(hist.max, result['max'])
+            if result['loss']:
+                loss.append(result['loss'])
+        for proc in procs:
+            proc.join()
+        return hist, loss
+
+    # The sampling loop alone, subtracted from the CPU figures below
+    ring = SampleRing(4096)
+    cpu = time.process_time()
+    for i in range(samples):
+        ring.append(int(time.time() * 1000000), 0.0, accel, mag)
+        if i % batch == batch - 1:
+            # Same test as the timed loops, nothing to send
+            pass
+    base = (time.process_time() - cpu) / samples
+
+    print("loopback, {0} samples per send, MTU {1} ({2} samples per "
+          "datagram); CPU is the sender's, less {3:.2f} us/sample for the "
+          "sampling loop".format(batch, mtu, samples_per_datagram(mtu),
+                                 base * 1e6))
+    print("{0:24s} {1:>14s} {2:>12s} {3:>12s} {4:>12s}".format(
+        'transport', 'CPU us/sample', 'lat p50', 'lat p99', 'lost'))
+    for n in consumers:
+        for transport in ('tcp', 'udp'):
+            # Sender CPU: flat out, consumers draining as fast as they can
+            senders, procs, results = start(transport, n, 60.0)
+            ring = SampleRing(4096)
+            pos = [0] * len(senders)
+            cpu = time.process_time()
+            for i in range(samples):
+                ring.append(int(time.time() * 1000000), 0.0, accel, mag)
+                if i % batch == batch - 1:
+                    for k, sender in enumerate(senders):
+                        pos[k] = sender.send_ring(ring, pos[k])
+            cpu = (time.process_time() - cpu) / samples - base
+            for proc in procs:
+                proc.terminate()
+                proc.join()
+            for sender in senders:
+                sender.close(0.0)
+
+            # Latency: paced at `rate`, sent every `batch` samples
+            senders, procs, results = start(transport, n, seconds + 1.0)
+            ring = SampleRing(4096)
+            pos = [0] * len(senders)
+            period = 1.0 / rate
+            t0 = time.monotonic()
+            i = 0
+            while time.monotonic() - t0 < seconds:
+                due = t0 + i * period
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                ring.append(int(time.time() * 1000000), 0.0, accel, mag)
+                i += 1
+                if i % batch == 0:
+                    for k, sender in enumerate(senders):
+                        pos[k] = sender.send_ring(ring, pos[k])
+                for sender in senders:
+                    if sender.in_flight:
+                        sender.pump()
+            hist, loss = finish(senders, procs, results)
+            lost = sum(l['samples_lost'] for l in loss) if loss else 0
+            label = '%s, %d consumer%s' % (
+                'tcp x%d' % n if transport == 'tcp' else 'udp multicast', n,
+                '' if n == 1 else 's')
+            print("{0:24s} {1:14.2f} {2:10.3f}ms {3:10.3f}ms {4:>12}".format(
+                label, cpu * 1e6, hist.percentile(50) / 1e6,
+                hist.percentile(99) / 1e6,
+                lost if transport == 'udp' else '-'))
+
+
+def _listen(spec, iface, interval):
+    host, _, port = spec.rpartition(':')
+    receiver = UdpReceiver(int(port), host or None, iface)
+    next_report = time.monotonic() + interval
+    try:
+        while True:
+            receiver.poll(max(0.0, next_report - time.monotonic()))
+            if time.monotonic() >= next_report:
+                next_report += interval
+                for sender, s in sorted(receiver.summary().items()):
+                    print("{0}: {1} datagrams, {2} lost ({3:.2%}), {4} late, "
+                          "{5} duplicate, {6} samples lost".format(
+                              sender, s['received'], s['lost'], s['loss'],
+                              s['late'], s['duplicates'], s['samples_lost']))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='LSM303 UDP/multicast receiver and benchmark')
+    parser.add_argument('--listen', metavar='[GROUP]:PORT',
+                        help='receive and report loss per sender')
+    parser.add_argument('--iface', default='0.0.0.0',
+                        help='interface address for multicast')
+    parser.add_argument('--interval', type=float, default=5.0)
+    parser.add_argument('--bench', action='store_true',
+                        help='loopback comparison with the TCP transport')
+    parser.add_argument('--samples', type=int, default=200000)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    args = parser.parse_args()
+    if args.listen:
+        _listen(args.listen, args.iface, args.interval)
+    else:
+        _bench(samples=args.samples, seconds=args.seconds)
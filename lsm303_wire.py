@@ -0,0 +1,462 @@
+# Binary wire protocol for the LSM303 sample stream.
+#
+# A frame is a 14 byte header followed by `count` fixed-size records:
+#
+#   header : magic 'L3' | version u8 | flags u8 | seq u32 | count u16 | length u32
+#   record : timestamp us u64 | heading deg f32 | accel x,y,z i16 | mag x,y,z i16
+#
+# With FLAG_COLUMNS set the payload holds the same fields column by column
+# (all timestamps, then all headings, then accel x,y,z triples, then mag
+# triples), which is how SampleRing stores them, so the sender can gather
+# ring slices straight into sendmsg() without packing.
+#
+# A sender may open the connection with a FLAG_HELLO frame (count 0, no
+# seq of its own) whose payload is its node name in UTF-8, so a collector
+# can keep each node's data apart across reconnects. FLAG_SEQ marks a
+# payload that starts with the u64 sequence number of its first sample,
+# ahead of the columns (datagrams in lsm303_udp.py). FLAG_DELTA marks a
+# payload of delta/deadband compressed blocks (lsm303_delta.py); `count`
+# is then the number of samples actually carried, and columns() decodes it
+# like any other frame.
+#
+# All fields are little-endian. `length` is the payload size in bytes so a
+# receiver can skip frames it does not understand. The receiver answers with
+# cumulative acks ('LA' + highest seq received); the sender keeps up to
+# `window` frames in flight and only waits when the window is full, so one
+# Wi-Fi round trip no longer costs one sample.
+#
+# Run as a script for a receiver or a loopback benchmark:
+#   python3 lsm303_wire.py --serve 3001
+#   python3 lsm303_wire.py --bench [--rtt-ms 20]
+import array
+import select
+import socket
+import struct
+import sys
+import time
+
+MAGIC = b'L3'
+ACK_MAGIC = b'LA'
+VERSION = 1
+
+FLAG_COLUMNS = 0x01
+FLAG_HELLO = 0x02
+FLAG_SEQ = 0x04
+FLAG_DELTA = 0x08
+
+HEADER = struct.Struct('<2sBBIHI')
+RECORD = struct.Struct('<Qf3h3h')
+ACK = struct.Struct('<2sI')
+
+# Largest payload a receiver will accept, guards against a corrupt length
+MAX_PAYLOAD = 1 << 20
+
+# Ring slices are sent as they sit in memory, which is only the wire byte
+# order on little-endian hosts (ARM boards and x86 all are)
+NATIVE_LE = sys.byteorder == 'little'
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_frame(seq, records, flags=0):
+    # records: iterable of (timestamp_us, heading, (ax, ay, az), (mx, my, mz))
+    records = list(records)
+    buf = bytearray(HEADER.size + len(records) * RECORD.size)
+    offset = HEADER.size
+    for ts, heading, accel, mag in records:
+        RECORD.pack_into(buf, offset, ts, heading,
+                         accel[0], accel[1], accel[2], mag[0], mag[1], mag[2])
+        offset += RECORD.size
+    HEADER.pack_into(buf, 0, MAGIC, VERSION, flags, seq, len(records),
+                     len(buf) - HEADER.size)
+    return bytes(buf)
+
+
+def pack_hello(name):
+    payload = name.encode('utf-8')
+    return HEADER.pack(MAGIC, VERSION, FLAG_HELLO, 0, 0, len(payload)) + \
+        payload
+
+
+def unpack_records(payload):
+    # Yields (timestamp_us, heading, (ax, ay, az), (mx, my, mz))
+    for ts, heading, ax, ay, az, mx, my, mz in RECORD.iter_unpack(payload):
+        yield ts, heading, (ax, ay, az), (mx, my, mz)
+
+
+def unpack_columns(payload, count):
+    # Split a FLAG_COLUMNS payload (bytes or a memoryview) into
+    # (ts, heading, accel, mag) arrays
+    columns = []
+    offset = 0
+    for typecode, size in (('Q', 8), ('f', 4), ('h', 6), ('h', 6)):
+        column = array.array(typecode)
+        column.frombytes(payload[offset:offset + size * count])
+        if not NATIVE_LE:
+            column.byteswap()
+        columns.append(column)
+        offset += size * count
+    return tuple(columns)
+
+
+class Frame(object):
+    def __init__(self, seq, flags, count, payload):
+        self.seq = seq
+        self.flags = flags
+        self.count = count
+        self.payload = payload
+
+    def records(self):
+        if self.flags & (FLAG_COLUMNS | FLAG_DELTA):
+            return self._column_records()
+        return unpack_records(self.payload)
+
+    def _column_records(self):
+        ts, heading, accel, mag = self.columns()
+        for i in range(self.count):
+            j = 3 * i
+            yield (ts[i], heading[i], tuple(accel[j:j + 3]),
+                   tuple(mag[j:j + 3]))
+
+    def columns(self):
+        # (ts, heading, accel, mag) arrays whatever the payload layout
+        if self.flags & FLAG_COLUMNS:
+            return unpack_columns(self.payload, self.count)
+        if self.flags & FLAG_DELTA:
+            # Only here: the codec needs NumPy, plain readers do not
+            from lsm303_delta import decode_payload
+            try:
+                return decode_payload(self.payload, self.count)
+            except (ValueError, IndexError, struct.error) as exc:
+                raise ProtocolError("bad delta payload: %s" % exc)
+        ts = array.array('Q', bytes(8 * self.count))
+        heading = array.array('f', bytes(4 * self.count))
+        accel = array.array('h', bytes(6 * self.count))
+        mag = array.array('h', bytes(6 * self.count))
+        for i, (t, h, ax, ay, az, mx, my, mz) in \
+                enumerate(RECORD.iter_unpack(self.payload)):
+            ts[i] = t
+            heading[i] = h
+            accel[3 * i:3 * i + 3] = array.array('h', (ax, ay, az))
+            mag[3 * i:3 * i + 3] = array.array('h', (mx, my, mz))
+        return ts, heading, accel, mag
+
+
+class FrameReader(object):
+    # Incremental frame parser: feed() whatever recv() returned and iterate
+    # over the complete frames. Partial frames stay buffered.
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+        frames = []
+        offset = 0
+        end = len(self.buf)
+        while end - offset >= HEADER.size:
+            magic, version, flags, seq, count, length = \
+                HEADER.unpack_from(self.buf, offset)
+            if magic != MAGIC:
+                raise ProtocolError("bad frame magic %r" % magic)
+            if length > MAX_PAYLOAD:
+                raise ProtocolError("frame payload too large (%d)" % length)
+            if end - offset < HEADER.size + length:
+                break
+            start = offset + HEADER.size
+            payload = bytes(self.buf[start:start + length])
+            if version == VERSION:
+                frames.append(Frame(seq, flags, count, payload))
+            offset = start + length
+        if offset:
+            del self.buf[:offset]
+        return frames
+
+
+class AckReader(object):
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        # Returns the highest seq acked in data, or None
+        self.buf += data
+        last = None
+        n = len(self.buf) - len(self.buf) % ACK.size
+        for offset in range(0, n, ACK.size):
+            magic, last = ACK.unpack_from(self.buf, offset)
+            if magic != ACK_MAGIC:
+                raise ProtocolError("bad ack magic %r" % magic)
+        del self.buf[:n]
+        return last
+
+
+class FrameSender(object):
+    # Batches samples into frames and keeps up to `window` frames in flight.
+    # A frame is sent when `batch` samples are queued or the oldest queued
+    # sample is older than `max_delay` seconds.
+    def __init__(self, sock, batch=32, window=16, max_delay=0.05):
+        self.sock = sock
+        self.batch = batch
+        self.window = window
+        self.max_delay = max_delay
+        self.buf = bytearray(HEADER.size + batch * RECORD.size)
+        self.header = bytearray(HEADER.size)
+        self.count = 0
+        self.first_time = 0.0
+        self.seq = 0
+        self.acked = -1
+        self.acks = AckReader()
+        self.ack_buf = bytearray(4096)
+        self.sent_time = {}
+        self.rtt = None
+        self.frames_sent = 0
+        self.samples_sent = 0
+        self.stalls = 0
+
+    def add(self, ts, heading, accel, mag):
+        offset = HEADER.size + self.count * RECORD.size
+        RECORD.pack_into(self.buf, offset, ts, heading,
+                         accel[0], accel[1], accel[2], mag[0], mag[1], mag[2])
+        self.count += 1
+        if self.count == 1:
+            self.first_time = time.monotonic()
+        if self.count == self.batch or \
+           time.monotonic() - self.first_time >= self.max_delay:
+            self.flush()
+
+    def in_flight(self):
+        return self.seq - 1 - self.acked
+
+    def flush(self):
+        if self.count == 0:
+            return
+        length = self.count * RECORD.size
+        HEADER.pack_into(self.buf, 0, MAGIC, VERSION, 0, self.seq,
+                         self.count, length)
+        self._wait_window()
+        self.sock.sendall(memoryview(self.buf)[:HEADER.size + length])
+        self._sent(self.count)
+        self.count = 0
+
+    def send_ring(self, ring, pos):
+        # Send ring samples from position pos up to ring.head as columnar
+        # frames of at most `batch` samples; returns the new position.
+        # Samples already overwritten in the ring are skipped.
+        if not NATIVE_LE:
+            raise RuntimeError("columnar send needs a little-endian host")
+        self.flush()
+        for index, count in ring.segments(pos):
+            while count > 0:
+                n = min(count, self.batch)
+                views = ring.views(index, n)
+                HEADER.pack_into(self.header, 0, MAGIC, VERSION, FLAG_COLUMNS,
+                                 self.seq, n, n * RECORD.size)
+                self._wait_window()
+                self._sendmsg([self.header] + list(views))
+                self._sent(n)
+                index += n
+                count -= n
+        return ring.head
+
+    def _sendmsg(self, buffers):
+        sent = self.sock.sendmsg(buffers)
+        total = sum(memoryview(b).nbytes for b in buffers)
+        if sent == total:
+            return
+        # Short write (signal or full socket buffer): send the rest in order
+        for b in buffers:
+            b = memoryview(b).cast('B')
+            if sent >= len(b):
+                sent -= len(b)
+                continue
+            self.sock.sendall(b[sent:])
+            sent = 0
+
+    def _wait_window(self):
+        # Only wait on the link when the window is exhausted
+        if self.in_flight() >= self.window:
+            self.stalls += 1
+            while self.in_flight() >= self.window:
+                self.poll_acks(None)
+
+    def _sent(self, count):
+        self.sent_time[self.seq] = time.monotonic()
+        self.seq += 1
+        self.frames_sent += 1
+        self.samples_sent += count
+        self.poll_acks(0)
+
+    def poll_acks(self, timeout=0):
+        # Read whatever acks are pending; timeout=None blocks for one
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return
+        n = self.sock.recv_into(self.ack_buf)
+        if not n:
+            raise ConnectionError("receiver closed the connection")
+        seq = self.acks.feed(memoryview(self.ack_buf)[:n])
+        if seq is None or seq <= self.acked:
+            return
+        now = time.monotonic()
+        sent = self.sent_time.get(seq)
+        if sent is not None:
+            self.rtt = now - sent
+        for s in range(self.acked + 1, seq + 1):
+            self.sent_time.pop(s, None)
+        self.acked = seq
+
+    def close(self, timeout=5.0):
+        # Flush the partial batch and wait for the receiver to ack it all
+        self.flush()
+        deadline = time.monotonic() + timeout
+        while self.in_flight() > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.poll_acks(remaining)
+
+
+def serve_connection(conn, handler=None, ack_delay=0.0):
+    # Parse frames from conn, call handler(frame) and send cumulative acks.
+    # ack_delay holds each ack back to emulate a slower link.
+    reader = FrameReader()
+    pending = []
+    samples = 0
+    while True:
+        timeout = None
+        if pending:
+            timeout = max(0.0, pending[0][0] - time.monotonic())
+        readable, _, _ = select.select([conn], [], [], timeout)
+        if readable:
+            data = conn.recv(65536)
+            if not data:
+                break
+            last = None
+            for frame in reader.feed(data):
+                if frame.flags & FLAG_HELLO:
+                    continue
+                samples += frame.count
+                if handler is not None:
+                    handler(frame)
+                last = frame.seq
+            if last is not None:
+                pending.append((time.monotonic() + ack_delay, last))
+        now = time.monotonic()
+        while pending and pending[0][0] <= now:
+            conn.sendall(ACK.pack(ACK_MAGIC, pending.pop(0)[1]))
+    return samples
+
+
+def serve(port, host='', handler=None):
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind((host, port))
+    srv.listen(1)
+    while True:
+        conn, addr = srv.accept()
+        print("connection from {0}:{1}".format(addr[0], addr[1]))
+        with conn:
+            try:
+                samples = serve_connection(conn, handler)
+            except (ConnectionError, ProtocolError) as exc:
+                print("connection lost: {0}".format(exc))
+                continue
+        print("{0} samples received".format(samples))
+
+
+def _print_frame(frame):
+    for ts, heading, accel, mag in frame.records():
+        print("{0:.1f} {1}".format(heading, ts))
+
+
+def _echo_server(srv, ack_delay):
+    # Stand-in for the old receiver: echo each message after ack_delay
+    conn, _ = srv.accept()
+    with conn:
+        while True:
+            data = conn.recv(1024)
+            if not data:
+                break
+            if ack_delay:
+                time.sleep(ack_delay)
+            conn.sendall(b'ok')
+
+
+def _frame_server(srv, ack_delay):
+    conn, _ = srv.accept()
+    with conn:
+        serve_connection(conn, ack_delay=ack_delay)
+
+
+def _bench_server(target, ack_delay):
+    import threading
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(1)
+    thread = threading.Thread(target=target, args=(srv, ack_delay))
+    thread.daemon = True
+    thread.start()
+    sock = socket.create_connection(srv.getsockname())
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return srv, sock, thread
+
+
+def bench(seconds=2.0, rtt=0.0, batch=32, window=16):
+    accel = (12, -40, 1010)
+    mag = (200, -150, -480)
+
+    # Old path: one text line and one blocking recv per sample
+    srv, sock, thread = _bench_server(_echo_server, rtt)
+    n = 0
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        time_cur = int(round(time.time() * 1000000))
+        line = str(int(123.4)) + " " + str(time_cur)
+        sock.sendall(line.encode('utf-8'))
+        sock.recv(1024)
+        n += 1
+    text_rate = n / (time.monotonic() - start)
+    sock.close()
+    thread.join()
+    srv.close()
+
+    # Framed path: batched records, windowed acks
+    srv, sock, thread = _bench_server(_frame_server, rtt)
+    sender = FrameSender(sock, batch=batch, window=window)
+    n = 0
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        sender.add(int(round(time.time() * 1000000)), 123.4, accel, mag)
+        n += 1
+    sender.close()
+    frame_rate = n / (time.monotonic() - start)
+    sock.close()
+    thread.join()
+    srv.close()
+
+    print("link rtt      : {0:.1f} ms".format(rtt * 1000))
+    print("text + recv   : {0:10.0f} samples/s".format(text_rate))
+    print("framed binary : {0:10.0f} samples/s  (batch {1}, window {2}, "
+          "{3} stalls)".format(frame_rate, batch, window, sender.stalls))
+    print("speedup       : {0:10.1f}x".format(frame_rate / text_rate))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='LSM303 binary wire protocol receiver and benchmark')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='run a receiver that prints samples')
+    parser.add_argument('--bench', action='store_true',
+                        help='loopback throughput benchmark')
+    parser.add_argument('--rtt-ms', type=float, default=0.0,
+                        help='emulated link round trip for --bench')
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--window', type=int, default=16)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, handler=_print_frame)
+    else:
+        bench(args.seconds, args.rtt_ms / 1000.0, args.batch, args.window)
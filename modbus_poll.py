@@ -0,0 +1,416 @@
+# Periodic multi-slave Modbus RTU telemetry poller for ZLAC8015D drives.
+#
+# Several controllers share one RS-485 bus at 115200 baud. Every read is
+# a full request/response round trip (about 1.5 ms before any data), so
+# polling each value of each drive on its own quickly fills the bus.
+#
+# Each Point has its own rate. The poller runs in frames of the fastest
+# point's period and polls a point every k-th frame, k rounded down so it
+# is never read slower than asked. It gets a phase 0..k-1,
+# picked so the slower points spread over the frames instead of all
+# landing on the same one. Within a frame the due points of a unit are
+# sorted by address and nearby ranges merged into one
+# read_holding_registers call, reading the registers in the gap, as long
+# as that is cheaper on the wire than another transaction (max_gap() works
+# it out from the byte time and turnaround). The whole table is built
+# once by Plan, so a frame is just a list lookup.
+#
+# Units are spread across the frame: unit i starts at i/n of the frame,
+# which leaves gaps between their bursts for MotorClient's setpoint
+# writes when both share the bus (pass MotorClient.client and .bus).
+# Plan.utilization() predicts the fraction of bus time the schedule needs
+# and warns when the worst frame does not fit.
+#
+# Decoded values go into a Snapshot keyed by (unit, name) with the time
+# they were read; report() gives the measured bus utilization, poll
+# frames/s, and per point the reads/s and worst staleness (time since
+# the value was last refreshed, compared with its period).
+#
+#   python3 modbus_poll.py                 # 3 simulated drives, 5 s
+#   python3 modbus_poll.py --units 1,2,3,4 --rate speed=100
+#   python3 modbus_poll.py --port /dev/ttyTHS1 --units 1
+import asyncio
+import time
+
+from lsm303_metrics import LogHistogram
+from modbus_motor import ACTUAL_CURRENT, ACTUAL_POSITION, ACTUAL_SPEED, \
+    BAUDRATE, BUS_VOLTAGE, DRIVER_TEMP, FAULT_CODE, MOTOR_TEMP, STATUS_WORD
+
+# Turnaround of the drive between request and response, seconds
+TURNAROUND = 0.0005
+# Registers in one read holding registers (function 3) request
+MAX_READ = 125
+
+
+class Point(object):
+    # kind: 'u16', 'i16', 'i32' (two registers, high word first) or 'u8x2'
+    # (one register holding two bytes, high byte first). count values of
+    # that kind in a row; more than one decodes to a tuple (left, right).
+    WORDS = {'u16': 1, 'i16': 1, 'i32': 2, 'u8x2': 1}
+
+    def __init__(self, name, address, rate, kind='u16', scale=1.0, count=1):
+        self.name = name
+        self.address = address
+        self.rate = rate
+        self.kind = kind
+        self.scale = scale
+        self.count = count
+        self.words = self.WORDS[kind] * count
+
+    def end(self):
+        return self.address + self.words
+
+    def decode(self, regs, offset):
+        kind = self.kind
+        values = []
+        i = offset
+        for _ in range(self.count):
+            if kind == 'i32':
+                value = regs[i] << 16 | regs[i + 1]
+                if value & 0x80000000:
+                    value -= 1 << 32
+                i += 2
+            else:
+                value = regs[i]
+                i += 1
+                if kind == 'i16' and value & 0x8000:
+                    value -= 0x10000
+                elif kind == 'u8x2':
+                    values.append((value >> 8, value & 0xFF))
+                    continue
+            values.append(value * self.scale if self.scale != 1.0 else value)
+        return values[0] if self.count == 1 else tuple(values)
+
+
+# What a ZLAC8015D exposes, at rates a differential-drive loop needs
+POINTS = [
+    Point('speed', ACTUAL_SPEED, 50, 'i16', 0.1, count=2),
+    Point('position', ACTUAL_POSITION, 50, 'i32', count=2),
+    Point('current', ACTUAL_CURRENT, 20, 'i16', 0.1, count=2),
+    Point('status', STATUS_WORD, 10),
+    Point('fault', FAULT_CODE, 10, count=2),
+    Point('bus_voltage', BUS_VOLTAGE, 1, scale=0.01),
+    Point('motor_temp', MOTOR_TEMP, 1, 'u8x2'),
+    Point('driver_temp', DRIVER_TEMP, 1, scale=0.1),
+]
+
+
+def read_time(count, baudrate=BAUDRATE, turnaround=TURNAROUND):
+    # Wire time of reading count registers: 8 byte request, 5 + 2 * count
+    # byte response, a 3.5 character gap after each, and the turnaround
+    byte = 10.0 / baudrate
+    return (8 + 5 + 2 * count + 7) * byte + turnaround
+
+
+def max_gap(baudrate=BAUDRATE, turnaround=TURNAROUND):
+    # Registers worth reading through rather than starting a new request
+    return int(read_time(0, baudrate, turnaround) / (2 * 10.0 / baudrate))
+
+
+def merge(points, gap):
+    # points sorted by address -> [(address, count, [(point, offset)])]
+    reads = []
+    for point in points:
+        if reads:
+            address, count, members = reads[-1]
+            end = address + count
+            if point.address - end <= gap and \
+                    max(end, point.end()) - address <= MAX_READ:
+                count = max(end, point.end()) - address
+                members.append((point, point.address - address))
+                reads[-1] = (address, count, members)
+                continue
+        reads.append((point.address, point.words, [(point, 0)]))
+    return reads
+
+
+class Plan(object):
+    def __init__(self, points, units, baudrate=BAUDRATE,
+                 turnaround=TURNAROUND, gap=None):
+        # gap: registers to read through between points, -1 for one read
+        # per point; worked out from the bus timing by default
+        self.points = sorted(points, key=lambda p: p.address)
+        self.units = list(units)
+        self.baudrate = baudrate
+        self.turnaround = turnaround
+        self.gap = max_gap(baudrate, turnaround) if gap is None else gap
+        fastest = max(p.rate for p in self.points)
+        self.frame = 1.0 / fastest
+        self.every = dict((p.name, max(1, int(fastest / p.rate + 1e-9)))
+                          for p in self.points)
+        self.cycle = 1
+        for k in self.every.values():
+            self.cycle = _lcm(self.cycle, k)
+        self.phase = self._phases()
+        # frames[i] = merged reads of one unit in frame i of the cycle
+        self.frames = []
+        for i in range(self.cycle):
+            due = [p for p in self.points
+                   if i % self.every[p.name] == self.phase[p.name]]
+            self.frames.append(merge(due, self.gap))
+
+    def _phases(self):
+        # Greedy: slowest points first, each to the phase that keeps the
+        # busiest frame it lands in lightest. Load is counted in registers
+        # plus a transaction's worth per point, which is what merging
+        # could at best save.
+        load = [0.0] * self.cycle
+        overhead = read_time(0, self.baudrate, self.turnaround) / \
+            (2 * 10.0 / self.baudrate)
+        phase = {}
+        for point in sorted(self.points, key=lambda p: -self.every[p.name]):
+            k = self.every[point.name]
+            cost = point.words + overhead
+            best = None
+            for ph in range(k):
+                worst = max(load[i] for i in range(ph, self.cycle, k))
+                if best is None or worst < best[0]:
+                    best = (worst, ph)
+            phase[point.name] = best[1]
+            for i in range(best[1], self.cycle, k):
+                load[i] += cost
+        return phase
+
+    def frame_time(self, i):
+        # Bus time of frame i for all units
+        return len(self.units) * sum(
+            read_time(count, self.baudrate, self.turnaround)
+            for _, count, _ in self.frames[i])
+
+    def utilization(self):
+        times = [self.frame_time(i) for i in range(self.cycle)]
+        return sum(times) / (self.cycle * self.frame), max(times) / self.frame
+
+    def reads_per_s(self):
+        n = sum(len(reads) for reads in self.frames)
+        return n * len(self.units) / (self.cycle * self.frame)
+
+    def describe(self):
+        # Distinct frames of the cycle and how often each occurs
+        counts = {}
+        for reads in self.frames:
+            line = ", ".join("{0:#06x}+{1} ({2})".format(
+                a, n, "/".join(p.name for p, _ in m)) for a, n, m in reads)
+            counts[line] = counts.get(line, 0) + 1
+        return ["{0:3d} x {1}".format(n, line)
+                for line, n in sorted(counts.items(), key=lambda x: -x[1])]
+
+
+def _lcm(a, b):
+    x, y = a, b
+    while y:
+        x, y = y, x % y
+    return a * b // x
+
+
+class Snapshot(object):
+    # Latest decoded value of every (unit, point) and when it was read.
+    # Plain dict assignment, so other threads may read it while the
+    # poller writes.
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.values = {}
+        self.stamps = {}
+
+    def update(self, unit, name, value, stamp):
+        self.values[unit, name] = value
+        self.stamps[unit, name] = stamp
+
+    def get(self, unit, name, default=None):
+        return self.values.get((unit, name), default)
+
+    def age(self, unit, name):
+        stamp = self.stamps.get((unit, name))
+        return None if stamp is None else self.clock() - stamp
+
+    def unit(self, unit):
+        return dict((name, value) for (u, name), value in
+                    list(self.values.items()) if u == unit)
+
+
+class Poller(object):
+    def __init__(self, client, plan, snapshot=None, bus=None,
+                 clock=time.monotonic):
+        # client: a connected pymodbus async client; bus: the asyncio.Lock
+        # of a MotorClient sharing it, if any
+        self.client = client
+        self.plan = plan
+        self.snapshot = snapshot if snapshot is not None else \
+            Snapshot(clock)
+        self.bus = bus if bus is not None else asyncio.Lock()
+        self.clock = clock
+        self.frames = 0
+        self.late = 0
+        self.errors = 0
+        self.transactions = 0
+        self.busy = 0.0
+        self.latency = LogHistogram()
+        self.reads = dict(((u, p.name), 0)
+                          for u in plan.units for p in plan.points)
+        self.stale = dict((key, 0.0) for key in self.reads)
+        self.started = None
+
+    async def run(self, seconds=None, paced=True):
+        loop = asyncio.get_event_loop()
+        plan = self.plan
+        slot = plan.frame / len(plan.units)
+        start = loop.time()
+        self.started = self.clock()
+        deadline = None if seconds is None else start + seconds
+        n = 0
+        while deadline is None or loop.time() < deadline:
+            reads = plan.frames[n % plan.cycle]
+            base = start + n * plan.frame
+            for i, unit in enumerate(plan.units):
+                if paced:
+                    delay = base + i * slot - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    elif delay < -slot:
+                        self.late += 1
+                for address, count, members in reads:
+                    await self._read(unit, address, count, members)
+            n += 1
+            self.frames = n
+
+    async def _read(self, unit, address, count, members):
+        async with self.bus:
+            t0 = self.clock()
+            try:
+                response = await self.client.read_holding_registers(
+                    address, count, slave=unit)
+            except Exception:
+                response = None
+            t1 = self.clock()
+        self.transactions += 1
+        self.busy += t1 - t0
+        self.latency.record(int((t1 - t0) * 1e9))
+        if response is None or response.isError():
+            self.errors += 1
+            return
+        regs = response.registers
+        snapshot = self.snapshot
+        for point, offset in members:
+            key = unit, point.name
+            previous = snapshot.stamps.get(key)
+            if previous is not None and t1 - previous > self.stale[key]:
+                self.stale[key] = t1 - previous
+            snapshot.update(unit, point.name, point.decode(regs, offset), t1)
+            self.reads[key] += 1
+
+    def report(self):
+        elapsed = self.clock() - self.started
+        points = {}
+        for point in self.plan.points:
+            for unit in self.plan.units:
+                key = unit, point.name
+                age = self.snapshot.age(unit, point.name)
+                worst = max(self.stale[key], age if age is not None else 0)
+                entry = points.setdefault(point.name, {
+                    'rate': point.rate, 'reads_per_s': 0.0,
+                    'max_stale_ms': 0.0})
+                entry['reads_per_s'] += self.reads[key] / elapsed / \
+                    len(self.plan.units)
+                entry['max_stale_ms'] = max(entry['max_stale_ms'],
+                                            worst * 1000.0)
+        planned, worst = self.plan.utilization()
+        return {'frames_per_s': self.frames / elapsed,
+                'transactions_per_s': self.transactions / elapsed,
+                'utilization': self.busy / elapsed,
+                'planned_utilization': planned,
+                'worst_frame': worst,
+                'late': self.late, 'errors': self.errors,
+                'transaction': self.latency.summary(),
+                'points': points}
+
+
+def _connect(port):
+    from pymodbus.client import AsyncModbusSerialClient
+    from pymodbus.transaction import ModbusRtuFramer
+    return AsyncModbusSerialClient(
+        port=port, framer=ModbusRtuFramer, baudrate=BAUDRATE, bytesize=8,
+        parity='N', stopbits=1, timeout=0.5)
+
+
+async def _poll(port, plan, seconds, paced=True):
+    client = _connect(port)
+    await client.connect()
+    poller = Poller(client, plan)
+    await poller.run(seconds, paced)
+    client.close()
+    return poller
+
+
+def _print_report(report):
+    print("  {0:.1f} frames/s, {1:.0f} reads/s, bus {2:.0%} busy "
+          "(planned {3:.0%}, worst frame {4:.0%}), read p50 {5:.0f} us "
+          "p99 {6:.0f} us, {7} late, {8} errors".format(
+              report['frames_per_s'], report['transactions_per_s'],
+              report['utilization'], report['planned_utilization'],
+              report['worst_frame'], report['transaction']['p50'],
+              report['transaction']['p99'], report['late'],
+              report['errors']))
+    for name, entry in report['points'].items():
+        print("  {0:12s} {1:5.1f} Hz wanted, {2:6.1f} reads/s, "
+              "max stale {3:7.1f} ms (period {4:.0f} ms)".format(
+                  name, entry['rate'], entry['reads_per_s'],
+                  entry['max_stale_ms'], 1000.0 / entry['rate']))
+
+
+def _bench(units=(1, 2, 3), points=POINTS, seconds=5.0):
+    from modbus_sim import SlaveSimulator
+    plan = Plan(points, units)
+    single = Plan(points, units, gap=-1)
+    planned, worst = plan.utilization()
+    print("{0} units, frame {1:.0f} ms x {2}, merge gap {3} registers, "
+          "planned bus {4:.0%} (worst frame {5:.0%})".format(
+              len(units), plan.frame * 1000, plan.cycle, plan.gap,
+              planned, worst))
+    for line in plan.describe():
+        print("  " + line)
+    if worst > 1.0:
+        print("  warning: worst frame exceeds the frame period")
+    with SlaveSimulator(units) as sim:
+        for label, p in (('merged', plan), ('one read per point', single)):
+            print("{0}, free running:".format(label))
+            poller = asyncio.run(_poll(sim.port, p, seconds / 4, False))
+            report = poller.report()
+            print("  {0:.1f} frames/s ({1:.2f} full cycles/s), "
+                  "{2:.0f} reads/s".format(
+                      report['frames_per_s'], report['frames_per_s'] / p.cycle,
+                      report['transactions_per_s']))
+        print("merged, paced at the point rates:")
+        poller = asyncio.run(_poll(sim.port, plan, seconds))
+        _print_report(poller.report())
+        print("  unit {0}: {1}".format(units[0],
+                                       poller.snapshot.unit(units[0])))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Multi-slave Modbus RTU telemetry poller')
+    parser.add_argument('--port', help='serial port; bench on a simulator '
+                        'when omitted')
+    parser.add_argument('--units', default='1,2,3',
+                        help='comma-separated unit ids')
+    parser.add_argument('--rate', action='append', default=[],
+                        metavar='NAME=HZ', help='override a point rate')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+    units = [int(u) for u in args.units.split(',')]
+    rates = dict((name, float(hz)) for name, hz in
+                 (r.split('=') for r in args.rate))
+    for point in POINTS:
+        if point.name in rates:
+            point.rate = rates.pop(point.name)
+    if rates:
+        parser.error('unknown points: ' + ', '.join(sorted(rates)))
+    if args.port:
+        plan = Plan(POINTS, units)
+        poller = asyncio.run(_poll(args.port, plan, args.seconds))
+        _print_report(poller.report())
+        for unit in units:
+            print("unit {0}: {1}".format(unit, poller.snapshot.unit(unit)))
+    else:
+        _bench(units, POINTS, args.seconds)
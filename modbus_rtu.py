@@ -0,0 +1,342 @@
+# Fast-path Modbus RTU framing for the motor client's hot writes.
+#
+# In a closed loop the only thing written at a high rate is the target
+# speed pair at 0x2088, yet every write through pymodbus builds a request
+# object, runs it through the framer, computes the CRC bit by bit over
+# the whole frame and decodes a response object, costing far more CPU
+# than the 13 bytes on the wire deserve on a Jetson.
+#
+# FrameCache keeps one template per (slave, function, address, count):
+# a preallocated bytearray holding the frame with its fixed head already
+# written, the CRC state after that head, and the expected response when
+# it is fixed (write multiple registers acknowledges with a fixed echo).
+# Encoding a write only packs the value bytes into the buffer, runs the
+# table-driven CRC16 over those few bytes starting from the cached state,
+# and patches the CRC in. The buffer is reused, so a frame is valid until
+# the next encode of the same template; send it before that.
+#
+# RtuLink is a minimal RTU master on a raw serial port (opened and
+# configured by pyserial, then read and written on the descriptor through
+# the event loop's add_reader). It offers the three pymodbus client calls
+# MotorClient and Poller make, write_register, write_registers and
+# read_holding_registers, so MotorClient(fast=True) swaps it in for
+# AsyncModbusSerialClient. An acknowledgement is checked by comparing it
+# with the cached expected bytes.
+#
+#   python3 modbus_rtu.py          # CRC and encode rates, byte-exact check
+#                                  # against pymodbus, CPU per write
+import asyncio
+import os
+import struct
+import time
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def crc16(data, crc=0xFFFF):
+    # Table-driven Modbus CRC-16; pass a previous result as crc to
+    # continue over more data
+    table = CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class _Template(object):
+    __slots__ = ('buf', 'head', 'crc', 'values', 'response', 'length')
+
+    def __init__(self, head, count, response=None, length=0):
+        # head: the fixed bytes before the values; count: 16-bit values
+        # patched in after it; response: fixed acknowledgement, if any;
+        # length: bytes in the response
+        self.head = len(head)
+        self.buf = bytearray(head) + bytearray(2 * count + 2)
+        self.crc = crc16(head)
+        self.values = struct.Struct('>%dH' % count) if count else None
+        if not count:
+            struct.pack_into('<H', self.buf, self.head, self.crc)
+        self.response = response
+        self.length = length
+
+
+class FrameCache(object):
+    def __init__(self):
+        self.templates = {}
+
+    def _template(self, slave, function, address, count):
+        key = slave, function, address, count
+        template = self.templates.get(key)
+        if template is not None:
+            return template
+        if function == 6:
+            head = struct.pack('>BBH', slave, 6, address)
+            template = _Template(head, 1, None, 8)
+        elif function == 16:
+            head = struct.pack('>BBHHB', slave, 16, address, count, 2 * count)
+            ack = struct.pack('>BBHH', slave, 16, address, count)
+            template = _Template(head, count,
+                                 ack + struct.pack('<H', crc16(ack)), 8)
+        else:
+            head = struct.pack('>BBHH', slave, function, address, count)
+            template = _Template(head, 0, None, 5 + 2 * count)
+        self.templates[key] = template
+        return template
+
+    def _patch(self, template, values):
+        buf = template.buf
+        start = template.head
+        template.values.pack_into(buf, start, *values)
+        end = len(buf) - 2
+        crc = template.crc
+        table = CRC_TABLE
+        for i in range(start, end):
+            crc = (crc >> 8) ^ table[(crc ^ buf[i]) & 0xFF]
+        buf[end] = crc & 0xFF
+        buf[end + 1] = crc >> 8
+        return buf
+
+    def write_register(self, slave, address, value):
+        # -> (frame, expected acknowledgement); function 6 echoes the frame
+        template = self._template(slave, 6, address, 1)
+        frame = self._patch(template, (value & 0xFFFF,))
+        return frame, frame
+
+    def write_registers(self, slave, address, values):
+        template = self._template(slave, 16, address, len(values))
+        return self._patch(template, values), template.response
+
+    def read_holding_registers(self, slave, address, count):
+        # -> (frame, response length)
+        template = self._template(slave, 3, address, count)
+        return template.buf, template.length
+
+
+class RtuError(Exception):
+    pass
+
+
+class Response(object):
+    # Enough of a pymodbus response for MotorClient and Poller
+    __slots__ = ('registers', 'exception_code')
+
+    def __init__(self, registers=None, exception_code=None):
+        self.registers = registers
+        self.exception_code = exception_code
+
+    def isError(self):
+        return self.exception_code is not None
+
+    def __str__(self):
+        if self.exception_code is not None:
+            return 'exception {0}'.format(self.exception_code)
+        return 'registers {0}'.format(self.registers)
+
+
+class RtuLink(object):
+    def __init__(self, port, baudrate=115200, timeout=1.0):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.serial = None
+        self.fd = None
+        self.frames = FrameCache()
+        self.rx = bytearray()
+        self.want = 0
+        self.waiter = None
+        self.connected = False
+
+    async def connect(self):
+        import serial
+        self.serial = serial.Serial(self.port, self.baudrate, bytesize=8,
+                                    parity='N', stopbits=1, timeout=0)
+        self.fd = self.serial.fileno()
+        asyncio.get_event_loop().add_reader(self.fd, self._readable)
+        self.connected = True
+        return True
+
+    def close(self):
+        if self.serial is not None:
+            asyncio.get_event_loop().remove_reader(self.fd)
+            self.serial.close()
+            self.serial = None
+            self.fd = None
+        self.connected = False
+
+    def _readable(self):
+        # Straight from the descriptor: pyserial's read() adds a select()
+        # and an ioctl per call
+        try:
+            data = os.read(self.fd, 256)
+        except BlockingIOError:
+            return
+        if self.waiter is None or self.waiter.done():
+            # Nothing outstanding: a late or stray reply
+            return
+        self.rx += data
+        # An exception reply is 5 bytes whatever was asked
+        if len(self.rx) >= self.want or \
+                (len(self.rx) >= 5 and self.rx[1] & 0x80):
+            self.waiter.set_result(None)
+
+    def _expire(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(
+                RtuError('no response from {0}'.format(self.port)))
+
+    async def _transact(self, frame, length):
+        del self.rx[:]
+        self.want = length
+        loop = asyncio.get_event_loop()
+        self.waiter = loop.create_future()
+        # A timer handle rather than wait_for(), which wraps every call in
+        # a new task
+        timer = loop.call_later(self.timeout, self._expire)
+        os.write(self.fd, frame)
+        try:
+            await self.waiter
+        finally:
+            timer.cancel()
+            self.waiter = None
+        reply = bytes(self.rx)
+        if reply[1] & 0x80:
+            if crc16(reply[:5]) != 0:
+                raise RtuError('bad CRC in {0}'.format(reply.hex()))
+            return None, reply[2]
+        return reply[:length], None
+
+    async def write_register(self, address, value, slave=1):
+        frame, expected = self.frames.write_register(slave, address, value)
+        # The echo is the frame itself, so compare before the buffer can
+        # be reused
+        expected = bytes(expected)
+        reply, code = await self._transact(frame, 8)
+        return self._ack(reply, code, expected)
+
+    async def write_registers(self, address, values, slave=1):
+        frame, expected = self.frames.write_registers(slave, address, values)
+        reply, code = await self._transact(frame, 8)
+        return self._ack(reply, code, expected)
+
+    def _ack(self, reply, code, expected):
+        if code is not None:
+            return Response(exception_code=code)
+        if reply != expected:
+            raise RtuError('unexpected reply {0}'.format(reply.hex()))
+        return Response()
+
+    async def read_holding_registers(self, address, count, slave=1):
+        frame, length = self.frames.read_holding_registers(
+            slave, address, count)
+        reply, code = await self._transact(frame, length)
+        if code is not None:
+            return Response(exception_code=code)
+        if crc16(reply) != 0 or reply[0] != slave or reply[2] != 2 * count:
+            raise RtuError('bad reply {0}'.format(reply.hex()))
+        return Response(list(struct.unpack_from('>%dH' % count, reply, 3)))
+
+
+def _rate(fn, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return n / (time.perf_counter() - t0)
+
+
+def _check(cache, framer, n=20000):
+    # Byte-exact against pymodbus over random slaves, addresses and values
+    import random
+    from pymodbus.register_read_message import ReadHoldingRegistersRequest
+    from pymodbus.register_write_message import \
+        WriteMultipleRegistersRequest, WriteSingleRegisterRequest
+    rng = random.Random(242)
+    bad = 0
+    for _ in range(n):
+        slave = rng.randint(1, 247)
+        address = rng.choice((0x2088, 0x200D, 0x20AB, rng.randint(0, 0xFF80)))
+        kind = rng.randint(0, 2)
+        if kind == 0:
+            value = rng.randint(0, 0xFFFF)
+            ours = cache.write_register(slave, address, value)[0]
+            request = WriteSingleRegisterRequest(address, value, slave=slave)
+        elif kind == 1:
+            values = [rng.randint(0, 0xFFFF)
+                      for _ in range(rng.randint(1, 123))]
+            ours = cache.write_registers(slave, address, values)[0]
+            request = WriteMultipleRegistersRequest(address, values,
+                                                    slave=slave)
+        else:
+            count = rng.randint(1, 125)
+            ours = cache.read_holding_registers(slave, address, count)[0]
+            request = ReadHoldingRegistersRequest(address, count,
+                                                  slave=slave)
+        if bytes(ours) != framer.buildPacket(request):
+            bad += 1
+    return bad
+
+
+async def _writes(port, fast, n):
+    from modbus_motor import MotorClient, TARGET_SPEED
+    async with MotorClient(port, fast=fast) as motor:
+        await motor.set_speed(0, 0)
+        cpu = time.thread_time()
+        wall = time.perf_counter()
+        for i in range(n):
+            await motor.set_speed(i % 200 - 100, 100 - i % 200)
+        cpu = time.thread_time() - cpu
+        wall = time.perf_counter() - wall
+        registers = await motor.read(TARGET_SPEED, 2)
+    return cpu / n, wall / n, registers
+
+
+def _bench(n=100000, writes=1000):
+    from pymodbus.register_write_message import WriteMultipleRegistersRequest
+    from pymodbus.transaction import ModbusRtuFramer
+    from modbus_sim import crc16 as bitwise_crc16
+    from modbus_sim import SlaveSimulator
+    frame = bytes.fromhex('01102088000204000afff6')
+    print("crc16 over 11 bytes: bitwise {0:9.0f}/s, table {1:9.0f}/s".format(
+        _rate(lambda i: bitwise_crc16(frame), n // 10),
+        _rate(lambda i: crc16(frame), n)))
+    cache = FrameCache()
+    framer = ModbusRtuFramer(None)
+    print("PDF example 01 06 20 0D 00 03 53 C8: {0}".format(
+        bytes(cache.write_register(1, 0x200D, 3)[0]).hex(' ').upper()))
+
+    def stock(i):
+        framer.buildPacket(WriteMultipleRegistersRequest(
+            0x2088, [i & 0xFF, 0xFF00 | i & 0xFF], slave=1))
+
+    def fast(i):
+        cache.write_registers(1, 0x2088, (i & 0xFF, 0xFF00 | i & 0xFF))
+    stock_rate = _rate(stock, n // 10)
+    fast_rate = _rate(fast, n)
+    print("encode 0x2088 pair: pymodbus {0:9.0f} frames/s ({1:5.1f} us), "
+          "cache {2:9.0f} frames/s ({3:5.2f} us), {4:.0f}x".format(
+              stock_rate, 1e6 / stock_rate, fast_rate, 1e6 / fast_rate,
+              fast_rate / stock_rate))
+    print("byte-exact vs pymodbus: {0} mismatches in 20000 frames".format(
+        _check(cache, framer)))
+    with SlaveSimulator() as sim:
+        for label, fast in (('pymodbus client', False),
+                            ('RtuLink + cache', True)):
+            cpu, wall, registers = asyncio.run(_writes(sim.port, fast, writes))
+            print("{0:16s} awaited set_speed: {1:6.0f} us CPU, {2:6.0f} us "
+                  "wall per write, target now {3}".format(
+                      label, cpu * 1e6, wall * 1e6, registers))
+        print("simulator: {0} requests, {1} CRC errors".format(
+            sim.transactions(), sim.crc_errors))
+
+
+if __name__ == '__main__':
+    _bench()
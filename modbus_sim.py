@@ -0,0 +1,296 @@
+# Local Modbus RTU slave simulator on a pseudo-terminal.
+#
+# Stands in for the ZLAC8015D (SZ) motor controller on the RS-485 bus so
+# the Modbus clients can be run and measured on any Linux box: the client
+# opens `sim.port` (the pty's slave side, e.g. /dev/pts/5) exactly as it
+# would open /dev/ttyTHS1, and a thread answers on the master side.
+#
+# The pty itself is instant, so the simulator sleeps for the time the
+# request and the response would take on the wire at `baudrate` (10 bits
+# per byte, 8N1) plus a turnaround delay before it answers. The bus then
+# runs at the real controller's pace and batching or coalescing shows up
+# in the numbers the way it would on the board.
+#
+# Supported: read holding/input registers (3, 4), write single register
+# (6), write multiple registers (16), broadcast writes to unit 0, and an
+# illegal-function exception for anything else. Each unit models the two
+# drives of a ZLAC8015D in velocity mode: once enabled, the actual speed
+# registers (0x20AB/0x20AC, 0.1 r/min) follow the targets (0x2088/0x2089,
+# r/min) at the set acceleration/deceleration times, the actual positions
+# (0x20A7-0x20AA) integrate them and the read-only bus voltage, status,
+# temperature and current registers hold plausible values.
+#
+# `faults` maps a register to the exception code that any request
+# touching it is answered with, for trying a client's error handling.
+#
+#   python3 modbus_sim.py            # run a simulator, print its port
+import os
+import select
+import struct
+import threading
+import time
+import tty
+
+from modbus_motor import ACCEL_TIME, ACTUAL_POSITION, ACTUAL_SPEED, \
+    BUS_VOLTAGE, CONTROL_MODE, CONTROL_WORD, DECEL_TIME, DRIVER_TEMP, \
+    EMERGENCY_STOP, ENABLE, MOTOR_TEMP, STATUS_WORD, TARGET_SPEED, \
+    VELOCITY_MODE
+
+# Acceleration times are the time to go from 0 to this speed (r/min)
+RATED_SPEED = 3000.0
+# Encoder counts per motor revolution
+COUNTS_PER_REV = 4096
+
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_ADDRESS = 0x02
+
+
+def crc16(data):
+    # Modbus CRC-16 (poly 0xA001 reflected, init 0xFFFF); the frame carries
+    # it low byte first
+    crc = 0xFFFF
+    for byte in bytearray(data):
+        crc ^= byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+
+def frame(body):
+    return bytes(body) + struct.pack('<H', crc16(body))
+
+
+class SimulatedDrive(object):
+    # Register map of one unit plus the two motors' actual speeds
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.registers = {ACCEL_TIME: 500, ACCEL_TIME + 1: 500,
+                          DECEL_TIME: 500, DECEL_TIME + 1: 500,
+                          BUS_VOLTAGE: 4800, MOTOR_TEMP: 0x1E1E,
+                          DRIVER_TEMP: 350}
+        # Actual speeds in r/min and positions in counts, and when they
+        # were last brought up to date
+        self.speed = [0.0, 0.0]
+        self.position = [0.0, 0.0]
+        self.updated = clock()
+
+    def enabled(self):
+        return self.registers.get(CONTROL_MODE) == VELOCITY_MODE and \
+            self.registers.get(CONTROL_WORD) == ENABLE
+
+    def _advance(self):
+        now = self.clock()
+        dt = now - self.updated
+        self.updated = now
+        regs = self.registers
+        for side in (0, 1):
+            target = 0.0
+            if self.enabled():
+                target = float(_signed(regs.get(TARGET_SPEED + side, 0)))
+            speed = self.speed[side]
+            self.position[side] += speed / 60.0 * COUNTS_PER_REV * dt
+            if regs.get(CONTROL_WORD) == EMERGENCY_STOP:
+                self.speed[side] = 0.0
+                continue
+            speeding_up = abs(target) > abs(speed)
+            ms = regs.get((ACCEL_TIME if speeding_up else DECEL_TIME) + side)
+            step = RATED_SPEED * dt / max(ms, 1) * 1000.0
+            if abs(target - speed) <= step:
+                self.speed[side] = target
+            else:
+                self.speed[side] = speed + (step if target > speed else -step)
+
+    def read(self, address, count):
+        self._advance()
+        regs = dict(self.registers)
+        for side in (0, 1):
+            regs[ACTUAL_SPEED + side] = int(round(self.speed[side] * 10))
+            position = int(self.position[side]) & 0xFFFFFFFF
+            regs[ACTUAL_POSITION + 2 * side] = position >> 16
+            regs[ACTUAL_POSITION + 2 * side + 1] = position & 0xFFFF
+        # Status word: running bits 0 (left) and 8 (right)
+        regs[STATUS_WORD] = (self.speed[0] != 0) | (self.speed[1] != 0) << 8
+        return [regs.get(a, 0) & 0xFFFF
+                for a in range(address, address + count)]
+
+    def write(self, address, values):
+        self._advance()
+        for i, value in enumerate(values):
+            self.registers[address + i] = value
+
+
+def _signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+class SlaveSimulator(object):
+    def __init__(self, units=(1,), baudrate=115200, turnaround=0.0005):
+        self.baudrate = baudrate
+        self.byte_time = 10.0 / baudrate
+        self.turnaround = turnaround
+        self.drives = dict((unit, SimulatedDrive()) for unit in units)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.buf = bytearray()
+        # Requests by function code, bytes each way, CRC errors
+        self.requests = {}
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.crc_errors = 0
+        # (function, address, count) of every write, for checking batching
+        self.writes = []
+        # register -> exception code
+        self.faults = {}
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def registers(self, unit=1):
+        return self.drives[unit].registers
+
+    def transactions(self):
+        return sum(self.requests.values())
+
+    def _run(self):
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.05)
+            if not readable:
+                # Silence on the line: whatever is buffered is garbage
+                if self.buf:
+                    del self.buf[:]
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                continue
+            self.rx_bytes += len(data)
+            self.buf += data
+            while True:
+                n = self._frame_length()
+                if n is None or len(self.buf) < n:
+                    break
+                request = bytes(self.buf[:n])
+                del self.buf[:n]
+                self._handle(request)
+
+    def _frame_length(self):
+        # Length of the request at the front of buf from its function
+        # code, None until enough of it has arrived
+        buf = self.buf
+        if len(buf) < 2:
+            return None
+        function = buf[1]
+        if function in (3, 4, 6):
+            return 8
+        if function == 16:
+            if len(buf) < 7:
+                return None
+            return 9 + buf[6]
+        # Unknown function: take unit + function + CRC and answer with an
+        # exception
+        return 4
+
+    def _handle(self, request):
+        start = time.monotonic()
+        body, crc = request[:-2], request[-2:]
+        if struct.pack('<H', crc16(body)) != crc:
+            self.crc_errors += 1
+            return
+        unit, function = body[0], body[1]
+        if unit != 0 and unit not in self.drives:
+            return
+        with self.lock:
+            self.requests[function] = self.requests.get(function, 0) + 1
+            response = self._respond(unit, function, body)
+        if unit == 0:
+            return
+        # Request and response time on the wire, plus the drive's turnaround
+        delay = (len(request) + len(response)) * self.byte_time + \
+            self.turnaround - (time.monotonic() - start)
+        if delay > 0:
+            time.sleep(delay)
+        os.write(self.master, response)
+        self.tx_bytes += len(response)
+
+    def _fault(self, address, count):
+        for register, code in self.faults.items():
+            if address <= register < address + count:
+                return code
+        return None
+
+    def _respond(self, unit, function, body):
+        drives = self.drives.values() if unit == 0 else [self.drives[unit]]
+        if function in (3, 4, 6, 16):
+            address, count = struct.unpack('>HH', body[2:6])
+            code = self._fault(address, 1 if function == 6 else count)
+            if code is not None:
+                return frame(bytes((unit, function | 0x80, code)))
+        if function in (3, 4):
+            address, count = struct.unpack('>HH', body[2:6])
+            if not 1 <= count <= 125:
+                return frame(bytes((unit, function | 0x80, ILLEGAL_ADDRESS)))
+            values = self.drives[unit].read(address, count)
+            return frame(struct.pack('>BBB%dH' % count, unit, function,
+                                     2 * count, *values))
+        if function == 6:
+            address, value = struct.unpack('>HH', body[2:6])
+            for drive in drives:
+                drive.write(address, [value])
+            self.writes.append((function, address, 1))
+            return frame(body)
+        if function == 16:
+            address, count, nbytes = struct.unpack('>HHB', body[2:7])
+            if nbytes != 2 * count or not 1 <= count <= 123:
+                return frame(bytes((unit, function | 0x80, ILLEGAL_ADDRESS)))
+            values = struct.unpack('>%dH' % count, body[7:7 + nbytes])
+            for drive in drives:
+                drive.write(address, values)
+            self.writes.append((function, address, count))
+            return frame(body[:6])
+        return frame(bytes((unit, function | 0x80, ILLEGAL_FUNCTION)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Modbus RTU motor controller simulator on a pty')
+    parser.add_argument('--units', default='1',
+                        help='comma-separated unit ids')
+    parser.add_argument('--baudrate', type=int, default=115200)
+    args = parser.parse_args()
+    sim = SlaveSimulator([int(u) for u in args.units.split(',')],
+                         args.baudrate).start()
+    print("simulated controller on {0}, Ctrl-C to quit".format(sim.port))
+    try:
+        while True:
+            time.sleep(10)
+            print("{0} requests, {1} CRC errors".format(
+                sim.transactions(), sim.crc_errors))
+    except KeyboardInterrupt:
+        sim.stop()
@@ -0,0 +1,399 @@
+# Fixed-rate closed-loop heading control on an asyncio event loop.
+#
+# Ties the course pieces together: the LSM303 heading (SampleRing, as
+# filled by lsm303_tcp.py), a PID controller like the C one from the PID
+# lab (20-2021S-9-PIDtest.c), and the motors, either the ZLAC8015D wheel
+# drives through modbus_motor.MotorClient or a PWM output as in
+# 2023S-103b-pwm.py.
+#
+# ControlLoop ticks at a fixed rate (lsm303_sched.RateScheduler, async
+# variant). Each tick it takes the freshest sample without waiting for
+# one: a tick with nothing new since the last is counted as stale and the
+# command is left as it is. Otherwise the PID computes the command and
+# the actuator gets it. The Modbus actuator only drops it into the
+# client's latest-wins speed slot, so a slow bus never stalls the loop.
+#
+# PID works on the error wrapped into +-180 deg, takes the derivative of
+# the measurement (no kick on setpoint steps, low-pass filtered) and
+# stops integrating while the output is saturated and the error would
+# push it further (conditional integration anti-windup).
+#
+# Latency is measured from the sensor timestamp (epoch us, as the
+# sources stamp samples) to the actuator write, and for Modbus also to
+# the drive's acknowledgement. Deadline misses and jitter come from the
+# scheduler.
+#
+# VehiclePlant simulates a differential-drive vehicle: a sampler thread
+# integrates the heading from the wheel speeds and appends synthetic
+# accel/mag samples to a SampleRing at the sensor rate, so the loop reads
+# the same structures it does on the Jetson. The wheels either follow
+# their commands with a first-order lag, or are the simulated ZLAC8015D
+# of modbus_sim behind a real MotorClient on a pty.
+#
+#   python3 pid_loop.py                   # loop rates, anti-windup, Modbus
+#   python3 pid_loop.py --rates 100 500 --seconds 3
+import asyncio
+import math
+import random
+import threading
+import time
+
+from lsm303_heading import heading_scalar
+from lsm303_metrics import LogHistogram
+from lsm303_ring import SampleRing
+from lsm303_sched import RateScheduler
+
+# Wheel radius and track of the hub-motor base, m
+WHEEL_RADIUS = 0.0825
+TRACK = 0.40
+# Fastest LSM303DLHC output data rate, Hz
+SENSOR_RATE = 1344.0
+
+
+def wrap180(angle):
+    return (angle + 180.0) % 360.0 - 180.0
+
+
+class PID(object):
+    def __init__(self, kp, ki=0.0, kd=0.0, out_min=-1.0, out_max=1.0,
+                 wrap=True, d_filter=0.02, anti_windup=True):
+        # wrap: error and measurement steps taken modulo 360 deg; d_filter:
+        # time constant of the derivative low-pass, s
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.out_min = out_min
+        self.out_max = out_max
+        self.wrap = wrap
+        self.d_filter = d_filter
+        self.anti_windup = anti_windup
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.previous = None
+        self.output = 0.0
+
+    def update(self, setpoint, measurement, dt):
+        error = setpoint - measurement
+        if self.wrap:
+            error = wrap180(error)
+        if self.previous is not None and dt > 0:
+            step = measurement - self.previous
+            if self.wrap:
+                step = wrap180(step)
+            # First-order low-pass of -d(measurement)/dt
+            a = dt / (self.d_filter + dt)
+            self.derivative += a * (-step / dt - self.derivative)
+        self.previous = measurement
+
+        p = self.kp * error
+        d = self.kd * self.derivative
+        integral = self.integral + self.ki * error * dt
+        output = p + integral + d
+        if output > self.out_max:
+            if not self.anti_windup or error < 0:
+                self.integral = integral
+            output = self.out_max
+        elif output < self.out_min:
+            if not self.anti_windup or error > 0:
+                self.integral = integral
+            output = self.out_min
+        else:
+            self.integral = integral
+        self.output = output
+        return output
+
+
+class RingSensor(object):
+    # Freshest heading in a SampleRing, recomputed from its accel/mag so
+    # it does not depend on when the producer fills ring.heading
+    def __init__(self, ring, cal=None):
+        self.ring = ring
+        self.cal = cal
+
+    def latest(self):
+        # -> (ts_us, heading_deg) or None; never blocks
+        ring = self.ring
+        head = ring.head
+        if head == 0:
+            return None
+        i = (head - 1) % ring.capacity
+        j = 3 * i
+        ts = ring.ts[i]
+        accel = ring.accel[j:j + 3]
+        mag = ring.mag[j:j + 3]
+        return ts, heading_scalar(accel, mag, self.cal)
+
+
+class ModbusActuator(object):
+    # Differential steering: u r/min added to the left wheel and taken off
+    # the right (positive u turns clockwise, raising the heading). motor is
+    # a MotorClient, or anything else with its set_speed()
+    def __init__(self, motor, base=0):
+        self.motor = motor
+        self.base = base
+
+    def write(self, u):
+        # The future resolves when the drive acknowledges the target
+        return self.motor.set_speed(self.base + u, self.base - u)
+
+
+class PwmActuator(object):
+    # u in -1..1 mapped onto a duty cycle of a PWM handle that stays open
+    # (RPi.GPIO / Jetson.GPIO GPIO.PWM, or anything with ChangeDutyCycle)
+    def __init__(self, pwm, center=50.0, span=50.0):
+        self.pwm = pwm
+        self.center = center
+        self.span = span
+
+    def write(self, u):
+        duty = self.center + self.span * u
+        self.pwm.ChangeDutyCycle(max(0.0, min(100.0, duty)))
+        return None
+
+
+class ControlLoop(object):
+    def __init__(self, sensor, pid, actuator, rate=100.0, setpoint=0.0,
+                 clock=time.time):
+        self.sensor = sensor
+        self.pid = pid
+        self.actuator = actuator
+        self.rate = rate
+        self.setpoint = setpoint
+        self.clock = clock
+        self.scheduler = RateScheduler(rate)
+        self.latency = LogHistogram()       # sensor -> actuator write
+        self.ack = LogHistogram()           # sensor -> acknowledgement
+        self.compute = LogHistogram()
+        self.updates = 0
+        self.stale = 0
+        self.errors = 0
+        self.last_ts = None
+        # (t, measurement, output) of every update when recording
+        self.trace = None
+
+    async def run(self, seconds=None):
+        scheduler = self.scheduler
+        scheduler.reset()
+        stop = None if seconds is None else \
+            time.monotonic() + seconds
+        while stop is None or time.monotonic() < stop:
+            await scheduler.wait_async()
+            t0 = time.perf_counter_ns()
+            sample = self.sensor.latest()
+            if sample is None or sample[0] == self.last_ts:
+                self.stale += 1
+                continue
+            ts, measurement = sample
+            dt = (ts - self.last_ts) / 1e6 if self.last_ts is not None \
+                else 1.0 / self.rate
+            self.last_ts = ts
+            u = self.pid.update(self.setpoint, measurement, dt)
+            result = self.actuator.write(u)
+            written = self.clock()
+            self.compute.record(time.perf_counter_ns() - t0)
+            self.latency.record(int((written * 1e6 - ts) * 1000))
+            if result is not None:
+                result.add_done_callback(
+                    lambda f, ts=ts: self._acked(f, ts))
+            self.updates += 1
+            if self.trace is not None:
+                self.trace.append((ts / 1e6, measurement, u))
+
+    def _acked(self, future, ts):
+        if future.cancelled() or future.exception() is not None:
+            self.errors += 1
+            return
+        self.ack.record(int((self.clock() * 1e6 - ts) * 1000))
+
+    def report(self):
+        stats = self.scheduler.stats
+        return {'ticks': stats.ticks, 'updates': self.updates,
+                'stale': self.stale, 'overruns': stats.overruns,
+                'missed': stats.missed, 'errors': self.errors,
+                'jitter_p99_us': stats.percentile(99) * 1e6,
+                'compute': self.compute.summary(),
+                'latency': self.latency.summary(),
+                'ack': self.ack.summary()}
+
+
+class LagWheels(object):
+    # Wheel speeds following their commands with a first-order lag
+    def __init__(self, tau=0.05):
+        self.tau = tau
+        self.command = [0.0, 0.0]
+        self.speed = [0.0, 0.0]
+
+    def set_speed(self, left, right):
+        self.command = [float(left), float(right)]
+        return None
+
+    def advance(self, dt):
+        a = dt / (self.tau + dt)
+        for side in (0, 1):
+            self.speed[side] += a * (self.command[side] - self.speed[side])
+        return self.speed
+
+
+class SimDriveWheels(object):
+    # The actual speeds of a modbus_sim drive, read in-process
+    def __init__(self, sim, unit=1):
+        self.sim = sim
+        self.unit = unit
+
+    def advance(self, dt):
+        drive = self.sim.drives[self.unit]
+        with self.sim.lock:
+            drive.read(0, 0)
+            return list(drive.speed)
+
+
+class VehiclePlant(object):
+    # Differential-drive heading from wheel speeds (r/min), sampled into
+    # a SampleRing as a flat LSM303 would see it, with count noise
+    def __init__(self, wheels, rate=100.0, heading=0.0, noise=2.0,
+                 ring=None, seed=242):
+        self.wheels = wheels
+        self.rate = rate
+        self.heading = heading
+        self.noise = noise
+        self.ring = ring if ring is not None else SampleRing()
+        self.rng = random.Random(seed)
+        self.running = False
+        self.thread = None
+
+    def _sample(self, dt):
+        left, right = self.wheels.advance(dt)
+        # Left faster than right turns clockwise
+        v = (left - right) * 2 * math.pi * WHEEL_RADIUS / 60.0
+        self.heading = (self.heading +
+                        math.degrees(v / TRACK) * dt) % 360.0
+        r = math.radians(self.heading)
+        g = self.rng.gauss
+        mag = (int(round(1000 * math.cos(r) + g(0, self.noise))),
+               int(round(1000 * math.sin(r) + g(0, self.noise))),
+               -300)
+        accel = (int(round(g(0, self.noise))),
+                 int(round(g(0, self.noise))), 1000)
+        self.ring.append(int(round(time.time() * 1e6)), self.heading,
+                         accel, mag)
+
+    def _run(self):
+        scheduler = RateScheduler(self.rate)
+        period = 1.0 / self.rate
+        while self.running:
+            scheduler.wait()
+            self._sample(period)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def step_response(trace, setpoint, start):
+    # Overshoot (deg) and 2 deg settling time (s) of a heading step
+    if not trace:
+        return float('nan'), float('nan')
+    t0 = trace[0][0]
+    sign = 1.0 if wrap180(setpoint - start) >= 0 else -1.0
+    overshoot = max(0.0, max(sign * wrap180(m - setpoint)
+                             for _, m, _ in trace))
+    settled = t0
+    for t, m, _ in trace:
+        if abs(wrap180(m - setpoint)) > 2.0:
+            settled = t
+    return overshoot, settled - t0
+
+
+def _gains(anti_windup=True):
+    # Output is r/min of differential wheel speed
+    return PID(kp=3.0, ki=2.0, kd=0.15, out_min=-60.0, out_max=60.0,
+               anti_windup=anti_windup)
+
+
+async def _lag_run(rate, seconds, setpoint, anti_windup=True):
+    wheels = LagWheels()
+    plant = VehiclePlant(wheels, rate=SENSOR_RATE).start()
+    loop = ControlLoop(RingSensor(plant.ring), _gains(anti_windup),
+                       ModbusActuator(wheels), rate, setpoint)
+    loop.trace = []
+    await loop.run(seconds)
+    plant.stop()
+    return loop
+
+
+async def _modbus_run(port, sim, rate, seconds, setpoint, fast):
+    from modbus_motor import MotorClient
+    async with MotorClient(port, fast=fast) as motor:
+        await motor.velocity_mode()
+        plant = VehiclePlant(SimDriveWheels(sim), rate=SENSOR_RATE).start()
+        loop = ControlLoop(RingSensor(plant.ring), _gains(),
+                           ModbusActuator(motor), rate, setpoint)
+        loop.trace = []
+        await loop.run(seconds)
+        plant.stop()
+        await motor.stop()
+        return loop, motor.stats()
+
+
+def _line(label, loop, setpoint):
+    r = loop.report()
+    overshoot, settle = step_response(loop.trace, setpoint, 0.0)
+    final = loop.trace[-1][1] if loop.trace else float('nan')
+    print("{0:22s} {1:5d} updates {2:4d} stale {3:3d} missed, jitter p99 "
+          "{4:6.0f} us, compute p50 {5:4.0f} us, sensor->write p50 {6:6.0f} "
+          "us p99 {7:6.0f} us".format(
+              label, r['updates'], r['stale'], r['missed'],
+              r['jitter_p99_us'], r['compute']['p50'], r['latency']['p50'],
+              r['latency']['p99']))
+    print("{0:22s} step 0 -> {1:.0f} deg: overshoot {2:5.1f} deg, "
+          "settled in {3:5.2f} s, final {4:6.1f} deg".format(
+              '', setpoint, overshoot, settle, final))
+    return r
+
+
+def _bench(rates=(50, 100, 200, 500, 1000), seconds=4.0, setpoint=90.0):
+    from modbus_sim import SlaveSimulator
+    print("lag wheels, sensor at {0:.0f} Hz:".format(SENSOR_RATE))
+    for rate in rates:
+        loop = asyncio.run(_lag_run(rate, seconds, setpoint))
+        _line("  {0} Hz".format(rate), loop, setpoint)
+    print("anti-windup at 100 Hz, 170 deg step (saturates):")
+    for anti_windup in (False, True):
+        loop = asyncio.run(_lag_run(100, seconds, 170.0, anti_windup))
+        _line("  {0}".format('on' if anti_windup else 'off'), loop, 170.0)
+    print("simulated ZLAC8015D through MotorClient on a pty, 100 Hz:")
+    with SlaveSimulator() as sim:
+        for fast in (False, True):
+            loop, stats = asyncio.run(
+                _modbus_run(sim.port, sim, 100, seconds, setpoint, fast))
+            r = _line("  {0}".format('RtuLink' if fast else 'pymodbus'),
+                      loop, setpoint)
+            print("{0:22s} sensor->ack p50 {1:6.0f} us p99 {2:6.0f} us, "
+                  "{3:.0f} bus writes/s, {4} superseded".format(
+                      '', r['ack']['p50'], r['ack']['p99'],
+                      stats['transactions_per_s'], stats['superseded']))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Fixed-rate heading PID loop on a simulated vehicle')
+    parser.add_argument('--rates', type=float, nargs='+',
+                        default=[50, 100, 200, 500, 1000])
+    parser.add_argument('--seconds', type=float, default=4.0)
+    parser.add_argument('--setpoint', type=float, default=90.0)
+    args = parser.parse_args()
+    _bench([int(r) if r == int(r) else r for r in args.rates],
+           args.seconds, args.setpoint)
@@ -0,0 +1,350 @@
+# Precomputed PWM motion profiles for step/direction stepper drives.
+#
+# With a step/dir driver every PWM pulse is one (micro)step, so the PWM
+# frequency is the motor speed and its integral the position. The 2023S
+# PWM script changes the duty cycle between time.sleep() calls (and
+# builds a new GPIO.PWM(33, 500) halfway through), so every update lands
+# late by the sleep overshoot plus the call time, the errors add up, and
+# an acceleration ramp or a 1/8 micro-step move cannot be timed.
+#
+# A Profile is built up front as numpy arrays sampled every dt seconds:
+# frequency (steps/s), duty cycle (%) and position (steps). trapezoid()
+# ramps at a constant acceleration up to v_max (or a triangle when the
+# move is too short); s_curve() limits the jerk as well by running the
+# trapezoid's speed through a moving average one accel/jerk long, which
+# keeps the distance exact and makes the acceleration a ramp instead of
+# a step. The frequency is scaled so the sampled profile integrates to
+# exactly the requested number of steps.
+#
+# ProfilePlayer applies row i at start + i * dt (lsm303_sched's spin
+# scheduler, so no drift), writes only what changed, and records the
+# timing error of every update. The PWM handle is opened once and kept:
+#
+#   SimPwm      counts the pulses it would have produced (integrates the
+#               frequency over the time each setting was held)
+#   GpioPwm     one RPi.GPIO / Jetson.GPIO GPIO.PWM for the whole run
+#   SysfsPwm    /sys/class/pwm channel with period and duty_cycle files
+#               kept open and rewritten with pwrite()
+#
+#   python3 pwm_profile.py              # profiles, player vs sleep on SimPwm
+#   python3 pwm_profile.py --steps 3200 --rate 2000
+import os
+import time
+
+import numpy as np
+
+from lsm303_metrics import LogHistogram
+from lsm303_sched import RateScheduler
+
+# Full step angle and micro-stepping of the lab's stepper (1/8 step)
+STEP_ANGLE = 1.8
+MICROSTEPS = 8
+DUTY = 50.0
+
+
+class Profile(object):
+    def __init__(self, dt, freq, duty=DUTY):
+        self.dt = dt
+        self.freq = np.ascontiguousarray(freq, dtype=np.float64)
+        self.duty = np.where(self.freq > 0, duty, 0.0)
+        self.position = np.cumsum(self.freq) * dt
+
+    def __len__(self):
+        return len(self.freq)
+
+    def duration(self):
+        return len(self.freq) * self.dt
+
+    def steps(self):
+        return float(self.position[-1]) if len(self.position) else 0.0
+
+
+def _trapezoid_speed(steps, v_max, accel, dt):
+    # Sampled speed of a constant-acceleration move of `steps`
+    steps = float(abs(steps))
+    if steps == 0:
+        return np.zeros(1)
+    t_ramp = v_max / accel
+    if accel * t_ramp * t_ramp > steps:
+        # Never reaches v_max: triangle
+        t_ramp = (steps / accel) ** 0.5
+        v_max = accel * t_ramp
+        t_cruise = 0.0
+    else:
+        t_cruise = (steps - accel * t_ramp * t_ramp) / v_max
+    total = 2 * t_ramp + t_cruise
+    # Speed at the middle of each interval
+    t = (np.arange(int(np.ceil(total / dt))) + 0.5) * dt
+    return np.minimum(np.minimum(accel * t, v_max),
+                      np.maximum(accel * (total - t), 0.0))
+
+
+def _exact(speed, steps, dt):
+    # Scale so the profile integrates to exactly `steps`
+    area = speed.sum() * dt
+    return speed * (abs(steps) / area) if area > 0 else speed
+
+
+def trapezoid(steps, v_max, accel, dt=0.001, duty=DUTY):
+    speed = _trapezoid_speed(steps, v_max, accel, dt)
+    return Profile(dt, _exact(speed, steps, dt), duty)
+
+
+def s_curve(steps, v_max, accel, jerk, dt=0.001, duty=DUTY):
+    # Moving average over accel / jerk seconds: the acceleration ramps up
+    # at `jerk` instead of jumping, and the area (distance) is unchanged
+    speed = _trapezoid_speed(steps, v_max, accel, dt)
+    width = max(1, int(round(accel / jerk / dt)))
+    if width > 1:
+        speed = np.convolve(speed, np.ones(width) / width)
+    return Profile(dt, _exact(speed, steps, dt), duty)
+
+
+class SimPwm(object):
+    # A PWM output that counts the pulses it would have produced
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.frequency = 0.0
+        self.duty = 0.0
+        self.pulses = 0.0
+        self.since = None
+        self.updates = 0
+
+    def _hold(self):
+        now = self.clock()
+        if self.since is not None and self.duty > 0:
+            self.pulses += self.frequency * (now - self.since)
+        self.since = now
+
+    def start(self, duty):
+        self._hold()
+        self.duty = duty
+
+    def ChangeFrequency(self, frequency):
+        self._hold()
+        self.frequency = frequency
+        self.updates += 1
+
+    def ChangeDutyCycle(self, duty):
+        self._hold()
+        self.duty = duty
+        self.updates += 1
+
+    def stop(self):
+        self._hold()
+        self.duty = 0.0
+
+
+class GpioPwm(object):
+    # GPIO.PWM on `pin` (BOARD), created once and kept for the whole run
+    def __init__(self, pin=33, frequency=500, module=None):
+        if module is None:
+            try:
+                import Jetson.GPIO as module
+            except ImportError:
+                import RPi.GPIO as module
+        self.GPIO = module
+        module.setwarnings(False)
+        module.setmode(module.BOARD)
+        module.setup(pin, module.OUT, initial=module.LOW)
+        self.pin = pin
+        self.pwm = module.PWM(pin, frequency)
+
+    def start(self, duty):
+        self.pwm.start(duty)
+
+    def ChangeFrequency(self, frequency):
+        # GPIO.PWM rejects 0 Hz; the duty cycle of 0 stops the pulses
+        if frequency > 0:
+            self.pwm.ChangeFrequency(frequency)
+
+    def ChangeDutyCycle(self, duty):
+        self.pwm.ChangeDutyCycle(duty)
+
+    def stop(self):
+        self.pwm.stop()
+        self.GPIO.cleanup(self.pin)
+
+
+class SysfsPwm(object):
+    # /sys/class/pwm/pwmchipN/pwmM with its files opened once
+    def __init__(self, chip=0, channel=0):
+        base = '/sys/class/pwm/pwmchip{0}'.format(chip)
+        path = '{0}/pwm{1}'.format(base, channel)
+        if not os.path.exists(path):
+            with open(base + '/export', 'w') as f:
+                f.write(str(channel))
+        self.period_fd = os.open(path + '/period', os.O_WRONLY)
+        self.duty_fd = os.open(path + '/duty_cycle', os.O_WRONLY)
+        self.enable_fd = os.open(path + '/enable', os.O_WRONLY)
+        self.period = 0
+        self.duty = 0.0
+        self.enabled = False
+
+    def _write(self, fd, value):
+        os.pwrite(fd, str(int(value)).encode(), 0)
+
+    def start(self, duty):
+        # The kernel refuses enable while the period is 0, so the channel
+        # is enabled by the first frequency set instead
+        self.duty = duty
+
+    def ChangeFrequency(self, frequency):
+        # 0 Hz has no period; the duty cycle of 0 stops the pulses
+        if frequency <= 0:
+            return
+        period = int(1e9 / frequency)
+        # duty_cycle may never exceed period: shrink it first when the
+        # period gets shorter
+        duty = int(period * self.duty / 100.0)
+        if period < self.period:
+            self._write(self.duty_fd, duty)
+            self._write(self.period_fd, period)
+        else:
+            self._write(self.period_fd, period)
+            self._write(self.duty_fd, duty)
+        self.period = period
+        if not self.enabled:
+            self._write(self.enable_fd, 1)
+            self.enabled = True
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = duty
+        # Before the first frequency there is no period to take it from;
+        # ChangeFrequency() writes it
+        if self.period:
+            self._write(self.duty_fd, int(self.period * duty / 100.0))
+
+    def stop(self):
+        if self.enabled:
+            self._write(self.enable_fd, 0)
+            self.enabled = False
+        for fd in (self.period_fd, self.duty_fd, self.enable_fd):
+            os.close(fd)
+
+
+class ProfilePlayer(object):
+    def __init__(self, pwm, spin=0.0002):
+        self.pwm = pwm
+        self.spin = spin
+        self.errors = None
+        self.hist = LogHistogram()
+        self.missed = 0
+        self.writes = 0
+
+    def play(self, profile):
+        pwm = self.pwm
+        freq = profile.freq.tolist()
+        duty = profile.duty.tolist()
+        n = len(freq)
+        scheduler = RateScheduler(1.0 / profile.dt, spin=self.spin,
+                                  clock=time.perf_counter)
+        # Timing error of each row, s; NaN where the row was skipped
+        errors = np.full(n, np.nan)
+        hist = self.hist
+        last_f = last_d = None
+        pwm.start(0.0)
+        while True:
+            tick, deadline = scheduler.wait()
+            if tick >= n:
+                break
+            f, d = freq[tick], duty[tick]
+            if f != last_f:
+                pwm.ChangeFrequency(f)
+                last_f = f
+                self.writes += 1
+            if d != last_d:
+                pwm.ChangeDutyCycle(d)
+                last_d = d
+                self.writes += 1
+            error = time.perf_counter() - deadline
+            errors[tick] = error
+            hist.record(int(error * 1e9))
+        pwm.ChangeDutyCycle(0.0)
+        pwm.stop()
+        self.missed = scheduler.stats.missed
+        self.errors = errors
+        return errors
+
+
+def play_with_sleep(pwm, profile):
+    # The 2023S script's way: set, then sleep dt
+    freq = profile.freq.tolist()
+    duty = profile.duty.tolist()
+    errors = np.empty(len(freq))
+    pwm.start(0.0)
+    start = time.perf_counter()
+    for i in range(len(freq)):
+        pwm.ChangeFrequency(freq[i])
+        pwm.ChangeDutyCycle(duty[i])
+        errors[i] = time.perf_counter() - (start + i * profile.dt)
+        time.sleep(profile.dt)
+    pwm.ChangeDutyCycle(0.0)
+    pwm.stop()
+    return errors
+
+
+def _summary(errors):
+    e = np.abs(errors[~np.isnan(errors)]) * 1e6
+    if not len(e):
+        return "no updates"
+    return "error p50 {0:7.1f} us  p99 {1:8.1f} us  max {2:8.1f} us".format(
+        np.percentile(e, 50), np.percentile(e, 99), e.max())
+
+
+def _bench(steps=3200, v_max=4000.0, accel=8000.0, jerk=40000.0,
+           rates=(1000, 5000, 20000)):
+    degrees = steps * STEP_ANGLE / MICROSTEPS
+    print("move: {0} steps at 1/{1} step = {2:.0f} deg, v_max {3:.0f} "
+          "steps/s, accel {4:.0f} steps/s^2, jerk {5:.0f} steps/s^3".format(
+              steps, MICROSTEPS, degrees, v_max, accel, jerk))
+    for name, build in (('trapezoid', lambda dt: trapezoid(
+            steps, v_max, accel, dt)),
+            ('s-curve', lambda dt: s_curve(steps, v_max, accel, jerk, dt))):
+        t0 = time.perf_counter()
+        profile = build(0.001)
+        built = time.perf_counter() - t0
+        accel_rows = np.diff(profile.freq) / profile.dt
+        peak_jerk = np.abs(np.diff(accel_rows)).max() / profile.dt
+        print("  {0:9s} {1:5d} rows at 1 ms, {2:.3f} s, built in "
+              "{3:4.0f} us, peak accel {4:5.0f}, peak jerk {5:8.0f}, "
+              "{6:.3f} steps".format(
+                  name, len(profile), profile.duration(), built * 1e6,
+                  np.abs(accel_rows).max(), peak_jerk, profile.steps()))
+    for rate in rates:
+        profile = s_curve(steps, v_max, accel, jerk, 1.0 / rate)
+        print("s-curve at {0} updates/s ({1} rows):".format(rate,
+                                                           len(profile)))
+        for label in ('player', 'sleep'):
+            pwm = SimPwm()
+            t0 = time.perf_counter()
+            if label == 'player':
+                player = ProfilePlayer(pwm)
+                errors = player.play(profile)
+                extra = ", {0} missed".format(player.missed)
+            else:
+                errors = play_with_sleep(pwm, profile)
+                extra = ""
+            elapsed = time.perf_counter() - t0
+            applied = np.count_nonzero(~np.isnan(errors))
+            print("  {0:6s} {1:8.0f} updates/s, took {2:.3f} s for {3:.3f} "
+                  "s, {4}, {5:.1f} pulses for {6}{7}".format(
+                      label, applied / elapsed, elapsed,
+                      profile.duration(), _summary(errors), pwm.pulses,
+                      steps, extra))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Stepper PWM motion profiles and timed playback')
+    parser.add_argument('--steps', type=int, default=3200,
+                        help='micro-steps to move')
+    parser.add_argument('--v-max', type=float, default=4000.0)
+    parser.add_argument('--accel', type=float, default=8000.0)
+    parser.add_argument('--jerk', type=float, default=40000.0)
+    parser.add_argument('--rate', type=int, action='append',
+                        help='table update rates to play, Hz')
+    args = parser.parse_args()
+    _bench(args.steps, args.v_max, args.accel, args.jerk,
+           args.rate or (1000, 5000, 20000))
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from lsm303_collector import Collector
+
+
+@pytest.fixture
+def collector(tmp_path):
+    collector = Collector(port=0, host='127.0.0.1',
+                          store=str(tmp_path / 'store'))
+    yield collector
+    collector.close()
+
+
+@pytest.mark.parametrize('name', ['.', '..', '...', '../..', '/etc',
+                                  '../../tmp/x', 'a/../..'])
+def test_capture_path_stays_under_store(collector, name):
+    store = os.path.abspath(collector.store)
+    path = collector.capture_path(name)
+    assert os.path.dirname(path) == store
+    assert os.path.basename(path) not in ('.', '..')
+
+
+def test_node_named_dots_writes_into_store(collector, tmp_path):
+    collector.node('..')
+    assert os.listdir(str(tmp_path)) == ['store']
+    assert os.listdir(collector.store) == ['_..']
+
+
+def test_plain_names_are_kept(collector):
+    assert os.path.basename(collector.capture_path('agv-07.lab')) == \
+        'agv-07.lab'
@@ -0,0 +1,69 @@
+import os
+
+from lsm303_forward import SampleQueue
+
+
+def _payload(i):
+    return bytes([i]) * 24
+
+
+def _spill(path, n):
+    # Nothing fits in memory: every block goes to a segment
+    queue = SampleQueue(memory_bytes=0, spill_dir=path)
+    for i in range(n):
+        queue.push(1, _payload(i))
+    return queue
+
+
+def _ids(queue):
+    return [queue.load(block)[0] for block in queue.blocks]
+
+
+def test_restart_skips_delivered_blocks(tmp_path):
+    path = str(tmp_path)
+    queue = _spill(path, 10)
+    for _ in range(4):
+        queue.release(queue.pop())
+    # A live block sent ahead of the backlog
+    queue.release(queue.take(len(queue.blocks) - 1))
+    queue.close()
+
+    queue = SampleQueue(memory_bytes=0, spill_dir=path)
+    assert _ids(queue) == [4, 5, 6, 7, 8]
+    assert queue.samples == 5
+
+
+def test_requeued_blocks_are_replayed(tmp_path):
+    path = str(tmp_path)
+    queue = _spill(path, 4)
+    # Sent but not acked when the link went down
+    sent = [queue.pop(), queue.pop()]
+    queue.requeue(sent)
+    queue.release(queue.pop())
+    queue.close()
+
+    queue = SampleQueue(memory_bytes=0, spill_dir=path)
+    assert _ids(queue) == [1, 2, 3]
+
+
+def test_fully_delivered_spill_leaves_nothing(tmp_path):
+    path = str(tmp_path)
+    queue = _spill(path, 6)
+    queue.segment = None    # as if the run had moved on to a new segment
+    while queue.blocks:
+        queue.release(queue.pop())
+    queue.close()
+    assert os.listdir(path) == []
+    assert len(SampleQueue(memory_bytes=0, spill_dir=path)) == 0
+
+
+def test_restart_twice(tmp_path):
+    path = str(tmp_path)
+    queue = _spill(path, 6)
+    queue.release(queue.pop())
+    queue.close()
+    queue = SampleQueue(memory_bytes=0, spill_dir=path)
+    queue.release(queue.pop())
+    queue.close()
+    queue = SampleQueue(memory_bytes=0, spill_dir=path)
+    assert _ids(queue) == [2, 3, 4, 5]
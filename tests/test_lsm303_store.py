@@ -0,0 +1,84 @@
+import pytest
+
+from lsm303_store import INDEX_STRIDE, CaptureReader, CaptureWriter
+
+
+def _write(writer, start, n):
+    for i in range(start, start + n):
+        writer.append(i * 1000, float(i), (i, -i, 1), (2, i, -i))
+
+
+def _ts(path):
+    reader = CaptureReader(path)
+    try:
+        return reader['ts'].tolist()
+    finally:
+        reader.close()
+
+
+def test_reopen_appends_after_existing_samples(tmp_path):
+    path = str(tmp_path / 'capture')
+    # Small chunks, so the first session already grew every file
+    writer = CaptureWriter(path, chunk=16)
+    _write(writer, 0, 40)
+    writer.close()
+    writer = CaptureWriter(path, chunk=16)
+    assert writer.count == 40
+    _write(writer, 40, 25)
+    writer.close()
+    assert _ts(path) == [i * 1000 for i in range(65)]
+
+
+def test_reopen_after_crash_keeps_committed_samples(tmp_path):
+    path = str(tmp_path / 'capture')
+    crashed = CaptureWriter(path, chunk=16)
+    _write(crashed, 0, 20)
+    # Not closed: the files are still preallocated past the last sample
+    writer = CaptureWriter(path, chunk=16)
+    assert writer.count == 20
+    _write(writer, 20, 5)
+    writer.close()
+    assert _ts(path) == [i * 1000 for i in range(25)]
+
+
+def test_time_index_spans_sessions(tmp_path):
+    path = str(tmp_path / 'capture')
+    n = INDEX_STRIDE + INDEX_STRIDE // 2
+    writer = CaptureWriter(path)
+    _write(writer, 0, n)
+    writer.close()
+    writer = CaptureWriter(path)
+    _write(writer, n, n)
+    writer.close()
+    reader = CaptureReader(path)
+    try:
+        t = 2 * INDEX_STRIDE + 7
+        window = reader.window(t * 1000, (t + 3) * 1000)
+        assert window['ts'].tolist() == [t * 1000, (t + 1) * 1000,
+                                         (t + 2) * 1000]
+        assert window['heading'].tolist() == [t, t + 1, t + 2]
+    finally:
+        reader.close()
+
+
+def test_truncate_starts_over(tmp_path):
+    path = str(tmp_path / 'capture')
+    writer = CaptureWriter(path)
+    _write(writer, 0, 10)
+    writer.close()
+    writer = CaptureWriter(path, truncate=True)
+    assert writer.count == 0
+    _write(writer, 100, 3)
+    writer.close()
+    assert _ts(path) == [100000, 101000, 102000]
+
+
+def test_reopen_refuses_another_layout(tmp_path):
+    path = tmp_path / 'capture'
+    CaptureWriter(str(path)).close()
+    meta = (path / 'meta.json').read_text()
+    (path / 'meta.json').write_text(meta.replace('"index_stride": %d' %
+                                                 INDEX_STRIDE,
+                                                 '"index_stride": 1'))
+    with pytest.raises(RuntimeError):
+        CaptureWriter(str(path))
@@ -0,0 +1,38 @@
+from lsm303_metrics import Metrics
+from lsm303_spectrum import SpectrumStage
+from lsm303_tcp import report
+
+
+class FakeSender(object):
+    def stats(self):
+        return {'connected': True, 'queued': 0, 'spilled': 0, 'dropped': 0}
+
+
+def _report(spectrum, capsys):
+    metrics = Metrics(('i2c', 'compute', 'send', 'rtt'))
+    report(metrics, None, FakeSender(), [], spectrum)
+    return metrics.last, capsys.readouterr().out
+
+
+def test_report_before_first_window(capsys):
+    last, out = _report(SpectrumStage(size=64, rate=100.0), capsys)
+    assert 'spectrum' not in last
+    assert 'az strongest line n/a' in out
+
+
+def test_report_without_usable_bins(capsys):
+    # A 2-point hann window has no bin outside the DC lobe: no peak
+    spectrum = SpectrumStage(size=2, rate=100.0)
+    spectrum.feed([1.0, 2.0, 3.0, 4.0])
+    assert spectrum.last is not None
+    last, out = _report(spectrum, capsys)
+    assert 'spectrum' not in last
+    assert 'az strongest line n/a' in out
+
+
+def test_report_with_peak(capsys):
+    spectrum = SpectrumStage(size=64, rate=100.0)
+    spectrum.feed([(-1.0) ** (i // 4) for i in range(128)])
+    last, out = _report(spectrum, capsys)
+    assert last['spectrum']['peak_hz'] > 0
+    assert 'az strongest line' in out and 'n/a' not in out
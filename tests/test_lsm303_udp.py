@@ -0,0 +1,61 @@
+from lsm303_udp import LossTracker
+
+
+def _feed(tracker, seqs, per=10):
+    return [tracker.add(seq & 0xFFFFFFFF, seq * per, per) for seq in seqs]
+
+
+def test_replay_older_than_history_is_stale_not_recovered():
+    tracker = LossTracker(history=16)
+    _feed(tracker, range(100))
+    assert _feed(tracker, [50]) == [False]
+    s = tracker.summary()
+    assert (s['lost'], s['late'], s['duplicates']) == (0, 0, 1)
+
+
+def test_reordered_datagram_is_taken_off_the_losses():
+    tracker = LossTracker(history=16)
+    _feed(tracker, [0, 1, 3, 4, 2])
+    s = tracker.summary()
+    assert (s['received'], s['lost'], s['late'], s['duplicates']) == \
+        (5, 0, 1, 0)
+    assert s['samples_lost'] == 0
+
+
+def test_late_datagram_counts_once():
+    tracker = LossTracker(history=16)
+    assert _feed(tracker, [0, 2, 1, 1]) == [True, True, True, False]
+    s = tracker.summary()
+    assert (s['lost'], s['late'], s['duplicates']) == (0, 1, 1)
+
+
+def test_duplicate_of_a_received_datagram():
+    tracker = LossTracker(history=16)
+    _feed(tracker, [0, 1, 2, 3, 1, 3])
+    s = tracker.summary()
+    assert (s['lost'], s['late'], s['duplicates']) == (0, 0, 2)
+
+
+def test_loss_recovered_only_inside_the_window():
+    tracker = LossTracker(history=16)
+    _feed(tracker, [0, 2])
+    _feed(tracker, range(3, 40))
+    # 1 was missed, but is now far older than the window
+    assert _feed(tracker, [1]) == [False]
+    s = tracker.summary()
+    assert (s['lost'], s['late'], s['duplicates']) == (1, 0, 1)
+
+
+def test_lost_never_negative():
+    tracker = LossTracker(history=16)
+    _feed(tracker, range(100))
+    _feed(tracker, list(range(85, 100)) * 3 + list(range(0, 100, 7)))
+    assert tracker.summary()['lost'] == 0
+
+
+def test_reorder_across_wraparound():
+    tracker = LossTracker(history=16)
+    start = (1 << 32) - 3
+    _feed(tracker, [start, start + 1, start + 3, start + 4, start + 2])
+    s = tracker.summary()
+    assert (s['lost'], s['late'], s['resets']) == (0, 1, 0)
@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+from lsm303_wire import FLAG_DELTA, Frame
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_does_not_need_numpy():
+    code = ('import sys, lsm303_wire, lsm303_udp; '
+            'print("numpy" in sys.modules)')
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    assert out.strip() == b'False'
+
+
+def test_delta_frame_columns():
+    import numpy as np
+
+    from lsm303_delta import DeltaEncoder
+    n = 50
+    ts = np.arange(n, dtype='<u8') * 10000
+    heading = np.linspace(0, 90, n).astype('<f4')
+    accel = np.tile(np.array([1, 2, 3], dtype='<i2'), n)
+    mag = np.tile(np.array([4, -5, 6], dtype='<i2'), n)
+    count, block = DeltaEncoder().encode(ts, heading, accel, mag)
+    ts2, heading2, accel2, mag2 = Frame(0, FLAG_DELTA, count,
+                                        block).columns()
+    assert list(ts2) == ts.tolist()
+    assert list(accel2) == accel.tolist()
+    assert list(mag2) == mag.tolist()
+    assert np.allclose(heading2, heading, atol=0.01)
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from modbus_motor import (ACCEL_TIME, CONTROL_MODE, CONTROL_WORD,
+                          DECEL_TIME, ENABLE, TARGET_SPEED, VELOCITY_MODE,
+                          MotorClient, MotorError)
+from modbus_sim import ILLEGAL_ADDRESS, ILLEGAL_FUNCTION, SlaveSimulator
+
+
+@pytest.fixture
+def sim():
+    with SlaveSimulator() as sim:
+        yield sim
+
+
+@pytest.fixture(params=[False, True], ids=['pymodbus', 'fast'])
+def fast(request):
+    return request.param
+
+
+def _run(sim, fast, body):
+    async def main():
+        async with MotorClient(sim.port, fast=fast, timeout=0.5) as motor:
+            return await body(motor)
+    return asyncio.run(main())
+
+
+def _signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def _targets(sim):
+    return [w for w in sim.writes if w[1] == TARGET_SPEED]
+
+
+def test_speed_burst_is_one_write_and_last_wins(sim, fast):
+    async def body(motor):
+        await motor.velocity_mode()
+        futures = [motor.set_speed(n, -n) for n in range(100)]
+        await asyncio.gather(*futures)
+        return motor.superseded
+
+    superseded = _run(sim, fast, body)
+    assert superseded == 99
+    assert _targets(sim) == [(16, TARGET_SPEED, 2)]
+    regs = sim.registers()
+    assert (_signed(regs[TARGET_SPEED]), _signed(regs[TARGET_SPEED + 1])) \
+        == (99, -99)
+
+
+def test_paced_speed_updates_coalesce(sim, fast):
+    # Faster than the bus takes them: most targets are superseded
+    async def body(motor):
+        await motor.velocity_mode()
+        futures = []
+        for n in range(200):
+            futures.append(motor.set_speed(n, n))
+            await asyncio.sleep(0)
+        await asyncio.gather(*futures)
+
+    _run(sim, fast, body)
+    writes = _targets(sim)
+    assert 1 <= len(writes) < 50
+    assert _signed(sim.registers()[TARGET_SPEED]) == 199
+
+
+def test_contiguous_commands_share_a_frame(sim, fast):
+    async def body(motor):
+        await asyncio.gather(motor.write(ACCEL_TIME, [200, 200]),
+                             motor.write(DECEL_TIME, [300, 300]),
+                             motor.write(CONTROL_MODE, VELOCITY_MODE),
+                             motor.write(CONTROL_WORD, ENABLE))
+
+    _run(sim, fast, body)
+    assert sim.writes == [(16, ACCEL_TIME, 4), (16, CONTROL_MODE, 2)]
+    regs = sim.registers()
+    assert [regs[ACCEL_TIME + i] for i in range(4)] == [200, 200, 300, 300]
+
+
+@pytest.mark.parametrize('code', [ILLEGAL_FUNCTION, ILLEGAL_ADDRESS])
+def test_write_exception_reaches_the_caller(sim, fast, code):
+    sim.faults[CONTROL_WORD] = code
+
+    async def body(motor):
+        mode = motor.write(CONTROL_MODE, VELOCITY_MODE)
+        enable = motor.write(CONTROL_WORD, ENABLE)
+        results = await asyncio.gather(mode, enable, return_exceptions=True)
+        # The bus is still usable afterwards
+        await motor.write(ACCEL_TIME, 100)
+        return results, motor.errors
+
+    results, errors = _run(sim, fast, body)
+    # Merged into one frame, so both commands carry the exception
+    assert all(isinstance(r, MotorError) for r in results)
+    assert errors == 1
+    assert sim.registers()[ACCEL_TIME] == 100
+
+
+def test_speed_exception_reaches_every_waiter(sim, fast):
+    sim.faults[TARGET_SPEED] = ILLEGAL_ADDRESS
+
+    async def body(motor):
+        futures = [motor.set_speed(n, n) for n in range(5)]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = _run(sim, fast, body)
+    assert len(results) == 5
+    assert all(isinstance(r, MotorError) for r in results)
+
+
+def test_read_exception_raises(sim, fast):
+    async def body(motor):
+        with pytest.raises(MotorError):
+            # Over the 125-register limit: illegal data address
+            await motor.read(ACCEL_TIME, 126)
+        sim.faults[ACCEL_TIME] = ILLEGAL_FUNCTION
+        with pytest.raises(MotorError):
+            await motor.read(ACCEL_TIME, 2)
+
+    _run(sim, fast, body)
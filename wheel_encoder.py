@@ -0,0 +1,513 @@
+# Edge-timestamped wheel encoder capture with vectorized RPM estimation.
+#
+# Polling a pin from Python, as 2023S-103a-gpio.py reads it, misses every
+# edge that comes and goes between two reads, and the time the read
+# happened is not the time the edge did. Here edges are captured as
+# events, stamped when they happen, and kept in a preallocated EdgeRing
+# (timestamps u64 ns and flags u8, absolute positions as in SampleRing)
+# for the estimator to work on in bulk.
+#
+#   GpiodCapture   libgpiod v2 edge events: the kernel stamps each edge in
+#                  its interrupt handler and queues it in a per-request
+#                  FIFO (event_buffer_size); a thread drains it in
+#                  batches. Sequence numbers show when the FIFO overflowed
+#                  and events were dropped.
+#   RpiCapture     RPi.GPIO / Jetson.GPIO add_event_detect() callbacks,
+#                  stamped in the callback (user space, later and noisier)
+#
+# Flags are the channel (bit 0: 0 = A, 1 = B) and the new level (bit 1).
+# Encoder decodes quadrature (x4: every edge of A and B is a count, the
+# sign from the Gray-code transition) or a single-channel tachometer, all
+# with numpy over whole batches: the levels of the other channel come
+# from a forward fill, the step of each edge from a 16-entry transition
+# table. RPM over a window of edges is then (counts[i] - counts[i-w]) /
+# (ts[i] - ts[i-w]) for every edge at once.
+#
+# SimEdgeSource stands in for a gpiod request: a generator thread makes
+# the edges of a wheel turning at a varying RPM with exact timestamps and
+# pushes them into a FIFO that drops its oldest event when full, as the
+# kernel's does. The bench sweeps the edge rate to find how fast the
+# capture thread keeps up without loss.
+#
+#   python3 wheel_encoder.py                      # simulated capture bench
+#   python3 wheel_encoder.py --chip /dev/gpiochip0 --lines 50,79
+import array
+import collections
+import math
+import threading
+import time
+
+import numpy as np
+
+# Slots of the wheel's encoder disc (2018S-27 encoder lecture)
+LINES_PER_REV = 20
+
+CHANNEL_B = 0x01
+RISING = 0x02
+
+# Gray-code step for (previous AB, new AB) -> -1, 0, +1, A leading B
+# counting forward; impossible double transitions (a lost edge) count 0
+_STEPS = [0, -1, 1, 0,
+          1, 0, 0, -1,
+          -1, 0, 0, 1,
+          0, 1, -1, 0]
+STEP_TABLE = np.array(_STEPS, dtype=np.int8)
+
+
+class EdgeRing(object):
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.ts = array.array('Q', bytes(8 * capacity))
+        self.flags = array.array('B', bytes(capacity))
+        self.head = 0
+        self.lost = 0
+
+    def tail(self):
+        return max(0, self.head - self.capacity)
+
+    def append(self, ts, flags):
+        i = self.head % self.capacity
+        self.ts[i] = ts
+        self.flags[i] = flags
+        self.head += 1
+
+    def arrays(self, start, end=None):
+        # (ts, flags) numpy copies of positions [start, end)
+        end = self.head if end is None else end
+        start = max(start, self.tail())
+        if end <= start:
+            return (np.empty(0, dtype=np.uint64),
+                    np.empty(0, dtype=np.uint8))
+        ts = np.frombuffer(self.ts, dtype=np.uint64)
+        flags = np.frombuffer(self.flags, dtype=np.uint8)
+        i, j = start % self.capacity, end % self.capacity
+        if i < j:
+            return ts[i:j].copy(), flags[i:j].copy()
+        return (np.concatenate((ts[i:], ts[:j])),
+                np.concatenate((flags[i:], flags[:j])))
+
+
+def _ffill(values, mask, initial):
+    # values[k] where mask[k], else the last such value before k
+    index = np.where(mask, np.arange(len(mask)), -1)
+    np.maximum.accumulate(index, out=index)
+    out = values[np.maximum(index, 0)].astype(np.int8)
+    out[index < 0] = initial
+    return out
+
+
+def decode(flags, state=(0, 0), quadrature=True):
+    # -> (per-edge steps int8, new (A, B) levels)
+    flags = np.asarray(flags, dtype=np.uint8)
+    if not quadrature:
+        return np.ones(len(flags), dtype=np.int8), state
+    if not len(flags):
+        return np.empty(0, dtype=np.int8), state
+    level = (flags & RISING) >> 1
+    is_b = (flags & CHANNEL_B).astype(bool)
+    a = _ffill(level, ~is_b, state[0])
+    b = _ffill(level, is_b, state[1])
+    ab = (a << 1) | b
+    previous = np.empty_like(ab)
+    previous[0] = (state[0] << 1) | state[1]
+    previous[1:] = ab[:-1]
+    steps = STEP_TABLE[(previous << 2) | ab]
+    return steps, (int(a[-1]), int(b[-1]))
+
+
+def rpm_series(ts, counts, window, counts_per_rev):
+    # RPM at every edge from the `window` edges before it (NaN for the
+    # first window edges); ts in ns, counts cumulative
+    ts = np.asarray(ts, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    out = np.full(len(ts), np.nan)
+    if len(ts) > window:
+        dt = (ts[window:] - ts[:-window]) * 1e-9
+        dc = counts[window:] - counts[:-window]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[window:] = dc / counts_per_rev / dt * 60.0
+    return out
+
+
+class Encoder(object):
+    def __init__(self, ring, lines_per_rev=LINES_PER_REV, quadrature=True,
+                 window=32, stall=0.2):
+        # window: edges per RPM estimate; stall: seconds without an edge
+        # after which the wheel counts as stopped
+        self.ring = ring
+        self.quadrature = quadrature
+        self.counts_per_rev = lines_per_rev * (4 if quadrature else 2)
+        self.window = window
+        self.stall = stall
+        self.pos = 0
+        self.state = (0, 0)
+        self.count = 0
+        # Cumulative count at each ring position, for RPM windows
+        self.counts = array.array('q', bytes(8 * ring.capacity))
+        self.last_ts = None
+
+    def update(self):
+        # Decode the edges captured since the last call; returns how many
+        ring = self.ring
+        start = max(self.pos, ring.tail())
+        end = ring.head
+        ts, flags = ring.arrays(start, end)
+        if not len(ts):
+            return 0
+        steps, self.state = decode(flags, self.state, self.quadrature)
+        cumulative = np.cumsum(steps, dtype=np.int64) + self.count
+        counts = np.frombuffer(self.counts, dtype=np.int64)
+        cap = ring.capacity
+        i, j = start % cap, end % cap
+        if i < j:
+            counts[i:j] = cumulative
+        else:
+            counts[i:] = cumulative[:cap - i]
+            counts[:j] = cumulative[cap - i:]
+        self.count = int(cumulative[-1])
+        self.last_ts = int(ts[-1])
+        self.pos = end
+        return len(ts)
+
+    def revolutions(self):
+        return self.count / float(self.counts_per_rev)
+
+    def rpm(self, now_ns=None):
+        # From the last `window` edges; 0 once no edge came for `stall`
+        self.update()
+        ring = self.ring
+        if self.last_ts is None:
+            return 0.0
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        if now_ns - self.last_ts > self.stall * 1e9:
+            return 0.0
+        # Only up to what update() decoded: the capture thread may have
+        # appended edges since, whose counts are not filled in yet
+        end = self.pos - 1
+        begin = max(ring.tail(), end - self.window)
+        if begin >= end:
+            return 0.0
+        cap = ring.capacity
+        dt = (ring.ts[end % cap] - ring.ts[begin % cap]) * 1e-9
+        dc = self.counts[end % cap] - self.counts[begin % cap]
+        return dc / float(self.counts_per_rev) / dt * 60.0 if dt > 0 else 0.0
+
+    def series(self, start=None, end=None):
+        # (ts, rpm) of every edge still in the ring
+        ring = self.ring
+        start = ring.tail() if start is None else max(start, ring.tail())
+        end = self.pos if end is None else min(end, self.pos)
+        ts, _ = ring.arrays(start, end)
+        counts = np.frombuffer(self.counts, dtype=np.int64)
+        cap = ring.capacity
+        index = np.arange(start, end) % cap
+        return ts, rpm_series(ts, counts[index], self.window,
+                              self.counts_per_rev)
+
+
+class GpiodCapture(object):
+    # Drains a libgpiod v2 edge-event request (or SimEdgeSource) into a
+    # ring; channels: line offsets of A (and B)
+    def __init__(self, ring, request, channels, batch=256, rising=None):
+        self.ring = ring
+        self.request = request
+        self.channel = dict((offset, i) for i, offset in enumerate(channels))
+        self.batch = batch
+        if rising is None:
+            import gpiod
+            rising = gpiod.EdgeEvent.Type.RISING_EDGE
+        self.rising = rising
+        self.seqno = 0
+        self.events = 0
+        self.reads = 0
+        self.running = False
+        self.thread = None
+
+    @classmethod
+    def open(cls, ring, chip, offsets, buffer=1024, consumer='cmpe242'):
+        import gpiod
+        from gpiod.line import Clock, Edge
+        settings = gpiod.LineSettings(edge_detection=Edge.BOTH,
+                                      event_clock=Clock.MONOTONIC)
+        request = gpiod.request_lines(
+            chip, consumer=consumer, config={tuple(offsets): settings},
+            event_buffer_size=buffer)
+        return cls(ring, request, offsets)
+
+    def drain(self, timeout=0.1):
+        if not self.request.wait_edge_events(timeout):
+            return 0
+        events = self.request.read_edge_events(self.batch)
+        ring = self.ring
+        channel = self.channel
+        rising = self.rising
+        for event in events:
+            seqno = event.global_seqno
+            if seqno != self.seqno + 1 and self.seqno:
+                ring.lost += seqno - self.seqno - 1
+            self.seqno = seqno
+            flags = channel[event.line_offset]
+            if event.event_type == rising:
+                flags |= RISING
+            ring.append(event.timestamp_ns, flags)
+        self.events += len(events)
+        self.reads += 1
+        return len(events)
+
+    def _run(self):
+        while self.running:
+            self.drain()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class RpiCapture(object):
+    # add_event_detect() callbacks on BOARD pins A (and B)
+    def __init__(self, ring, pins, module=None, bouncetime=None):
+        if module is None:
+            try:
+                import Jetson.GPIO as module
+            except ImportError:
+                import RPi.GPIO as module
+        self.GPIO = module
+        self.ring = ring
+        self.pins = list(pins)
+        module.setwarnings(False)
+        module.setmode(module.BOARD)
+        for i, pin in enumerate(self.pins):
+            module.setup(pin, module.IN)
+            kw = {} if bouncetime is None else {'bouncetime': bouncetime}
+            module.add_event_detect(pin, module.BOTH,
+                                    callback=self._callback(i, pin), **kw)
+
+    def _callback(self, channel, pin):
+        ring = self.ring
+        read = self.GPIO.input
+        clock = time.monotonic_ns
+
+        def edge(_):
+            ts = clock()
+            ring.append(ts, channel | (RISING if read(pin) else 0))
+        return edge
+
+    def stop(self):
+        for pin in self.pins:
+            self.GPIO.remove_event_detect(pin)
+        self.GPIO.cleanup(self.pins)
+
+
+class SimEdgeEvent(object):
+    __slots__ = ('timestamp_ns', 'line_offset', 'event_type',
+                 'global_seqno', 'line_seqno')
+
+    def __init__(self, ts, offset, event_type, seqno):
+        self.timestamp_ns = ts
+        self.line_offset = offset
+        self.event_type = event_type
+        self.global_seqno = seqno
+        self.line_seqno = seqno
+
+
+class SimEdgeSource(object):
+    # Quadrature edges of a wheel at rpm(t) (t in s from start), queued
+    # the way the gpiod character device queues them
+    RISING_EDGE = 1
+    FALLING_EDGE = 2
+    # A rises, B rises, A falls, B falls: forward
+    SEQUENCE = [(0, True), (1, True), (0, False), (1, False)]
+
+    def __init__(self, rpm, lines_per_rev=LINES_PER_REV, buffer=1024,
+                 tick=0.0002):
+        self.rpm = rpm
+        self.counts_per_rev = 4 * lines_per_rev
+        self.fifo = collections.deque(maxlen=buffer)
+        self.cond = threading.Condition()
+        self.tick = tick
+        self.generated = 0
+        self.running = False
+        self.thread = None
+
+    def wait_edge_events(self, timeout):
+        with self.cond:
+            if not self.fifo:
+                self.cond.wait(timeout)
+            return bool(self.fifo)
+
+    def read_edge_events(self, max_events=None):
+        fifo = self.fifo
+        with self.cond:
+            n = len(fifo) if max_events is None else \
+                min(max_events, len(fifo))
+            return [fifo.popleft() for _ in range(n)]
+
+    def _run(self):
+        t0 = time.monotonic_ns()
+        ts = t0
+        k = 0
+        rising, falling = self.RISING_EDGE, self.FALLING_EDGE
+        sequence = self.SEQUENCE
+        while self.running:
+            now = time.monotonic_ns()
+            batch = []
+            while ts <= now:
+                rpm = self.rpm((ts - t0) * 1e-9)
+                if rpm <= 0:
+                    ts = now + 1
+                    break
+                channel, up = sequence[k & 3]
+                k += 1
+                batch.append(SimEdgeEvent(ts, channel,
+                                          rising if up else falling, k))
+                ts += int(60e9 / (rpm * self.counts_per_rev))
+            if batch:
+                with self.cond:
+                    # A full deque drops its oldest, like the kernel FIFO
+                    self.fifo.extend(batch)
+                    self.cond.notify()
+                self.generated = k
+            time.sleep(self.tick)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def _capture(rate, buffer, seconds, lines_per_rev=LINES_PER_REV):
+    # Edges at a constant rate through a FIFO of `buffer` events
+    rpm = rate * 60.0 / (4 * lines_per_rev)
+    ring = EdgeRing(1 << 20)
+    source = SimEdgeSource(lambda t: rpm, lines_per_rev, buffer)
+    capture = GpiodCapture(ring, source, [0, 1],
+                           rising=SimEdgeSource.RISING_EDGE)
+    capture.start()
+    source.start()
+    time.sleep(seconds)
+    source.stop()
+    time.sleep(0.05)
+    capture.stop()
+    capture.drain(0)
+    return source.generated, ring.head, ring.lost, capture.reads
+
+
+def _bench(rates=(1000, 2000, 5000, 20000, 50000, 100000, 200000),
+           buffers=(16, 1024),
+           seconds=1.0):
+    print("capture through a gpiod-style FIFO, {0} line disc (x4 = {1} "
+          "edges/rev):".format(LINES_PER_REV, 4 * LINES_PER_REV))
+    best = {}
+    for buffer in buffers:
+        lossless = True
+        for rate in rates:
+            generated, captured, lost, reads = _capture(rate, buffer,
+                                                        seconds)
+            print("  fifo {0:5d}  {1:7d} edges/s ({2:6.0f} rpm): {3:7d} "
+                  "generated, {4:7d} captured, {5:6d} lost, {6:5.1f} "
+                  "edges/read".format(
+                      buffer, rate, rate * 60.0 / (4 * LINES_PER_REV),
+                      generated, captured, lost,
+                      captured / float(max(reads, 1))))
+            lossless = lossless and lost == 0 and generated == captured
+            if lossless:
+                best[buffer] = rate
+    for buffer in buffers:
+        print("  fifo {0}: highest rate without loss {1} edges/s".format(
+            buffer, best.get(buffer, 'none')))
+
+    # Estimator: 300 +- 150 rpm over a 4 s period, read every 100 ms
+    def speed(t):
+        return 300.0 + 150.0 * math.sin(2 * math.pi * t / 4.0)
+    ring = EdgeRing(1 << 20)
+    source = SimEdgeSource(speed, LINES_PER_REV, 1024)
+    capture = GpiodCapture(ring, source, [0, 1],
+                           rising=SimEdgeSource.RISING_EDGE)
+    encoder = Encoder(ring, window=32)
+    capture.start()
+    source.start()
+    start = time.monotonic_ns()
+    errors = []
+    for _ in range(20):
+        time.sleep(0.1)
+        now = time.monotonic_ns()
+        errors.append(encoder.rpm(now) - speed((now - start) * 1e-9))
+    source.stop()
+    time.sleep(0.05)
+    capture.stop()
+    capture.drain(0)
+    encoder.update()
+    print("live rpm (window 32 edges) vs true: mean error {0:+.1f} rpm, "
+          "max {1:.1f} rpm; {2} counts = {3:.3f} rev for {4} edges".format(
+              np.mean(errors), np.max(np.abs(errors)), encoder.count,
+              encoder.revolutions(), ring.head))
+
+    # Vectorized decode + RPM of a long capture vs a per-edge loop
+    n = 1000000
+    flags = np.array([0 | RISING, 1 | RISING, 0, 1] * (n // 4),
+                     dtype=np.uint8)
+    ts = np.cumsum(np.full(n, 25000, dtype=np.int64))
+    t0 = time.perf_counter()
+    steps, _ = decode(flags)
+    rpm = rpm_series(ts, np.cumsum(steps, dtype=np.int64), 32,
+                     4 * LINES_PER_REV)
+    vectorized = time.perf_counter() - t0
+    m = 100000
+    t0 = time.perf_counter()
+    state, count, counts = 0, 0, []
+    for f in flags[:m].tolist():
+        level = (f & RISING) >> 1
+        new = (state & 1) | (level << 1) if not f & CHANNEL_B else \
+            (state & 2) | level
+        count += _STEPS[(state << 2) | new]
+        state = new
+        counts.append(count)
+    loop = (time.perf_counter() - t0) * n / m
+    print("decode + rpm of {0} edges: numpy {1:.1f} ms, per-edge loop "
+          "~{2:.0f} ms ({3:.0f}x); rpm {4:.1f} (expected {5:.1f})".format(
+              n, vectorized * 1e3, loop * 1e3, loop / vectorized,
+              rpm[-1], 60e9 / 25000 / (4 * LINES_PER_REV)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Wheel encoder edge capture and RPM estimation')
+    parser.add_argument('--chip', help='gpiod chip to capture from; '
+                        'simulated bench when omitted')
+    parser.add_argument('--lines', default='50,79',
+                        help='line offsets of channels A,B')
+    parser.add_argument('--lines-per-rev', type=int, default=LINES_PER_REV)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+    if args.chip:
+        offsets = [int(x) for x in args.lines.split(',')]
+        ring = EdgeRing()
+        capture = GpiodCapture.open(ring, args.chip, offsets).start()
+        encoder = Encoder(ring, args.lines_per_rev, len(offsets) == 2)
+        stop = time.monotonic() + args.seconds
+        while time.monotonic() < stop:
+            time.sleep(0.5)
+            print("{0:8.1f} rpm  {1:9.3f} rev  {2} lost".format(
+                encoder.rpm(), encoder.revolutions(), ring.lost))
+        capture.stop()
+    else:
+        _bench()